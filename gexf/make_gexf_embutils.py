@@ -22,6 +22,9 @@ parser.add_argument('--distance-limit', type=float, default=0.4 , help='Add arcs
 parser.add_argument('--min-neighbours', type=int, default=2 , help='A word should have at least this many neighbours (default: 2)')
 parser.add_argument('--max-neighbours', type=int, default=60 , help='Consider at most this many neighbours within distance limit (default: 60)')
 parser.add_argument('--weight-scaling', type=float, default=2.5 , help='Scaling factor of distances to arc strength (default: 2.5)')
+parser.add_argument('--knn', action='store_true', default=False, help='Connect each of the first --n-words words only to its nearest neighbours among them, at most --max-neighbours within --distance-limit, computing the whole graph in one pass')
+parser.add_argument('--index', type=str, action='store', default=None, help='Use an approximate nearest neighbour index from this file, building and saving it first if it does not exist')
+parser.add_argument('--index-ef', type=int, default=None, help='Search width of the approximate nearest neighbour index, higher is slower but more accurate')
 
 
 def make_url_oracc(word):
@@ -93,6 +96,14 @@ def build_graph(args):
 
     vecs = embutils.WordEmbeddings()
     vecs.load_from_file(args.embedding_file)
+    if args.index != None:
+        if os.path.exists(args.index):
+            vecs.load_index(args.index)
+        else:
+            vecs.build_index()
+            vecs.save_index(args.index)
+        if args.index_ef != None:
+            vecs.set_index_ef(args.index_ef)
     vocabulary = vecs.get_vocabulary()
     words = list(filter(acceptable_word, vocabulary))
     if args.ego == None:
@@ -102,6 +113,9 @@ def build_graph(args):
 
     edges_added = set()
     words_added = set()
+    freqranks = {}
+    for rank, word in enumerate(vocabulary):
+        freqranks.setdefault(word, rank + 1)
     
     def make_node(word, index):
         node = etree.Element("node", id=str(index), label=word)
@@ -115,19 +129,42 @@ def build_graph(args):
             else:
                 attvalues.append(etree.Element("attvalue", id="egourl", value=make_url_ego(word)))
             
-        freqrank = vocabulary.index(word) + 1
+        freqrank = freqranks[word]
         attvalues.append(etree.Element("attvalue", id="freqrank", value=f"{freqrank}/{len(vocabulary)}"))
         size = etree.SubElement(node, "size", value = str(-1*log(float(freqrank)/(10*args.n_words))))
         color = etree.SubElement(node, "color", r = r_value, g = g_value, b = b_value)
         return node
 
+    if args.ego == None and args.knn:
+        indptr, indices, distances = vecs.knn_graph(args.n_words, args.max_neighbours, args.distance_limit)
+        for i in range(len(indptr) - 1):
+            word = vocabulary[i]
+            if not acceptable_word(word):
+                continue
+            nodes.append(make_node(word, i))
+            for neighbour_id, distance in zip(indices[indptr[i]:indptr[i + 1]], distances[indptr[i]:indptr[i + 1]]):
+                neighbour_word = vocabulary[neighbour_id]
+                if not acceptable_word(neighbour_word) or (neighbour_word, word) in edges_added:
+                    continue
+                edges_added.add((word, neighbour_word))
+                neighbour_weight = max(0.0, (1 - distance - args.distance_limit))*args.weight_scaling
+                edges.append(etree.Element("edge", id=str(len(edges)), source=str(i), target=str(neighbour_id), weight=str(neighbour_weight)))
+        seed_words = []
+
+    # Seed words' neighbourhoods a batch at a time, each batch in one pass
+    # over the vectors. The loop usually stops long before the last seed, so
+    # they are only fetched as it gets to them.
+    seed_batch = 32
+    seed_neighbours = []
     for i, word in enumerate(seed_words):
         if len(words_added) >= args.n_words:
             break
 
         nodes.append(make_node(word, i))
         words_added.add(word)
-        neighbours = vecs.get_words_at_distance_under(word, args.distance_limit)
+        if i % seed_batch == 0:
+            seed_neighbours = vecs.get_words_at_distance_under_many(seed_words[i:i + seed_batch], args.distance_limit)
+        neighbours = seed_neighbours[i % seed_batch]
         if len(neighbours) < args.min_neighbours + 1:
             neighbours = vecs.like(word, args.min_neighbours + 1)
         neighbours_added = 0
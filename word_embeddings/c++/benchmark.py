@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+
+import embutils
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+try:
+    import word2vec
+except ImportError:
+    word2vec = None
+
+parser = argparse.ArgumentParser(description = "Time embutils and word2vec.VecReader on synthetic word embedding files, generated from a seed so that every run sees the same data, and write the timings as a JSON report that can be compared with one from another commit.")
+parser.add_argument('--sizes', action='store', default='10000x100,100000x100,100000x300', help='Comma-separated WORDSxDIMENSION sizes of the files, eg. 3000000x300 (default: 10000x100,100000x100,100000x300)')
+parser.add_argument('--formats', action='store', default='bin,txt', help='Comma-separated file formats to time loading for, queries always use the first (default: bin,txt)')
+parser.add_argument('--data-dir', action='store', default=os.path.join(tempfile.gettempdir(), 'embutils-benchmark'), help='Where generated files are kept and reused from (default: embutils-benchmark in the temporary directory)')
+parser.add_argument('--seed', type=int, default=0, help='Seed for the vectors, words and queries (default: 0)')
+parser.add_argument('--queries', type=int, default=20, help='Number of queries of each kind (default: 20)')
+parser.add_argument('--n-closest', type=int, default=10, help='Number of results per query (default: 10)')
+parser.add_argument('--distance', type=float, default=0.5, help='Distance limit for get_words_at_distance_under (default: 0.5)')
+parser.add_argument('--repeat', type=int, default=3, help='Times to run each operation, the best and median are reported (default: 3)')
+parser.add_argument('--threads', type=int, default=None, help='Threads for embutils (default: one per core)')
+parser.add_argument('--skip-vecreader', action='store_true', default=False, help='Only time embutils')
+parser.add_argument('--output', '-o', action='store', default=None, help='Write the report here, default is STDOUT')
+parser.add_argument('--baseline', action='store', default=None, help='Compare the results with this earlier report')
+parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None, help="Don't run anything, compare two reports")
+
+def parse_size(size):
+    words, dimension = size.lower().split('x')
+    return int(words), int(dimension)
+
+def synthetic_words(n_words, rng):
+    # Lowercase words of 2 to 9 random letters, made unique by a base 36
+    # serial number, roughly in the length range of real vocabularies
+    letters = np.frombuffer(b'abcdefghijklmnopqrstuvwxyz', dtype = np.uint8)
+    lengths = rng.integers(2, 10, n_words)
+    chars = letters[rng.integers(0, 26, lengths.sum())]
+    words = []
+    pos = 0
+    for i, length in enumerate(lengths):
+        serial = np.base_repr(i, 36).lower()
+        words.append(chars[pos:pos + length].tobytes().decode('ascii') + serial)
+        pos += length
+    return words
+
+def write_synthetic(filename, n_words, dimension, seed, binary, chunk_rows = 1 << 16):
+    """
+    Write n_words vectors scattered around n_words / 200 centres, so that
+    neighbourhoods have some structure, in word2vec binary or text format.
+    """
+    rng = np.random.default_rng(seed)
+    words = synthetic_words(n_words, rng)
+    centres = rng.standard_normal((max(16, n_words // 200), dimension)).astype(np.float32)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(f"{n_words} {dimension}\n".encode('utf-8'))
+        for start in range(0, n_words, chunk_rows):
+            end = min(n_words, start + chunk_rows)
+            vectors = centres[rng.integers(0, len(centres), end - start)]
+            vectors += 0.6 * rng.standard_normal((end - start, dimension), dtype = np.float32)
+            if binary:
+                for word, vector in zip(words[start:end], vectors):
+                    f.write(word.encode('utf-8') + b' ' + vector.tobytes() + b'\n')
+            else:
+                for word, vector in zip(words[start:end], vectors):
+                    f.write((word + ' ' + ' '.join(map('{:.6f}'.format, vector.tolist())) + '\n').encode('utf-8'))
+    os.replace(tmp_filename, filename)
+    return words
+
+def synthetic_file(data_dir, n_words, dimension, seed, fmt):
+    filename = os.path.join(data_dir, f"synthetic-{n_words}x{dimension}-seed{seed}.{fmt}")
+    if not os.path.exists(filename):
+        print(f"generating {filename}", file = sys.stderr)
+        write_synthetic(filename, n_words, dimension, seed, fmt == 'bin')
+    return filename
+
+def time_runs(fun, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+
+    def record(self, backend, operation, n_words, dimension, calls, fun, fmt = None):
+        runs = time_runs(fun, self.args.repeat)
+        result = {'backend': backend, 'operation': operation, 'words': n_words,
+                  'dimension': dimension, 'calls': calls,
+                  'best': min(runs), 'median': statistics.median(runs), 'runs': runs}
+        if fmt is not None:
+            result['format'] = fmt
+        self.results.append(result)
+        print(f"{backend:>9} {operation:<16} {fmt or '':<3} {n_words:>8}x{dimension:<4} {min(runs) / calls:.6f} s/call", file = sys.stderr)
+
+    def run_size(self, n_words, dimension):
+        args = self.args
+        formats = args.formats.split(',')
+        filenames = {fmt: synthetic_file(args.data_dir, n_words, dimension, args.seed, fmt) for fmt in formats}
+        vecs = embutils.WordEmbeddings()
+        if args.threads is not None:
+            vecs.set_threads(args.threads)
+        for fmt in reversed(formats):
+            # The first format is loaded last and left in for the queries
+            self.record('embutils', 'load', n_words, dimension, 1,
+                        lambda: vecs.load_from_file(filenames[fmt]), fmt)
+        vocabulary = vecs.get_vocabulary()
+        rng = np.random.default_rng(args.seed + 1)
+        # Query words from the more frequent end, as in real use
+        picks = rng.integers(0, min(len(vocabulary), 10000), (args.queries, 3))
+        queries = [tuple(vocabulary[i] for i in row) for row in picks]
+        n = args.n_closest
+        calls = len(queries)
+        self.record('embutils', 'get', n_words, dimension, calls,
+                    lambda: [vecs.get_embedding(w1) for w1, w2, w3 in queries])
+        self.record('embutils', 'like1', n_words, dimension, calls,
+                    lambda: [vecs.like(w1, n) for w1, w2, w3 in queries])
+        self.record('embutils', 'like2', n_words, dimension, calls,
+                    lambda: [vecs.like(w1, w2, n) for w1, w2, w3 in queries])
+        self.record('embutils', 'like3', n_words, dimension, calls,
+                    lambda: [vecs.like(embutils.LikeArgs(embutils.LikeArgs(w1, w2, False), embutils.LikeArgs(w3), True), n)
+                             for w1, w2, w3 in queries])
+        self.record('embutils', 'unlike', n_words, dimension, calls,
+                    lambda: [vecs.unlike(w1, w2, n) for w1, w2, w3 in queries])
+        self.record('embutils', 'distance_under', n_words, dimension, calls,
+                    lambda: [vecs.get_words_at_distance_under(w1, args.distance) for w1, w2, w3 in queries])
+        del vecs
+        if args.skip_vecreader or word2vec is None:
+            return
+        readers = {}
+        for fmt in reversed(formats):
+            def load():
+                readers[fmt] = word2vec.VecReader(filenames[fmt])
+            self.record('VecReader', 'load', n_words, dimension, 1, load, fmt)
+        reader = readers[formats[0]]
+        self.record('VecReader', 'find', n_words, dimension, calls,
+                    lambda: [reader.find(w1) for w1, w2, w3 in queries])
+        self.record('VecReader', 'closest_n', n_words, dimension, calls,
+                    lambda: [reader.closest_n(w1, n) for w1, w2, w3 in queries])
+        self.record('VecReader', 'closest_n_batch', n_words, dimension, calls,
+                    lambda: reader.closest_n_batch([w1 for w1, w2, w3 in queries], n))
+
+    def run(self):
+        os.makedirs(self.args.data_dir, exist_ok = True)
+        for size in self.args.sizes.split(','):
+            self.run_size(*parse_size(size))
+        return {'environment': environment(self.args), 'results': self.results}
+
+def environment(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    vecs = embutils.WordEmbeddings()
+    if args.threads is not None:
+        vecs.set_threads(args.threads)
+    return {'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'embutils_threads': vecs.get_threads(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'arguments': vars(args)}
+
+def result_key(result):
+    return (result['backend'], result['operation'], result['words'], result['dimension'],
+            result.get('format', ''))
+
+def compare(old, new, out = sys.stdout):
+    """
+    Print the best time per call of each operation in both reports, and
+    new / old, so that under 1.0 means faster.
+    """
+    old_results = {result_key(result): result for result in old['results']}
+    print(f"# old {old['environment'].get('commit', '')[:12]} new {new['environment'].get('commit', '')[:12]}", file = out)
+    print("backend\toperation\tsize\tformat\told s/call\tnew s/call\tnew/old", file = out)
+    for result in new['results']:
+        key = result_key(result)
+        if key not in old_results:
+            continue
+        old_per_call = old_results[key]['best'] / old_results[key]['calls']
+        new_per_call = result['best'] / result['calls']
+        ratio = new_per_call / old_per_call if old_per_call > 0 else float('inf')
+        print(f"{key[0]}\t{key[1]}\t{key[2]}x{key[3]}\t{key[4]}\t{old_per_call:.6f}\t{new_per_call:.6f}\t{ratio:.3f}", file = out)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.compare is not None:
+        old, new = (json.load(open(filename)) for filename in args.compare)
+        compare(old, new)
+        sys.exit(0)
+    report = Benchmark(args).run()
+    if args.output != None:
+        outfile = open(args.output, 'w')
+    else:
+        outfile = sys.stdout
+    json.dump(report, outfile, indent = 1)
+    outfile.write('\n')
+    if args.baseline != None:
+        compare(json.load(open(args.baseline)), report, sys.stderr)
@@ -1,5 +1,11 @@
 #include "embutils.h"
 
+#include <charconv>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
 Vector::Vector(void) {
     cached_norm = 0.0;
 }
@@ -21,6 +27,49 @@ WordVecFloat Vector::cosine_distance(const Vector & other) const
     return std::max(static_cast<WordVecFloat>(0.0), retval);
 }
 
+// The cosine distance between two vectors from their dot product and inverse
+// norms. Sometimes very nearby vectors combined with rounding error will
+// produce a slightly negative distance, so return at least 0.0, and take a
+// zero vector to be at distance 0.0 from everything.
+static inline WordVecFloat cosine_distance_from_dot(WordVecFloat dot,
+                                                    WordVecFloat inverse_norm1,
+                                                    WordVecFloat inverse_norm2)
+{
+    if (inverse_norm1 == 0.0 || inverse_norm2 == 0.0) {
+        return 0.0;
+    }
+    return std::max(static_cast<WordVecFloat>(0.0), 1 - dot * inverse_norm1 * inverse_norm2);
+}
+
+static inline WordVecFloat inverse_norm(WordVecFloat norm)
+{
+    return norm == 0.0 ? 0.0 : 1.0 / norm;
+}
+
+static inline WordVecFloat dot_product(const WordVecFloat * l,
+                                       const WordVecFloat * r,
+                                       size_t n)
+{
+    WordVecFloat ret = 0;
+    for (size_t i = 0; i < n; ++i) {
+        ret += l[i] * r[i];
+    }
+    return ret;
+}
+
+// A dot product accumulated in double precision, for when the result goes
+// into sums that may cancel out
+static inline double exact_dot_product(const WordVecFloat * l,
+                                       const WordVecFloat * r,
+                                       size_t n)
+{
+    double ret = 0;
+    for (size_t i = 0; i < n; ++i) {
+        ret += static_cast<double>(l[i]) * r[i];
+    }
+    return ret;
+}
+
 WordVecFloat WordEmbedding::cosine_distance(const WordEmbedding & other) const
 {
     return vector.cosine_distance(other.vector);
@@ -32,206 +81,421 @@ WordVecFloat WordEmbedding::cosine_distance(const Vector & other) const
 }
 
 void WordEmbeddings::load_from_file(const std::string & filename,
-                                    float fraction)
+                                    float fraction,
+                                    const std::string & datatype)
 {
     load_from_file(filename,
                    [=] (size_t lexicon_size) {
                        return static_cast<unsigned int>(fraction * lexicon_size);
-                   });
+                   },
+                   datatype);
 }
 
 void WordEmbeddings::load_from_file(const std::string & filename,
-                                    unsigned int limit)
+                                    unsigned int limit,
+                                    const std::string & datatype)
 {
     load_from_file(filename,
                    [=] (size_t lexicon_size) {
                        return limit;
-                   });
+                   },
+                   datatype);
 }
 
+/*
+ * The file is mapped into memory and only as much of it as the limit asks
+ * for is looked at. Binary files are walked record by record to find the
+ * words, then the vectors are copied out and their norms computed in
+ * parallel. Text files are cut into lines first and the lines parsed in
+ * parallel, in place.
+ */
 void WordEmbeddings::load_from_file(
     const std::string & filename,
-    std::function<unsigned int (size_t lexicon_size)> limiter)
+    std::function<unsigned int (size_t lexicon_size)> limiter,
+    const std::string & datatype)
 {
+    PhaseTimer timer(phase_total(&Instrumentation::load_time));
     clear();
-    dimension = 0;
+    if (datatype != "float32" && datatype != "float16") {
+        throw std::runtime_error("unknown vector datatype " + datatype);
+    }
     bool binary_format = false;
     if (filename.rfind(".bin") == filename.size() - 4) {
         binary_format = true;
     }
-    char separator = ' ';
-    std::ifstream infile;
-    std::string line;
-    unsigned int lexicon_size;
-    infile.open(filename.c_str());
-    if(!infile.good()) {
+    std::shared_ptr<MappedFile> file;
+    try {
+        file = std::make_shared<MappedFile>(filename);
+    } catch (std::runtime_error & e) {
         std::cerr << "could not open vector file " << filename <<
             " for reading\n";
         return;
     }
-    std::getline(infile, line);
-    std::stringstream ss(line);
+    if (file->size() >= sizeof(SnapshotHeader) && memcmp(file->begin(), "EMBSNAP1", 8) == 0) {
+        load_snapshot(file, limiter);
+        return;
+    }
+    const char * begin = file->begin();
+    const char * end = begin + file->size();
+    const char * pos = std::find(begin, end, '\n');
+    std::stringstream ss(std::string(begin, pos));
+    unsigned int lexicon_size = 0;
     ss >> lexicon_size;
     ss.ignore(1);
     ss >> dimension;
+    pos = std::min(end, pos + 1);
     unsigned int limit = limiter(lexicon_size);
     if (limit > 0 && limit < lexicon_size) {
         lexicon_size = limit;
     }
-    reserve(lexicon_size);
-    size_t words_read = 0;
+    const size_t aligned_floats = AlignedVector::allocator_type::alignment / sizeof(WordVecFloat);
+    row_stride = (dimension + aligned_floats - 1) / aligned_floats * aligned_floats;
     if (binary_format) {
-        while (infile.good() && words_read < lexicon_size) {
-            std::getline(infile, line, separator);
-            if (words_read == 0 && line == "</s>") {
-                infile.ignore(sizeof(WordVecFloat) * dimension + 1);
-                ++words_read;
-                continue;
-            }
-            WordEmbedding we;
-            we.vector.resize(dimension);
-            infile.read((char*)&(we.vector[0]), sizeof(WordVecFloat) * dimension);
-            infile.ignore(1);
-            we.vector.cache_norm();
-            we.word = line;
-            push_back(we);
-            ++words_read;
-        }
+        load_binary(file, pos, lexicon_size, datatype == "float16");
+        source_filename = filename;
     } else {
-        while(infile.good() && words_read < lexicon_size) {
-            std::getline(infile, line);
-            if (line.empty()) { continue; }
-            ++words_read;
-            size_t pos = line.find(separator);
-            if (pos == std::string::npos) {
-                std::cerr << "warning: text vector file " << filename <<
-                    " doesn't appear to be space-separated\n  (reading line " << words_read + 1 << ")\n";
-                break;
-            }
-            std::string word = line.substr(0, pos);
-            RawVector components;
-            components.reserve(dimension);
-            size_t nextpos;
-            while (std::string::npos != (nextpos = line.find(separator, pos + 1))) {
-                components.push_back(strtod(line.substr(pos + 1, nextpos - pos).c_str(), NULL));
-                pos = nextpos;
-            }
-            // there can be one more from pos to the newline if there isn't a
-            // separator at the end
-            if (line.back() != separator) {
-                components.push_back(strtof(line.substr(pos + 1).c_str(), NULL));
-            }
-            if (size() != 0 && begin()->vector.size() != components.size()) {
-                std::cerr << "warning: vector file " << filename <<
-                    " appears malformed\n  (reading line " << words_read + 1 << ")\n";
-                continue;
-            }
-            WordEmbedding we;
-            we.word = word;
-            we.vector = Vector(components);
-            push_back(we);
-        }
+        load_text(filename, pos, end, lexicon_size);
     }
-    infile.close();
+    lookup.build(*this);
     if (size() == 0) {
         std::cerr << "Tried to read word vector file, empty result\n";
     }
     if (false) {
-        std::cerr << "Read " << size() << " vectors of dimensionality " << begin()->vector.size() << std::endl;
+        std::cerr << "Read " << size() << " vectors of dimensionality " << dimension << std::endl;
     }
 }
 
-WordEmbedding WordEmbeddings::get(const std::string & word) const
+// Everything is used in place, only the limit is applied
+void WordEmbeddings::load_snapshot(
+    std::shared_ptr<MappedFile> file,
+    std::function<unsigned int (size_t lexicon_size)> limiter)
 {
-    size_t best_prefix = 0;
-    size_t best_suffix = 0;
-    WordEmbeddings::const_iterator best_by_prefix;
-    WordEmbeddings::const_iterator best_by_suffix;
-    for (auto it = begin(); it != end(); ++it) {
-        std::string::const_iterator w_it = word.begin();
-        std::string::const_iterator t_it = it->word.begin();
-        while(true) {
-            if (w_it == word.end() && t_it == it->word.end()) {
-                // matched
-                return *it;
-            }
-            else if (w_it == word.end() || t_it == it->word.end() || *w_it != *t_it) {
-                break;
-            }
-            else {
-                ++w_it; ++t_it;
-            }
+    SnapshotHeader header;
+    memcpy(&header, file->begin(), sizeof(header));
+    const size_t alignment = AlignedVector::allocator_type::alignment;
+    auto fits = [&](uint64_t offset, uint64_t bytes) {
+        return offset % alignment == 0 && offset <= file->size() && bytes <= file->size() - offset; };
+    if (header.row_stride < header.dimension ||
+        header.slot_count == 0 || (header.slot_count & (header.slot_count - 1)) != 0 ||
+        !fits(header.matrix_offset, header.rows * header.row_stride * sizeof(WordVecFloat)) ||
+        !fits(header.inverse_norms_offset, header.rows * sizeof(WordVecFloat)) ||
+        !fits(header.word_offsets_offset, (header.rows + 1) * sizeof(uint64_t)) ||
+        !fits(header.word_arena_offset, header.word_arena_size) ||
+        !fits(header.slots_offset, header.slot_count * sizeof(uint32_t))) {
+        throw std::runtime_error("snapshot file is malformed or truncated");
+    }
+    const char * begin = file->begin();
+    const uint64_t * offsets = reinterpret_cast<const uint64_t *>(begin + header.word_offsets_offset);
+    if (offsets[header.rows] > header.word_arena_size) {
+        throw std::runtime_error("snapshot file is malformed or truncated");
+    }
+    snapshot = file;
+    dimension = header.dimension;
+    row_stride = header.row_stride;
+    row_count = header.rows;
+    unsigned int limit = limiter(header.rows);
+    if (limit > 0 && limit < row_count) {
+        row_count = limit;
+    }
+    matrix_data = reinterpret_cast<const WordVecFloat *>(begin + header.matrix_offset);
+    inverse_norm_data = reinterpret_cast<const WordVecFloat *>(begin + header.inverse_norms_offset);
+    word_offset_data = offsets;
+    word_arena_data = begin + header.word_arena_offset;
+    lookup.attach(reinterpret_cast<const uint32_t *>(begin + header.slots_offset), header.slot_count);
+}
+
+void WordEmbeddings::save_snapshot(const std::string & filename) const
+{
+    const uint64_t alignment = AlignedVector::allocator_type::alignment;
+    auto aligned = [&](uint64_t offset) { return (offset + alignment - 1) / alignment * alignment; };
+    std::vector<uint32_t> slots = make_word_slots(*this);
+    SnapshotHeader header;
+    memcpy(header.magic, "EMBSNAP1", 8);
+    header.rows = size();
+    header.dimension = dimension;
+    header.row_stride = row_stride;
+    header.word_arena_size = word_offset_data[size()] - word_offset_data[0];
+    header.slot_count = slots.size();
+    header.matrix_offset = aligned(sizeof(header));
+    header.inverse_norms_offset = aligned(
+        header.matrix_offset + size() * row_stride * sizeof(WordVecFloat));
+    header.word_offsets_offset = aligned(
+        header.inverse_norms_offset + size() * sizeof(WordVecFloat));
+    header.word_arena_offset = aligned(
+        header.word_offsets_offset + (size() + 1) * sizeof(uint64_t));
+    header.slots_offset = aligned(header.word_arena_offset + header.word_arena_size);
+
+    std::ofstream outfile(filename.c_str(), std::ios::binary);
+    if (!outfile.good()) {
+        throw std::runtime_error("could not open snapshot file " + filename + " for writing");
+    }
+    uint64_t position = 0;
+    auto write = [&](const void * data, uint64_t bytes) {
+        outfile.write(static_cast<const char *>(data), bytes);
+        position += bytes;
+    };
+    auto pad_to = [&](uint64_t offset) {
+        static const char zeros[64] = {};
+        while (position < offset) {
+            write(zeros, std::min(offset - position, static_cast<uint64_t>(sizeof(zeros))));
         }
-        if (w_it == word.end()) {
-            // word ended first, can't get a better suffix than this
-            if (word.size() > best_prefix) {
-                best_prefix = word.size();
-                best_by_prefix = it;
-            }
+    };
+    write(&header, sizeof(header));
+    pad_to(header.matrix_offset);
+    RawVector buffer;
+    RawVector row_buffer(row_stride, 0.0);
+    for (size_t row = 0; row < size(); ++row) {
+        const WordVecFloat * v = full_precision_row(row, buffer);
+        std::copy(v, v + dimension, row_buffer.begin());
+        write(row_buffer.data(), row_stride * sizeof(WordVecFloat));
+    }
+    pad_to(header.inverse_norms_offset);
+    write(inverse_norm_data, size() * sizeof(WordVecFloat));
+    pad_to(header.word_offsets_offset);
+    for (size_t row = 0; row <= size(); ++row) {
+        uint64_t offset = word_offset_data[row] - word_offset_data[0];
+        write(&offset, sizeof(offset));
+    }
+    pad_to(header.word_arena_offset);
+    write(word_arena_data + word_offset_data[0], header.word_arena_size);
+    pad_to(header.slots_offset);
+    write(slots.data(), slots.size() * sizeof(uint32_t));
+    if (!outfile.good()) {
+        throw std::runtime_error("error writing snapshot file " + filename);
+    }
+}
+
+// Records are the word, a space, the vector and a newline
+void WordEmbeddings::load_binary(std::shared_ptr<MappedFile> file,
+                                 const char * pos,
+                                 size_t lexicon_size,
+                                 bool float16)
+{
+    const char * begin = file->begin();
+    const char * end = begin + file->size();
+    source_float16 = float16;
+    size_t vector_bytes = (float16 ? sizeof(uint16_t) : sizeof(WordVecFloat)) * dimension;
+    source_offsets.reserve(lexicon_size);
+    word_offsets.reserve(lexicon_size + 1);
+    size_t words_read = 0;
+    while (pos < end && words_read < lexicon_size) {
+        const char * space = std::find(pos, end, ' ');
+        if (space == end || static_cast<size_t>(end - space - 1) < vector_bytes) {
+            break;
+        }
+        std::string_view word(pos, space - pos);
+        pos = std::min(end, space + 1 + vector_bytes + 1);
+        ++words_read;
+        if (words_read == 1 && word == "</s>") {
             continue;
-        } else if (t_it == it->word.end()) {
-                // iterator ended before word, iterator is full prefix
-            if (it->word.size() > best_prefix) {
-                best_prefix = it->word.size();
-                best_by_prefix = it;
+        }
+        source_offsets.push_back(space + 1 - begin);
+        word_arena.append(word);
+        word_offsets.push_back(word_arena.size());
+    }
+    matrix = std::make_shared<AlignedVector>(source_offsets.size() * row_stride, 0.0);
+    inverse_norms.resize(source_offsets.size());
+    use_own_arrays();
+    full_precision_source = file;
+    for_each_row_range(row_parts(), [&](size_t part, size_t row_begin, size_t row_end) {
+            for (size_t row = row_begin; row < row_end; ++row) {
+                WordVecFloat * v = matrix->data() + row * row_stride;
+                read_source_row(row, v);
+                inverse_norms[row] = inverse_norm(sqrt(dot_product(v, v, dimension)));
             }
-            continue;
-        } else {
-            // They differed here
-            if (w_it - word.begin() > best_prefix) {
-                best_prefix = (w_it - word.begin());
-                best_by_prefix = it;
-            }
-            // Then we see about the suffix
-            std::string::const_reverse_iterator w_it = word.rbegin();
-            std::string::const_reverse_iterator t_it = it->word.rbegin();
-
-            while (true) {
-                if (w_it == word.rend() || t_it == it->word.rend() || *w_it != *t_it) {
-                    break;
-                } else {
-                    ++w_it; ++t_it;
-                }
+        });
+    full_precision_source.reset();
+}
+
+namespace {
+
+// The rows parsed from some lines of a text file, and the lines that had
+// problems
+struct TextRows {
+    std::vector<WordVecFloat> components;
+    std::string words;
+    std::vector<size_t> word_ends;
+    std::vector<size_t> malformed_lines;
+    size_t unseparated_line = std::string::npos;
+};
+
+// Like strtof() but in place, empty or unparseable fields come out as 0
+WordVecFloat parse_component(const char * begin, const char * end)
+{
+    WordVecFloat retval = 0.0;
+    if (begin != end && *begin == '+') {
+        ++begin;
+    }
+    std::from_chars(begin, end, retval);
+    return retval;
+}
+
+void parse_text_lines(const std::vector<const char *> & line_starts,
+                      const char * file_end,
+                      size_t first, size_t last,
+                      size_t dimension,
+                      TextRows & rows)
+{
+    const char separator = ' ';
+    RawVector components(dimension);
+    for (size_t i = first; i < last; ++i) {
+        const char * line = line_starts[i];
+        const char * line_end = std::find(line, file_end, '\n');
+        const char * pos = std::find(line, line_end, separator);
+        if (pos == line_end) {
+            rows.unseparated_line = i;
+            return;
+        }
+        std::string_view word(line, pos - line);
+        size_t found = 0;
+        const char * nextpos;
+        while (line_end != (nextpos = std::find(pos + 1, line_end, separator))) {
+            if (found < dimension) {
+                components[found] = parse_component(pos + 1, nextpos);
             }
-            if (w_it == word.rend()) {
-                // word reverse ended first
-                if (word.size() > best_suffix) {
-                    best_suffix = word.size();
-                    best_by_suffix = it;
-                }
-                continue;
-            } else if (t_it == it->word.rend()) {
-                if (it->word.size() > best_suffix) {
-                    best_suffix = it->word.size();
-                    best_by_suffix = it;
-                }
-                continue;
-            } else {
-                if (w_it - word.rbegin() > best_suffix) {
-                    best_suffix = (w_it - word.rbegin());
-                    best_by_suffix = it;
-                }
+            ++found;
+            pos = nextpos;
+        }
+        // there can be one more from pos to the newline if there isn't a
+        // separator at the end
+        if (*(line_end - 1) != separator) {
+            if (found < dimension) {
+                components[found] = parse_component(pos + 1, line_end);
             }
+            ++found;
+        }
+        if (found != dimension) {
+            rows.malformed_lines.push_back(i);
+            continue;
         }
+        rows.components.insert(rows.components.end(), components.begin(), components.end());
+        rows.words.append(word);
+        rows.word_ends.push_back(rows.words.size());
     }
+}
 
-    if (best_suffix > best_prefix) {
-        return *best_by_suffix;
-    } else if (best_prefix > 0) {
-        return *best_by_prefix;
-    } else {
+}
+
+void WordEmbeddings::load_text(const std::string & filename,
+                               const char * pos,
+                               const char * end,
+                               size_t lexicon_size)
+{
+    std::vector<const char *> line_starts;
+    line_starts.reserve(lexicon_size);
+    while (pos < end && line_starts.size() < lexicon_size) {
+        const char * newline = static_cast<const char *>(memchr(pos, '\n', end - pos));
+        if (newline == nullptr) {
+            newline = end;
+        }
+        if (newline != pos) {
+            line_starts.push_back(pos);
+        }
+        pos = newline + 1;
+    }
+    const size_t min_part_lines = 1024;
+    size_t parts = std::max(static_cast<size_t>(1),
+                            std::min(4 * pool->size(), line_starts.size() / min_part_lines));
+    std::vector<TextRows> parsed(parts);
+    pool->run(parts, [&](size_t part) {
+            parse_text_lines(line_starts, end,
+                             line_starts.size() * part / parts,
+                             line_starts.size() * (part + 1) / parts,
+                             dimension, parsed[part]);
+        });
+    matrix->reserve(line_starts.size() * row_stride);
+    inverse_norms.reserve(line_starts.size());
+    word_offsets.reserve(line_starts.size() + 1);
+    for (const auto & rows : parsed) {
+        // Lines are reported by their number counting only nonempty lines
+        // after the header
+        for (size_t line : rows.malformed_lines) {
+            std::cerr << "warning: vector file " << filename <<
+                " appears malformed\n  (reading line " << line + 2 << ")\n";
+        }
+        size_t word_begin = 0;
+        for (size_t i = 0; i < rows.word_ends.size(); ++i) {
+            push_row(rows.words.substr(word_begin, rows.word_ends[i] - word_begin),
+                     rows.components.data() + i * dimension);
+            word_begin = rows.word_ends[i];
+        }
+        if (rows.unseparated_line != std::string::npos) {
+            std::cerr << "warning: text vector file " << filename <<
+                " doesn't appear to be space-separated\n  (reading line " <<
+                rows.unseparated_line + 2 << ")\n";
+            break;
+        }
+    }
+}
+
+void WordEmbeddings::clear(void)
+{
+    dimension = 0;
+    row_stride = 0;
+    // A new matrix rather than emptying the old one, which arrays from
+    // vectors() may still be using
+    matrix = std::make_shared<AlignedVector>();
+    std::vector<WordVecFloat>().swap(inverse_norms);
+    std::string().swap(word_arena);
+    word_offsets.assign(1, 0);
+    index.reset();
+    quantized.reset();
+    full_precision_source.reset();
+    lookup.clear();
+    source_filename.clear();
+    source_offsets.clear();
+    source_float16 = false;
+    snapshot.reset();
+    cache->clear();
+    use_own_arrays();
+}
+
+void WordEmbeddings::use_own_arrays(void)
+{
+    row_count = inverse_norms.size();
+    matrix_data = matrix->empty() ? nullptr : matrix->data();
+    inverse_norm_data = inverse_norms.data();
+    word_arena_data = word_arena.data();
+    word_offset_data = word_offsets.data();
+}
+
+void WordEmbeddings::push_row(const std::string & word, const WordVecFloat * v)
+{
+    size_t row_start = matrix->size();
+    matrix->resize(row_start + row_stride, 0.0);
+    std::copy(v, v + dimension, matrix->begin() + row_start);
+    inverse_norms.push_back(inverse_norm(sqrt(dot_product(v, v, dimension))));
+    word_arena.append(word);
+    word_offsets.push_back(word_arena.size());
+    use_own_arrays();
+}
+
+WordEmbedding WordEmbeddings::get(const std::string & word) const
+{
+    PhaseTimer timer(phase_total(&Instrumentation::lookup_time));
+    bool by_suffix = false;
+    long row = lookup.find_best(*this, word, &by_suffix);
+    if (stats) {
+        ++stats->lookups;
+        if (row >= 0 && word_at(row) != word) {
+            ++(by_suffix ? stats->suffix_fallbacks : stats->prefix_fallbacks);
+        }
+    }
+    if (row < 0) {
         throw std::runtime_error("requested word " + word + " not present");
     }
+    return embedding_at(row);
 }
 
 WordEmbedding WordEmbeddings::get_exact(const std::string & word) const
 {
-    for (auto it = begin(); it != end(); ++it) {
-        if (word == it->word) {
-            return *it;
-        }
+    PhaseTimer timer(phase_total(&Instrumentation::lookup_time));
+    count(&Instrumentation::lookups, 1);
+    long row = lookup.find(*this, word);
+    if (row < 0) {
+        throw std::runtime_error("requested word " + word + " not present");
     }
-    throw std::runtime_error("requested word " + word + " not present");
+    return embedding_at(row);
 }
 
 WordWithVector WordEmbeddings::get_embedding(const std::string & word) const
@@ -251,375 +515,2355 @@ WordVecFloat WordEmbeddings::get_distance(const std::string& word1, const std::s
     return emb1.cosine_distance(emb2);
 }
 
-// Get the n best candidates in the original space using an insertion sort
-ScoredEmbeddings WordEmbeddings::get_top_n(const Vector & comparison_point,
-                                           size_t n) const
-{
-    ScoredEmbeddings retval;
-    retval.reserve(n + 1);
-    for (auto it = begin(); it != end(); ++it) {
-        WordVecFloat cosdist = it->cosine_distance(comparison_point);
-        for (size_t i = retval.size();; --i) {
-            if (i == 0) {
-                // We got to the top
-                ScoredEmbedding new_val = std::pair<WordEmbedding, WordVecFloat>(
-                    WordEmbedding(*it), cosdist);
-                retval.insert(retval.begin(), new_val);
-                break;
-            } else if (cosdist >= retval[i - 1].second) {
-                // This value is worse than the one ahead of us
-                if (i == n) {
-                    // We didn't make the list
-                } else {
-                    // We make this a new list member
-                    ScoredEmbedding new_val = std::pair<WordEmbedding, WordVecFloat>(
-                        WordEmbedding(*it), cosdist);
-                    retval.insert(retval.begin() + i, new_val);
-                }
-                break;
-            } else {
-                // We move up the list
-                continue;
-            }
-        }
-        if (retval.size() > n) {
-            retval.pop_back();
-        }
+ThreadPool::ThreadPool(size_t threads): stopping(false)
+{
+    for (size_t i = 1; i < threads; ++i) {
+        workers.push_back(std::thread(&ThreadPool::work, this));
     }
-    return retval;
 }
 
-ScoredEmbeddings WordEmbeddings::get_top_n(const WordEmbedding & comparison_point,
-                                           size_t n) const
+ThreadPool::~ThreadPool()
 {
-    return get_top_n(comparison_point.vector, n);
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        stopping = true;
+    }
+    available.notify_all();
+    for (auto & worker : workers) {
+        worker.join();
+    }
 }
 
-ScoredWords WordEmbeddings::get_words_at_distance_under(
-    const std::string & comparison_word,
-    WordVecFloat distance) const
+void ThreadPool::work(void)
 {
-    WordEmbedding comparison_point = get(comparison_word);
-    ScoredWords retval;
-    for (auto it = begin(); it != end(); ++it) {
-        if (comparison_word == it->word) {
-            continue;
-        }
-        WordVecFloat cosdist = it->cosine_distance(comparison_point);
-        if (cosdist <= distance) {
-            ScoredWord new_val(it->word, cosdist);
-            for (size_t i = 0;; ++i) {
-                if (i == retval.size()) {
-                    retval.push_back(new_val);
-                    break;
-                } else if (retval[i].second <= cosdist) {
-                    continue;
-                } else {
-                    retval.insert(retval.begin() + i, new_val);
-                    break;
-                }
+    while (true) {
+        std::function<void (void)> task;
+        {
+            std::unique_lock<std::mutex> lock(mutex);
+            available.wait(lock, [this] { return stopping || !tasks.empty(); });
+            if (tasks.empty()) {
+                return;
             }
+            task = std::move(tasks.front());
+            tasks.pop_front();
         }
+        task();
     }
-    return retval;
 }
 
-LikeUnlikeTransformer::LikeUnlikeTransformer(
-    const RawVector & first_point,
-    const RawVector & second_point,
-    bool is_negative,
-    WordVecFloat vector_similarity_projection_factor):
-    negative(is_negative),
-    projection_factor(vector_similarity_projection_factor)
-{
-
-    /*
-     * When there are two vectors A and B, we compute the vector A - B that
-     * goes from one to the other, and define a hyperplane orthogonal to that
-     * vector that intersects the vector at the midpoint between the
-     * two. We then add to all vectors a multiple of A - B to move them closer
-     * to the plane, reducing the distance that is due to the difference
-     * between A and B. (This is like projecting the space to the hyperplane
-     * if we go all the way to the plane)
-     *
-     * The hyperplane is defined by the equation |B - A| = d, where d is a
-     * translation term. |B - A| = 0 would be the set of vectors orthogonal to
-     * |B - A|. We set d so that the distance from the hyperplane to A is
-     * half of the norm of |B - A|.
-     *
-     */
+// The state of one call to ThreadPool::run, shared by the caller and the
+// workers helping it. A worker may only get to it after all the parts are
+// done and the caller has returned, so fun is only touched after claiming
+// a part.
+struct PoolJob {
+    const std::function<void (size_t)> * fun;
+    size_t parts;
+    std::atomic<size_t> next;
+    size_t finished;
+    std::exception_ptr error;
+    std::mutex mutex;
+    std::condition_variable done;
 
-    plane_vec = first_point - second_point;
-    plane_vec_square_sum = square_sum(plane_vec);
-    translation_term = dot_product(plane_vec, first_point)
-        - plane_vec_square_sum * 0.5;
+    PoolJob(const std::function<void (size_t)> & _fun, size_t _parts):
+        fun(&_fun), parts(_parts), next(0), finished(0) {}
 
-    if (is_negative == true) {
-        WordVecFloat comparison_scaler =
-            (translation_term - dot_product(first_point, plane_vec)) / plane_vec_square_sum;
-        comparison_scaler *= vector_similarity_projection_factor;
-        comparison_point_cache = first_point - scalar_multiplication(comparison_scaler, plane_vec);
-    } else {
-        comparison_point_cache = second_point + scalar_multiplication(static_cast<WordVecFloat>(0.5), plane_vec);
+    void work(void)
+    {
+        for (size_t part = next++; part < parts; part = next++) {
+            std::exception_ptr part_error;
+            try {
+                (*fun)(part);
+            } catch (...) {
+                part_error = std::current_exception();
+            }
+            std::lock_guard<std::mutex> lock(mutex);
+            if (part_error && !error) {
+                error = part_error;
+            }
+            if (++finished == parts) {
+                done.notify_all();
+            }
+        }
     }
-    plane_vec_square_sum = square_sum(plane_vec);
-    comparison_point_norm = norm(comparison_point_cache);
+};
 
-}
-
-Vector LikeUnlikeTransformer::operator() (const Vector & original)
+void ThreadPool::run(size_t parts, const std::function<void (size_t)> & fun)
 {
-    Vector transformed(original);
-    /*
-     * Given a plane "plane_vec = translation term" and a point,
-     * find the multiple of plane_vec which produces a vector going
-     * from point to the nearest point in the plane.
-     */
-    
-    WordVecFloat transformed_vec_scaler =
-        (translation_term - dot_product(transformed, plane_vec))
-        / plane_vec_square_sum;
-    transformed_vec_scaler *= projection_factor;
-    if(negative) {
-        transformed =
-            Vector(transformed - scalar_multiplication(transformed_vec_scaler, plane_vec));
-    } else {
-        transformed =
-            Vector(transformed + scalar_multiplication(transformed_vec_scaler, plane_vec));
+    if (parts == 0) {
+        return;
     }
-    return transformed;
-}
-
-// Get the n best candidates in the transformed space using an insertion sort
-ScoredEmbeddings WordEmbeddings::get_top_n_in_transformed_space(
-    size_t n,
-    const RawVector & _comparison_point,
-    const RawVector & plane_vec,
-    WordVecFloat translation_term,
-    bool negative,
-    WordVecFloat vector_similarity_projection_factor) const
-{
-    ScoredEmbeddings retval;
-    Vector comparison_point(_comparison_point);
-    WordVecFloat plane_vec_square_sum = square_sum(plane_vec);
-    for (WordEmbeddings::const_iterator it = this->begin();
-         it != this->end(); ++it) {
-        Vector transformed_vec(it->vector);
-
-        /*
-         * First, given a plane "plane_vec = translation term" and a point,
-         * find the multiple of plane_vec which produces a vector going
-         * from point to the nearest point in the plane.
-         */
-
-        WordVecFloat transformed_vec_scaler =
-            (translation_term - dot_product(transformed_vec, plane_vec))
-            / plane_vec_square_sum;
-        transformed_vec_scaler *= vector_similarity_projection_factor;
-        if(negative) {
-            transformed_vec =
-                Vector(transformed_vec - scalar_multiplication(transformed_vec_scaler, plane_vec));
-        } else {
-            transformed_vec =
-                Vector(transformed_vec + scalar_multiplication(transformed_vec_scaler, plane_vec));
-        }
-        WordVecFloat cosdist = comparison_point.cosine_distance(transformed_vec);
-        retval.reserve(n + 1);
-        for (size_t i = retval.size();; --i) {
-            if (i == 0) {
-                // We got to the top
-                ScoredEmbedding new_val = std::pair<WordEmbedding, WordVecFloat>(
-                    WordEmbedding(*it), cosdist);
-                retval.insert(retval.begin(), new_val);
-                break;
-            } else if (cosdist >= retval[i - 1].second) {
-                // This value is worse than the one ahead of us
-                if (i == n) {
-                    // We didn't make the list
-                } else {
-                    // We make this a new list member
-                    ScoredEmbedding new_val = std::pair<WordEmbedding, WordVecFloat>(
-                        WordEmbedding(*it), cosdist);
-                    retval.insert(retval.begin() + i, new_val);
-                }
-                break;
-            } else {
-                // We move up the list
-                continue;
+    std::shared_ptr<PoolJob> job = std::make_shared<PoolJob>(fun, parts);
+    size_t helpers = std::min(parts, size()) - 1;
+    if (helpers > 0) {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            for (size_t i = 0; i < helpers; ++i) {
+                tasks.push_back([job] { job->work(); });
             }
         }
-        if (retval.size() > n) {
-            retval.pop_back();
-        }
+        available.notify_all();
+    }
+    job->work();
+    std::unique_lock<std::mutex> lock(job->mutex);
+    job->done.wait(lock, [&job] { return job->finished == job->parts; });
+    if (job->error) {
+        std::rethrow_exception(job->error);
     }
-    return retval;
 }
 
-ScoredWords WordEmbeddings::get_top_n_words_in_transformed_space(
-    size_t n,
-    const RawVector & _comparison_point,
-    const RawVector & plane_vec,
-    WordVecFloat translation_term,
-    bool negative,
-    WordVecFloat vector_similarity_projection_factor) const
+void WordEmbeddings::set_threads(size_t threads)
 {
-    return get_top_n_in_transformed_space(
-        n, _comparison_point, plane_vec, translation_term, negative,
-        vector_similarity_projection_factor);
+    pool = std::make_shared<ThreadPool>(std::max(static_cast<size_t>(1), threads));
 }
 
-ScoredEmbeddings WordEmbeddings::get_top_n_in_transformed_space(
-    size_t n,
-    LikeUnlikeTransformerChain transformer) const
+// Enough parts to keep every thread busy even if some of them are slow to
+// start, but not so many that the overhead shows on small vocabularies
+size_t WordEmbeddings::row_parts(void) const
 {
-    ScoredEmbeddings retval;
-    Vector comparison_point(transformer.get_final_comparison_point());
-    for (WordEmbeddings::const_iterator it = this->begin();
-         it != this->end(); ++it) {
-        Vector transformed_vec = transformer(it->vector);
-        WordVecFloat cosdist = comparison_point.cosine_distance(transformed_vec);
-        retval.reserve(n + 1);
-        for (size_t i = retval.size();; --i) {
-            if (i == 0) {
-                // We got to the top
-                ScoredEmbedding new_val = std::pair<WordEmbedding, WordVecFloat>(
-                    WordEmbedding(*it), cosdist);
-                retval.insert(retval.begin(), new_val);
-                break;
-            } else if (cosdist >= retval[i - 1].second) {
-                // This value is worse than the one ahead of us
-                if (i == n) {
-                    // We didn't make the list
-                } else {
-                    // We make this a new list member
-                    ScoredEmbedding new_val = std::pair<WordEmbedding, WordVecFloat>(
-                        WordEmbedding(*it), cosdist);
-                    retval.insert(retval.begin() + i, new_val);
-                }
-                break;
-            } else {
-                // We move up the list
-                continue;
-            }
-        }
-        if (retval.size() > n) {
-            retval.pop_back();
-        }
-    }
-    return retval;
+    const size_t min_part_rows = 4096;
+    return std::max(static_cast<size_t>(1),
+                    std::min(4 * pool->size(), size() / min_part_rows));
 }
 
-ScoredWords WordEmbeddings::get_top_n_words_in_transformed_space(
-    size_t n,
-    LikeUnlikeTransformerChain transformer) const
+void WordEmbeddings::for_each_row_range(
+    size_t parts,
+    const std::function<void (size_t part, size_t begin, size_t end)> & fun) const
 {
-    return get_top_n_in_transformed_space(n, transformer);
+    pool->run(parts, [&](size_t part) {
+            fun(part, size() * part / parts, size() * (part + 1) / parts); });
 }
 
-ScoredWords WordEmbeddings::get_top_n_words(const Vector & comparison_point,
-                                            size_t n) const
+TopRows::TopRows(size_t _n): n(_n), inserted(0)
 {
-    ScoredWords retval;
-    retval.reserve(n);
-    ScoredEmbeddings embs = this->get_top_n(comparison_point, n);
-    for (auto it = embs.begin(); it != embs.end(); ++it) {
-        retval.push_back(ScoredWord((it->first).word, it->second));
-    }
-    return retval;
+    heap.reserve(n + 1);
 }
 
-ScoredWords WordEmbeddings::get_top_n_words(const WordEmbedding & comparison_point,
-                                            size_t n) const
+void TopRows::push(WordVecFloat score, uint32_t row)
 {
-    return get_top_n_words(comparison_point.vector, n);
+    if (heap.size() < n) {
+        heap.push_back(ScoredRow(score, row));
+        std::push_heap(heap.begin(), heap.end());
+        ++inserted;
+    } else if (n > 0 && ScoredRow(score, row) < heap.front()) {
+        std::pop_heap(heap.begin(), heap.end());
+        heap.back() = ScoredRow(score, row);
+        std::push_heap(heap.begin(), heap.end());
+        ++inserted;
+    }
 }
 
-ScoredWords WordEmbeddings::like(const std::string & word, unsigned int nwords) const
+void TopRows::merge(const TopRows & other)
+{
+    for (const auto & scored : other.heap) {
+        push(scored.first, scored.second);
+    }
+}
 
+ScoredRows TopRows::sorted(void) const
 {
-    return get_top_n_words(get(word), nwords);
+    ScoredRows retval(heap);
+    std::sort_heap(retval.begin(), retval.end());
+    return retval;
 }
 
-ScoredWords WordEmbeddings::like(const std::string & word1, const std::string & word2,
-                                 unsigned int nwords, bool is_negative,
-                                 WordVecFloat vector_similarity_projection_factor) const
+void Instrumentation::reset(void)
 {
-    WordEmbedding this_word1 = get(word1);
-    WordEmbedding this_word2 = get(word2);
-    LikeUnlikeTransformerChain chain;
-    LikeUnlikeTransformer transformer(this_word1.vector, this_word2.vector, is_negative, vector_similarity_projection_factor);
-    chain.push_back(transformer);
-    return get_top_n_words_in_transformed_space(nwords,
-                                                chain);
+    vectors_scanned = 0;
+    lookups = 0;
+    prefix_fallbacks = 0;
+    suffix_fallbacks = 0;
+    candidates_inserted = 0;
+    load_time = 0;
+    lookup_time = 0;
+    chain_time = 0;
+    scan_time = 0;
+    conversion_time = 0;
 }
 
-void LikeArgs::embed(const WordEmbeddings & embs)
+void WordEmbeddings::set_instrumentation(bool enabled)
+{
+    if (!enabled) {
+        stats.reset();
+    } else if (!stats) {
+        stats = std::make_shared<Instrumentation>();
+    }
+}
+
+std::map<std::string, unsigned long long> WordEmbeddings::get_instrumentation_counts(void) const
+{
+    std::map<std::string, unsigned long long> retval;
+    if (!stats) {
+        return retval;
+    }
+    retval["vectors_scanned"] = stats->vectors_scanned;
+    retval["lookups"] = stats->lookups;
+    retval["prefix_fallbacks"] = stats->prefix_fallbacks;
+    retval["suffix_fallbacks"] = stats->suffix_fallbacks;
+    retval["candidates_inserted"] = stats->candidates_inserted;
+    return retval;
+}
+
+std::map<std::string, double> WordEmbeddings::get_instrumentation_seconds(void) const
+{
+    std::map<std::string, double> retval;
+    if (!stats) {
+        return retval;
+    }
+    retval["load_seconds"] = stats->load_time * 1e-9;
+    retval["lookup_seconds"] = stats->lookup_time * 1e-9;
+    retval["chain_seconds"] = stats->chain_time * 1e-9;
+    retval["scan_seconds"] = stats->scan_time * 1e-9;
+    retval["conversion_seconds"] = stats->conversion_time * 1e-9;
+    return retval;
+}
+
+void ResultCache::set_capacity(size_t _capacity)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    capacity = _capacity;
+    while (entries.size() > capacity) {
+        positions.erase(entries.back().first);
+        entries.pop_back();
+    }
+}
+
+bool ResultCache::find(const std::string & key, ScoredWords & result)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    auto position = positions.find(key);
+    if (position == positions.end()) {
+        ++misses;
+        return false;
+    }
+    ++hits;
+    entries.splice(entries.begin(), entries, position->second);
+    result = position->second->second;
+    return true;
+}
+
+void ResultCache::insert(const std::string & key, const ScoredWords & result)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    if (capacity == 0 || positions.count(key) > 0) {
+        return;
+    }
+    entries.push_front(std::make_pair(key, result));
+    positions[key] = entries.begin();
+    if (entries.size() > capacity) {
+        positions.erase(entries.back().first);
+        entries.pop_back();
+    }
+}
+
+void ResultCache::clear(void)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    entries.clear();
+    positions.clear();
+}
+
+void ResultCache::reset_counters(void)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    hits = 0;
+    misses = 0;
+}
+
+size_t ResultCache::get_hits(void)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    return hits;
+}
+
+size_t ResultCache::get_misses(void)
+{
+    std::lock_guard<std::mutex> lock(mutex);
+    return misses;
+}
+
+ScoredRows WordEmbeddings::merge_top_rows(std::vector<TopRows> & tops) const
+{
+    if (stats) {
+        for (const auto & top : tops) {
+            stats->candidates_inserted += top.get_inserted();
+        }
+    }
+    for (size_t part = 1; part < tops.size(); ++part) {
+        tops[0].merge(tops[part]);
+    }
+    return tops[0].sorted();
+}
+
+// Get the n best candidates in the original space, each part of the
+// vocabulary keeping its own bounded heap
+ScoredRows WordEmbeddings::get_top_n(const Vector & comparison_point,
+                                     size_t n) const
+{
+    if (quantized) {
+        return get_top_n_quantized(comparison_point, n);
+    }
+    count(&Instrumentation::vectors_scanned, size());
+    WordVecFloat query_inverse_norm = inverse_norm(comparison_point.get_norm());
+    size_t parts = row_parts();
+    std::vector<TopRows> tops(parts, TopRows(n));
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            for (size_t row = begin; row < end; ++row) {
+                WordVecFloat cosdist = row_distance(row, comparison_point.data(), query_inverse_norm);
+                tops[part].push(cosdist, row);
+            }
+        });
+    return merge_top_rows(tops);
+}
+
+ScoredRows WordEmbeddings::get_top_n(const WordEmbedding & comparison_point,
+                                     size_t n) const
+{
+    return get_top_n(comparison_point.vector, n);
+}
+
+// The n best rows for each comparison point. Plain vectors are scored a
+// block of rows at a time against every point, otherwise each point is
+// searched for on its own.
+std::vector<ScoredRows> WordEmbeddings::get_top_n(
+    const std::vector<Vector> & comparison_points,
+    size_t n) const
+{
+    std::vector<ScoredRows> retval;
+    if (comparison_points.empty() || size() == 0 || row_stride == 0) {
+        return std::vector<ScoredRows>(comparison_points.size());
+    }
+    retval.reserve(comparison_points.size());
+    if (quantized || (index && use_index)) {
+        for (const auto & comparison_point : comparison_points) {
+            if (index && use_index) {
+                retval.push_back(index->search(*this, comparison_point, n));
+            } else {
+                retval.push_back(get_top_n(comparison_point, n));
+            }
+        }
+        return retval;
+    }
+    count(&Instrumentation::vectors_scanned, size() * comparison_points.size());
+    std::vector<WordVecFloat> query_inverse_norms;
+    for (const auto & comparison_point : comparison_points) {
+        query_inverse_norms.push_back(inverse_norm(comparison_point.get_norm()));
+    }
+    const size_t block_bytes = 1 << 17;
+    size_t block_rows = std::max(static_cast<size_t>(1),
+                                 block_bytes / (row_stride * sizeof(WordVecFloat)));
+    size_t parts = row_parts();
+    std::vector<std::vector<TopRows> > tops(
+        comparison_points.size(), std::vector<TopRows>(parts, TopRows(n)));
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            for (size_t block = begin; block < end; block += block_rows) {
+                size_t block_end = std::min(end, block + block_rows);
+                for (size_t i = 0; i < comparison_points.size(); ++i) {
+                    for (size_t row = block; row < block_end; ++row) {
+                        WordVecFloat cosdist = row_distance(
+                            row, comparison_points[i].data(), query_inverse_norms[i]);
+                        tops[i][part].push(cosdist, row);
+                    }
+                }
+            }
+        });
+    for (auto & point_tops : tops) {
+        retval.push_back(merge_top_rows(point_tops));
+    }
+    return retval;
+}
+
+void WordEmbeddings::nearest_rows(const WordVecFloat * queries,
+                                  size_t count,
+                                  size_t query_dimension,
+                                  int64_t * rows,
+                                  size_t rows_size,
+                                  WordVecFloat * scores,
+                                  size_t scores_size) const
+{
+    if (count == 0) {
+        return;
+    }
+    if (query_dimension != dimension) {
+        throw std::runtime_error("query vectors have dimension " + std::to_string(query_dimension) +
+                                 ", embeddings have " + std::to_string(dimension));
+    }
+    if (rows_size != scores_size || rows_size % count != 0) {
+        throw std::runtime_error("rows and scores must have room for the same number of results per query");
+    }
+    size_t n = rows_size / count;
+    std::vector<Vector> comparison_points;
+    comparison_points.reserve(count);
+    for (size_t i = 0; i < count; ++i) {
+        const WordVecFloat * query = queries + i * dimension;
+        comparison_points.push_back(Vector(RawVector(query, query + dimension)));
+    }
+    std::vector<ScoredRows> found;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        found = get_top_n(comparison_points, n);
+    }
+    for (size_t i = 0; i < count; ++i) {
+        for (size_t j = 0; j < n; ++j) {
+            // Fewer rows than asked for are padded with -1 at distance 2
+            bool present = j < found[i].size();
+            rows[i * n + j] = present ? static_cast<int64_t>(found[i][j].second) : -1;
+            scores[i * n + j] = present ? found[i][j].first : 2.0;
+        }
+    }
+}
+
+// Dot products of four rows stride floats apart with another row, loading
+// each component of the other row once for all four
+static inline void dot_products4(const WordVecFloat * rows,
+                                 size_t stride,
+                                 const WordVecFloat * other,
+                                 size_t n,
+                                 WordVecFloat * dots)
+{
+    WordVecFloat dot0 = 0, dot1 = 0, dot2 = 0, dot3 = 0;
+    for (size_t i = 0; i < n; ++i) {
+        dot0 += rows[i] * other[i];
+        dot1 += rows[stride + i] * other[i];
+        dot2 += rows[2 * stride + i] * other[i];
+        dot3 += rows[3 * stride + i] * other[i];
+    }
+    dots[0] = dot0;
+    dots[1] = dot1;
+    dots[2] = dot2;
+    dots[3] = dot3;
+}
+
+// The same with two other rows one after the other, which keeps the
+// eight sums in registers and loads each component once for both
+static inline void dot_products4x2(const WordVecFloat * rows,
+                                   const WordVecFloat * others,
+                                   size_t stride,
+                                   size_t n,
+                                   WordVecFloat * dots)
+{
+    WordVecFloat dot0 = 0, dot1 = 0, dot2 = 0, dot3 = 0;
+    WordVecFloat dot4 = 0, dot5 = 0, dot6 = 0, dot7 = 0;
+    for (size_t i = 0; i < n; ++i) {
+        WordVecFloat other0 = others[i];
+        WordVecFloat other1 = others[stride + i];
+        dot0 += rows[i] * other0;
+        dot1 += rows[stride + i] * other0;
+        dot2 += rows[2 * stride + i] * other0;
+        dot3 += rows[3 * stride + i] * other0;
+        dot4 += rows[i] * other1;
+        dot5 += rows[stride + i] * other1;
+        dot6 += rows[2 * stride + i] * other1;
+        dot7 += rows[3 * stride + i] * other1;
+    }
+    dots[0] = dot0;
+    dots[1] = dot1;
+    dots[2] = dot2;
+    dots[3] = dot3;
+    dots[4] = dot4;
+    dots[5] = dot5;
+    dots[6] = dot6;
+    dots[7] = dot7;
+}
+
+// Every block of node rows is multiplied with every block of candidate
+// rows while both are in cache, each part of the pool keeping the heaps of
+// its own node rows
+size_t WordEmbeddings::knn_graph(size_t top_n,
+                                 size_t k,
+                                 WordVecFloat max_distance,
+                                 int64_t * indptr,
+                                 size_t indptr_size,
+                                 int64_t * indices,
+                                 size_t indices_size,
+                                 WordVecFloat * distances,
+                                 size_t distances_size) const
+{
+    size_t nodes = top_n == 0 ? size() : std::min(top_n, size());
+    if (indptr_size < nodes + 1 || indices_size < nodes * k || distances_size < nodes * k) {
+        throw std::runtime_error("knn_graph needs room for " + std::to_string(nodes + 1) +
+                                 " row pointers and " + std::to_string(nodes * k) + " edges");
+    }
+    if (k == 0 || nodes == 0 || row_stride == 0) {
+        std::fill(indptr, indptr + nodes + 1, 0);
+        return 0;
+    }
+    PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+    count(&Instrumentation::vectors_scanned, nodes * nodes);
+    const WordVecFloat * data = matrix_data;
+    size_t stride = row_stride;
+    // Vectors released by quantize() are read back for the rows of the graph
+    RawVector released_rows;
+    if (full_precision_released()) {
+        released_rows.resize(nodes * dimension);
+        for (size_t row = 0; row < nodes; ++row) {
+            read_source_row(row, released_rows.data() + row * dimension);
+        }
+        data = released_rows.data();
+        stride = dimension;
+    }
+    const size_t node_block_rows = 64;
+    const size_t block_bytes = 1 << 17;
+    size_t block_rows = std::max(static_cast<size_t>(1),
+                                 block_bytes / (stride * sizeof(WordVecFloat)));
+    std::vector<size_t> degrees(nodes, 0);
+    pool->run((nodes + node_block_rows - 1) / node_block_rows, [&](size_t part) {
+            size_t node_begin = part * node_block_rows;
+            size_t node_end = std::min(nodes, node_begin + node_block_rows);
+            std::vector<TopRows> tops(node_end - node_begin, TopRows(k));
+            // The highest distance that still gets a row in. Rows come in
+            // order, so once a heap is full a row has to be strictly closer
+            // than the worst one kept.
+            std::vector<WordVecFloat> bounds(node_end - node_begin, max_distance);
+            auto push = [&](size_t node, size_t row, WordVecFloat dot) {
+                WordVecFloat cosdist = cosine_distance_from_dot(
+                    dot, inverse_norm_data[node], inverse_norm_data[row]);
+                size_t i = node - node_begin;
+                if (cosdist <= bounds[i] && node != row) {
+                    tops[i].push(cosdist, row);
+                    if (tops[i].full()) {
+                        bounds[i] = std::min(max_distance, std::nextafter(
+                                                 tops[i].worst(), static_cast<WordVecFloat>(-1.0)));
+                    }
+                }
+            };
+            for (size_t block = 0; block < nodes; block += block_rows) {
+                size_t block_end = std::min(nodes, block + block_rows);
+                size_t node = node_begin;
+                for (; node + 4 <= node_end; node += 4) {
+                    size_t row = block;
+                    for (; row + 2 <= block_end; row += 2) {
+                        WordVecFloat dots[8];
+                        dot_products4x2(data + node * stride, data + row * stride,
+                                        stride, dimension, dots);
+                        for (size_t i = 0; i < 4; ++i) {
+                            push(node + i, row, dots[i]);
+                            push(node + i, row + 1, dots[4 + i]);
+                        }
+                    }
+                    if (row < block_end) {
+                        WordVecFloat dots[4];
+                        dot_products4(data + node * stride, stride,
+                                      data + row * stride, dimension, dots);
+                        for (size_t i = 0; i < 4; ++i) {
+                            push(node + i, row, dots[i]);
+                        }
+                    }
+                }
+                for (; node < node_end; ++node) {
+                    for (size_t row = block; row < block_end; ++row) {
+                        push(node, row, dot_product(data + node * stride,
+                                                    data + row * stride, dimension));
+                    }
+                }
+            }
+            // Each node row first writes its edges at node * k
+            for (size_t node = node_begin; node < node_end; ++node) {
+                count(&Instrumentation::candidates_inserted,
+                      tops[node - node_begin].get_inserted());
+                ScoredRows neighbours = tops[node - node_begin].sorted();
+                degrees[node] = neighbours.size();
+                for (size_t i = 0; i < neighbours.size(); ++i) {
+                    indices[node * k + i] = neighbours[i].second;
+                    distances[node * k + i] = neighbours[i].first;
+                }
+            }
+        });
+    // and the edges are then moved down to close the gaps
+    size_t edges = 0;
+    for (size_t node = 0; node < nodes; ++node) {
+        indptr[node] = edges;
+        if (edges < node * k) {
+            std::copy(indices + node * k, indices + node * k + degrees[node], indices + edges);
+            std::copy(distances + node * k, distances + node * k + degrees[node], distances + edges);
+        }
+        edges += degrees[node];
+    }
+    indptr[nodes] = edges;
+    return edges;
+}
+
+long WordEmbeddings::get_row(const std::string & word) const
+{
+    PhaseTimer timer(phase_total(&Instrumentation::lookup_time));
+    count(&Instrumentation::lookups, 1);
+    return lookup.find(*this, word);
+}
+
+// Keep hit lists from growing past twice the cap while scanning, so that
+// trimming them costs linear time overall
+static void trim_hits(ScoredRows & hits, size_t max_hits)
+{
+    if (max_hits > 0 && hits.size() >= 2 * max_hits) {
+        std::nth_element(hits.begin(), hits.begin() + max_hits, hits.end());
+        hits.resize(max_hits);
+    }
+}
+
+// All the hits of the parts of a scan sorted once by distance, ties in row
+// order, and cut to max_hits if it is not 0
+static ScoredRows merge_hits(std::vector<ScoredRows> & hits, size_t max_hits)
+{
+    ScoredRows retval;
+    for (auto & part_hits : hits) {
+        trim_hits(part_hits, max_hits);
+        retval.insert(retval.end(), part_hits.begin(), part_hits.end());
+    }
+    std::sort(retval.begin(), retval.end());
+    if (max_hits > 0 && retval.size() > max_hits) {
+        retval.resize(max_hits);
+    }
+    return retval;
+}
+
+ScoredRows WordEmbeddings::get_rows_at_distance_under(
+    const std::string & comparison_word,
+    const Vector & comparison_point,
+    WordVecFloat distance,
+    size_t max_hits) const
+{
+    if (index && use_index) {
+        std::vector<ScoredRows> hits(1);
+        for (const auto & hit : index->search_radius(*this, comparison_point, distance)) {
+            if (comparison_word != word_at(hit.second)) {
+                hits[0].push_back(hit);
+            }
+        }
+        return merge_hits(hits, max_hits);
+    }
+    count(&Instrumentation::vectors_scanned, size());
+    size_t parts = row_parts();
+    std::vector<ScoredRows> hits(parts);
+    if (quantized) {
+        // Only rows whose distance could be under the limit by the error
+        // bound need to be checked in full precision
+        WordVecFloat query_norm = comparison_point.get_norm();
+        RawVector unit_query = scalar_multiplication(
+            query_norm == 0.0 ? 0.0 : 1.0 / query_norm, comparison_point);
+        for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+                for (size_t row = begin; row < end; ++row) {
+                    if (comparison_word == word_at(row) ||
+                        (query_norm != 0.0 &&
+                         quantized->distance(row, unit_query) - quantized->error_bound(row) > distance)) {
+                        continue;
+                    }
+                    WordVecFloat cosdist = row_distance(row, comparison_point);
+                    if (cosdist <= distance) {
+                        hits[part].push_back(ScoredRow(cosdist, row));
+                        trim_hits(hits[part], max_hits);
+                    }
+                }
+            });
+        return merge_hits(hits, max_hits);
+    }
+    WordVecFloat query_inverse_norm = inverse_norm(comparison_point.get_norm());
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            for (size_t row = begin; row < end; ++row) {
+                if (comparison_word == word_at(row)) {
+                    continue;
+                }
+                WordVecFloat cosdist = row_distance(row, comparison_point.data(), query_inverse_norm);
+                if (cosdist <= distance) {
+                    hits[part].push_back(ScoredRow(cosdist, row));
+                    trim_hits(hits[part], max_hits);
+                }
+            }
+        });
+    return merge_hits(hits, max_hits);
+}
+
+ScoredWords WordEmbeddings::get_words_at_distance_under(
+    const std::string & comparison_word,
+    WordVecFloat distance,
+    size_t max_hits) const
+{
+    Vector comparison_point = get(comparison_word).vector;
+    ScoredRows rows;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        rows = get_rows_at_distance_under(comparison_word, comparison_point, distance, max_hits);
+    }
+    return scored_words(rows);
+}
+
+std::vector<ScoredWordVector> WordEmbeddings::get_words_at_distance_under_many(
+    const StringVector & comparison_words,
+    WordVecFloat distance,
+    size_t max_hits) const
+{
+    std::vector<Vector> comparison_points;
+    comparison_points.reserve(comparison_words.size());
+    for (const auto & word : comparison_words) {
+        comparison_points.push_back(get(word).vector);
+    }
+    std::vector<ScoredRows> found;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        found = get_rows_at_distance_under_many(comparison_words, comparison_points,
+                                                distance, max_hits);
+    }
+    std::vector<ScoredWordVector> retval;
+    retval.reserve(found.size());
+    for (const auto & rows : found) {
+        retval.push_back(scored_words(rows));
+    }
+    return retval;
+}
+
+std::vector<ScoredRows> WordEmbeddings::get_rows_at_distance_under_many(
+    const StringVector & comparison_words,
+    const std::vector<Vector> & comparison_points,
+    WordVecFloat distance,
+    size_t max_hits) const
+{
+    std::vector<ScoredRows> retval;
+    if (comparison_words.empty() || size() == 0 || row_stride == 0) {
+        return std::vector<ScoredRows>(comparison_words.size());
+    }
+    retval.reserve(comparison_words.size());
+    if ((index && use_index) || quantized) {
+        for (size_t i = 0; i < comparison_words.size(); ++i) {
+            retval.push_back(get_rows_at_distance_under(
+                                 comparison_words[i], comparison_points[i],
+                                 distance, max_hits));
+        }
+        return retval;
+    }
+    count(&Instrumentation::vectors_scanned, size() * comparison_words.size());
+    std::vector<WordVecFloat> query_inverse_norms;
+    for (const auto & comparison_point : comparison_points) {
+        query_inverse_norms.push_back(inverse_norm(comparison_point.get_norm()));
+    }
+    // Every comparison point is scored against a block of rows while the
+    // block is in cache
+    const size_t block_bytes = 1 << 17;
+    size_t block_rows = std::max(static_cast<size_t>(1),
+                                 block_bytes / (row_stride * sizeof(WordVecFloat)));
+    size_t parts = row_parts();
+    std::vector<std::vector<ScoredRows> > hits(
+        comparison_words.size(), std::vector<ScoredRows>(parts));
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            for (size_t block = begin; block < end; block += block_rows) {
+                size_t block_end = std::min(end, block + block_rows);
+                for (size_t i = 0; i < comparison_words.size(); ++i) {
+                    for (size_t row = block; row < block_end; ++row) {
+                        WordVecFloat cosdist = row_distance(
+                            row, comparison_points[i].data(), query_inverse_norms[i]);
+                        if (cosdist <= distance && comparison_words[i] != word_at(row)) {
+                            hits[i][part].push_back(ScoredRow(cosdist, row));
+                            trim_hits(hits[i][part], max_hits);
+                        }
+                    }
+                }
+            }
+        });
+    for (auto & word_hits : hits) {
+        retval.push_back(merge_hits(word_hits, max_hits));
+    }
+    return retval;
+}
+
+LikeUnlikeTransformer::LikeUnlikeTransformer(
+    const RawVector & first_point,
+    const RawVector & second_point,
+    bool is_negative,
+    WordVecFloat vector_similarity_projection_factor):
+    negative(is_negative),
+    projection_factor(vector_similarity_projection_factor)
+{
+
+    /*
+     * When there are two vectors A and B, we compute the vector A - B that
+     * goes from one to the other, and define a hyperplane orthogonal to that
+     * vector that intersects the vector at the midpoint between the
+     * two. We then add to all vectors a multiple of A - B to move them closer
+     * to the plane, reducing the distance that is due to the difference
+     * between A and B. (This is like projecting the space to the hyperplane
+     * if we go all the way to the plane)
+     *
+     * The hyperplane is defined by the equation |B - A| = d, where d is a
+     * translation term. |B - A| = 0 would be the set of vectors orthogonal to
+     * |B - A|. We set d so that the distance from the hyperplane to A is
+     * half of the norm of |B - A|.
+     *
+     */
+
+    plane_vec = first_point - second_point;
+    plane_vec_square_sum = square_sum(plane_vec);
+    translation_term = dot_product(plane_vec, first_point)
+        - plane_vec_square_sum * 0.5;
+
+    if (is_negative == true) {
+        WordVecFloat comparison_scaler =
+            (translation_term - dot_product(first_point, plane_vec)) / plane_vec_square_sum;
+        comparison_scaler *= vector_similarity_projection_factor;
+        comparison_point_cache = first_point - scalar_multiplication(comparison_scaler, plane_vec);
+    } else {
+        comparison_point_cache = second_point + scalar_multiplication(static_cast<WordVecFloat>(0.5), plane_vec);
+    }
+    plane_vec_square_sum = square_sum(plane_vec);
+    comparison_point_norm = norm(comparison_point_cache);
+
+}
+
+Vector LikeUnlikeTransformer::operator() (const Vector & original)
+{
+    Vector transformed(original);
+    /*
+     * Given a plane "plane_vec = translation term" and a point,
+     * find the multiple of plane_vec which produces a vector going
+     * from point to the nearest point in the plane.
+     */
+    
+    WordVecFloat transformed_vec_scaler =
+        (translation_term - dot_product(transformed, plane_vec))
+        / plane_vec_square_sum;
+    transformed_vec_scaler *= projection_factor;
+    if(negative) {
+        transformed =
+            Vector(transformed - scalar_multiplication(transformed_vec_scaler, plane_vec));
+    } else {
+        transformed =
+            Vector(transformed + scalar_multiplication(transformed_vec_scaler, plane_vec));
+    }
+    return transformed;
+}
+
+ChainScorer::ChainScorer(const RawVector & _comparison_point):
+    dimension(_comparison_point.size()),
+    comparison_point(_comparison_point),
+    comparison_point_norm(sqrt(exact_dot_product(_comparison_point.data(),
+                                                 _comparison_point.data(),
+                                                 _comparison_point.size()))),
+    gain(1.0) {}
+
+ChainScorer::ChainScorer(LikeUnlikeTransformerChain & chain):
+    ChainScorer(chain.get_final_comparison_point())
+{
+    for (const auto & transformer : chain) {
+        add_step(transformer.get_plane_vec(), transformer.get_translation_term(),
+                 transformer.get_step_scale());
+    }
+}
+
+void ChainScorer::add_step(const RawVector & plane_vec,
+                           WordVecFloat translation_term,
+                           WordVecFloat step_scale)
+{
+    planes.insert(planes.end(), plane_vec.begin(), plane_vec.end());
+    translation_terms.push_back(translation_term);
+    step_scales.push_back(step_scale);
+    plane_comparison_dots.push_back(dot_product(plane_vec, comparison_point));
+    std::vector<double> dots;
+    for (size_t j = 0; j < steps(); ++j) {
+        dots.push_back(dot_product(&(planes[j * dimension]), plane_vec.data(), dimension));
+    }
+    plane_dots.push_back(dots);
+    // A step is x -> x - step_scale * (x . p) p + a constant, which stretches
+    // x along p by 1 - step_scale * |p|^2 and leaves the rest alone
+    gain *= std::max(1.0, fabs(1.0 - step_scale * dots.back()));
+}
+
+void ChainScorer::transform(const WordVecFloat * x, double * multiples,
+                            double & square, double & comparison_dot) const
+{
+    comparison_dot = exact_dot_product(x, comparison_point.data(), dimension);
+    square = exact_dot_product(x, x, dimension);
+    for (size_t k = 0; k < steps(); ++k) {
+        // The dot product of the plane vector with x as transformed by the
+        // steps before this one
+        double plane_dot = exact_dot_product(x, &(planes[k * dimension]), dimension);
+        for (size_t j = 0; j < k; ++j) {
+            plane_dot += multiples[j] * plane_dots[k][j];
+        }
+        double multiple = step_scales[k] * (translation_terms[k] - plane_dot);
+        multiples[k] = multiple;
+        // |x + m p|^2 = |x|^2 + 2 m x . p + m^2 |p|^2
+        square += 2 * multiple * plane_dot + multiple * multiple * plane_dots[k][k];
+        comparison_dot += multiple * plane_comparison_dots[k];
+    }
+}
+
+WordVecFloat ChainScorer::distance_of(double square, double comparison_dot) const
+{
+    if (square <= 0.0 || comparison_point_norm == 0.0) {
+        return 0.0;
+    }
+    // The cosine is rounded to single precision first, as in
+    // Vector::cosine_distance, so that vectors transformed onto the
+    // comparison point come out at distance 0.0
+    WordVecFloat cosine = comparison_dot / (sqrt(square) * comparison_point_norm);
+    return std::max(static_cast<WordVecFloat>(0.0), 1 - cosine);
+}
+
+WordVecFloat ChainScorer::distance(const WordVecFloat * x,
+                                   double * multiples) const
+{
+    double square, comparison_dot;
+    transform(x, multiples, square, comparison_dot);
+    return distance_of(square, comparison_dot);
+}
+
+WordVecFloat ChainScorer::distance(const WordVecFloat * x,
+                                   double * multiples,
+                                   double error,
+                                   WordVecFloat & bound) const
+{
+    double square, comparison_dot;
+    transform(x, multiples, square, comparison_dot);
+    // After the steps the other vector is within moved of this one, and
+    // for any u and v, |u / |u| - v / |v|| <= 2 |u - v| / (|u| + |v|), which
+    // bounds the difference of their cosines with the comparison point
+    double moved = gain * error;
+    double length = square > 0.0 ? sqrt(square) : 0.0;
+    bound = moved < length ? 2 * moved / (2 * length - moved) : 2.0;
+    return distance_of(square, comparison_dot);
+}
+
+// Get the n best candidates in the transformed space, each part of the
+// vocabulary keeping its own bounded heap
+ScoredRows WordEmbeddings::get_top_n_in_transformed_space(
+    size_t n,
+    const RawVector & _comparison_point,
+    const RawVector & plane_vec,
+    WordVecFloat translation_term,
+    bool negative,
+    WordVecFloat vector_similarity_projection_factor) const
+{
+    ChainScorer scorer(_comparison_point);
+    WordVecFloat step_scale = vector_similarity_projection_factor / square_sum(plane_vec);
+    scorer.add_step(plane_vec, translation_term, negative ? -step_scale : step_scale);
+    return get_top_n_in_transformed_space(n, scorer);
+}
+
+ScoredRows WordEmbeddings::get_top_n_in_transformed_space(
+    size_t n,
+    const ChainScorer & scorer) const
+{
+    return get_top_n_in_transformed_space(n, std::vector<ChainScorer>(1, scorer))[0];
+}
+
+/*
+ * The n best candidates for each scorer in one pass over the vectors. The
+ * rows are taken a block at a time, and each block is scored for all the
+ * scorers while it's in cache.
+ */
+std::vector<ScoredRows> WordEmbeddings::get_top_n_in_transformed_space(
+    size_t n,
+    const std::vector<ChainScorer> & scorers) const
+{
+    std::vector<ScoredRows> retval;
+    if (scorers.empty() || size() == 0 || row_stride == 0) {
+        return std::vector<ScoredRows>(scorers.size());
+    }
+    if (quantized) {
+        for (const auto & scorer : scorers) {
+            retval.push_back(get_top_n_in_transformed_space_quantized(n, scorer));
+        }
+        return retval;
+    }
+    count(&Instrumentation::vectors_scanned, size() * scorers.size());
+    const size_t block_bytes = 1 << 17;
+    size_t block_rows = std::max(static_cast<size_t>(1),
+                                 block_bytes / (row_stride * sizeof(WordVecFloat)));
+    size_t max_steps = 0;
+    for (const auto & scorer : scorers) {
+        max_steps = std::max(max_steps, scorer.steps());
+    }
+    size_t parts = row_parts();
+    std::vector<std::vector<TopRows> > tops(
+        scorers.size(), std::vector<TopRows>(parts, TopRows(n)));
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            std::vector<double> multiples(max_steps);
+            for (size_t block = begin; block < end; block += block_rows) {
+                size_t block_end = std::min(end, block + block_rows);
+                for (size_t i = 0; i < scorers.size(); ++i) {
+                    for (size_t row = block; row < block_end; ++row) {
+                        WordVecFloat cosdist = scorers[i].distance(row_data(row), multiples.data());
+                        tops[i][part].push(cosdist, row);
+                    }
+                }
+            }
+        });
+    for (auto & scorer_tops : tops) {
+        retval.push_back(merge_top_rows(scorer_tops));
+    }
+    return retval;
+}
+
+ScoredWords WordEmbeddings::get_top_n_words_in_transformed_space(
+    size_t n,
+    const RawVector & _comparison_point,
+    const RawVector & plane_vec,
+    WordVecFloat translation_term,
+    bool negative,
+    WordVecFloat vector_similarity_projection_factor) const
+{
+    ScoredRows rows;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        rows = get_top_n_in_transformed_space(
+            n, _comparison_point, plane_vec, translation_term, negative,
+            vector_similarity_projection_factor);
+    }
+    return scored_words(rows);
+}
+
+ScoredRows WordEmbeddings::get_top_n_in_transformed_space(
+    size_t n,
+    LikeUnlikeTransformerChain transformer) const
+{
+    return get_top_n_in_transformed_space(n, ChainScorer(transformer));
+}
+
+ScoredWords WordEmbeddings::get_top_n_words_in_transformed_space(
+    size_t n,
+    LikeUnlikeTransformerChain transformer) const
+{
+    ChainScorer scorer = [&] {
+        PhaseTimer timer(phase_total(&Instrumentation::chain_time));
+        return ChainScorer(transformer);
+    }();
+    ScoredRows rows;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        rows = get_top_n_in_transformed_space(n, scorer);
+    }
+    return scored_words(rows);
+}
+
+ScoredWords WordEmbeddings::get_top_n_words(const Vector & comparison_point,
+                                            size_t n) const
+{
+    ScoredRows rows;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        if (index && use_index) {
+            rows = index->search(*this, comparison_point, n);
+        } else {
+            rows = get_top_n(comparison_point, n);
+        }
+    }
+    return scored_words(rows);
+}
+
+ScoredWords WordEmbeddings::get_top_n_words(const WordEmbedding & comparison_point,
+                                            size_t n) const
+{
+    return get_top_n_words(comparison_point.vector, n);
+}
+
+/*
+ * Cache keys of queries. Words are written with their lengths so that no
+ * two lists of words give the same key, and each Like() or Unlike() step
+ * as its arguments followed by its sign and the bits of its projection
+ * factor. Like(word1, word2) has the same key however it was asked for.
+ */
+static void append_word_key(std::string & key, const std::string & word)
+{
+    key += std::to_string(word.size());
+    key += ':';
+    key += word;
+}
+
+static void append_step_key(std::string & key, bool negative,
+                            WordVecFloat projection_factor)
+{
+    uint32_t bits;
+    memcpy(&bits, &projection_factor, sizeof(bits));
+    key += negative ? '-' : '+';
+    key += std::to_string(bits);
+    key += ')';
+}
+
+static void append_args_key(std::string & key, const LikeArgs & args)
+{
+    if (!args.left && !args.right) {
+        append_word_key(key, args.embedding.word);
+        return;
+    }
+    key += '(';
+    for (const auto & child : {args.left, args.right}) {
+        if (child) {
+            append_args_key(key, *child);
+        } else {
+            key += '_';
+        }
+    }
+    append_step_key(key, args.negative, args.projection_factor);
+}
+
+ScoredWords WordEmbeddings::cached_query(
+    const std::string & key,
+    unsigned int nwords,
+    const std::function<ScoredWords (void)> & query) const
+{
+    if (!cache->enabled()) {
+        return query();
+    }
+    std::string sized_key = std::to_string(nwords) + ' ' + key;
+    ScoredWords retval;
+    if (!cache->find(sized_key, retval)) {
+        retval = query();
+        cache->insert(sized_key, retval);
+    }
+    return retval;
+}
+
+ScoredWords WordEmbeddings::like(const std::string & word, unsigned int nwords) const
+
+{
+    // Marked apart from a single word given as LikeArgs, which is an error
+    std::string key = "=";
+    append_word_key(key, word);
+    return cached_query(key, nwords, [&] { return get_top_n_words(get(word), nwords); });
+}
+
+ScoredWords WordEmbeddings::like(const std::string & word1, const std::string & word2,
+                                 unsigned int nwords, bool is_negative,
+                                 WordVecFloat vector_similarity_projection_factor) const
+{
+    std::string key = "(";
+    append_word_key(key, word1);
+    append_word_key(key, word2);
+    append_step_key(key, is_negative, vector_similarity_projection_factor);
+    return cached_query(key, nwords, [&] {
+            WordEmbedding this_word1 = get(word1);
+            WordEmbedding this_word2 = get(word2);
+            LikeUnlikeTransformerChain chain;
+            {
+                PhaseTimer timer(phase_total(&Instrumentation::chain_time));
+                LikeUnlikeTransformer transformer(this_word1.vector, this_word2.vector, is_negative, vector_similarity_projection_factor);
+                chain.push_back(transformer);
+            }
+            return get_top_n_words_in_transformed_space(nwords,
+                                                        chain);
+        });
+}
+
+void LikeArgs::embed(const WordEmbeddings & embs)
 {
     if (left) { left->embed(embs); }
     if (right) { right->embed(embs); }
-    if (embedding.word.size() > 0) {
+    if (is_leaf() || embedding.word.size() > 0) {
         embedding = embs.get(embedding.word);
     }
 }
 
-LikeUnlikeTransformerChain LikeArgs::get_transformer_chain(void)
+LikeUnlikeTransformerChain LikeArgs::get_transformer_chain(void)
+{
+    LikeUnlikeTransformerChain retval;
+    if (!left || !right) {
+        throw std::runtime_error("like needs two arguments to compare");
+    }
+    if (left->is_leaf() && right->is_leaf()) {
+        retval.push_back(LikeUnlikeTransformer(left->embedding.vector,
+                                               right->embedding.vector,
+                                               negative,
+                                               projection_factor));
+        return retval;
+    } else if (right->is_leaf()) {
+        LikeUnlikeTransformerChain l = left->get_transformer_chain();
+        retval.insert(retval.end(), l.begin(), l.end());
+        LikeUnlikeTransformer root(retval.get_final_comparison_point(),
+                                   right->embedding.vector,
+                                   negative,
+                                   projection_factor);
+        retval.push_back(root);
+        return retval;
+    }
+    LikeUnlikeTransformerChain l = left->get_transformer_chain();
+    retval.insert(retval.end(), l.begin(), l.end());
+    LikeUnlikeTransformerChain r = right->get_transformer_chain();
+    retval.insert(retval.end(), r.begin(), r.end());
+    return retval;
+}
+
+ScoredWords WordEmbeddings::like(LikeArgs args,
+                                 unsigned int nwords) const
+{
+//    auto embedder = std::bind(&WordEmbeddings::get, *this);
+//    std::function<WordEmbedding (const std::string & word)> embedder_fobj(embedder);
+    std::string key;
+    append_args_key(key, args);
+    return cached_query(key, nwords, [&] {
+            args.embed(*this);
+            // turn strings into Vectors
+            LikeUnlikeTransformerChain transformer;
+            {
+                PhaseTimer timer(phase_total(&Instrumentation::chain_time));
+                transformer = args.get_transformer_chain();
+            }
+            // needs to able to chain computations
+            return get_top_n_words_in_transformed_space(nwords, transformer);
+        });
+    // WordEmbedding this_word1 = get(word1);
+    // WordEmbedding this_word2 = get(word2);
+    // WordEmbedding this_word3 = get(word3);
+    // LikeUnlikeTransformer transformer(this_word1.vector, this_word2.vector, is_negative, vector_similarity_projection_factor);
+    // RawVector comparison = transformer.get_comparison_point();
+    // LikeUnlikeTransformer transformer2(comparison, transformer(this_word3.vector), is_negative, vector_similarity_projection_factor);
+    // return get_top_n_words_in_transformed_space(nwords,
+    //                                             transformer2);
+}
+
+RawVector WordEmbeddings::like_distances(LikeArgs args, const StringVector & words,
+                                         bool transform_each) const
+{
+    args.embed(*this);
+    LikeUnlikeTransformerChain chain = args.get_transformer_chain();
+    ChainScorer scorer(chain);
+    Vector comparison_point = chain.get_final_comparison_point();
+    std::vector<double> multiples(scorer.steps());
+    RawVector buffer;
+    RawVector retval;
+    for (const auto & word : words) {
+        long row = get_row(word);
+        if (row < 0) {
+            throw std::runtime_error("requested word " + word + " not present");
+        }
+        const WordVecFloat * v = full_precision_row(row, buffer);
+        if (transform_each) {
+            Vector transformed = chain(Vector(RawVector(v, v + dimension)));
+            retval.push_back(transformed.cosine_distance(comparison_point));
+        } else {
+            retval.push_back(scorer.distance(v, multiples.data()));
+        }
+    }
+    return retval;
+}
+
+ScoredWords WordEmbeddings::like(const std::string & word1, const std::string & word2,
+                                 unsigned int nwords,
+                                 WordVecFloat vector_similarity_projection_factor) const
+{
+    return like(word1, word2, nwords, false, vector_similarity_projection_factor);
+}
+
+ScoredWords WordEmbeddings::unlike(const std::string & word1, const std::string & word2,
+                                 unsigned int nwords,
+                                 WordVecFloat vector_similarity_projection_factor) const
+{
+    return like(word1, word2, nwords, true, vector_similarity_projection_factor);
+}
+
+std::vector<ScoredWordVector> WordEmbeddings::like_many(std::vector<LikeArgs> queries,
+                                                        unsigned int nwords) const
+{
+    // Only the queries not found in the cache are scanned for
+    std::vector<ScoredWordVector> retval(queries.size());
+    std::vector<size_t> scanned;
+    std::vector<std::string> keys;
+    std::vector<ChainScorer> scorers;
+    for (size_t i = 0; i < queries.size(); ++i) {
+        if (cache->enabled()) {
+            std::string key = std::to_string(nwords) + ' ';
+            append_args_key(key, queries[i]);
+            ScoredWords cached;
+            if (cache->find(key, cached)) {
+                retval[i] = cached;
+                continue;
+            }
+            keys.push_back(key);
+        }
+        queries[i].embed(*this);
+        PhaseTimer timer(phase_total(&Instrumentation::chain_time));
+        LikeUnlikeTransformerChain transformer = queries[i].get_transformer_chain();
+        scorers.push_back(ChainScorer(transformer));
+        scanned.push_back(i);
+    }
+    std::vector<ScoredRows> found;
+    {
+        PhaseTimer timer(phase_total(&Instrumentation::scan_time));
+        found = get_top_n_in_transformed_space(nwords, scorers);
+    }
+    for (size_t j = 0; j < scanned.size(); ++j) {
+        ScoredWords words = scored_words(found[j]);
+        if (cache->enabled()) {
+            cache->insert(keys[j], words);
+        }
+        retval[scanned[j]] = words;
+    }
+    return retval;
+}
+
+static size_t common_prefix_length(std::string_view a, std::string_view b)
+{
+    size_t i = 0;
+    while (i < a.size() && i < b.size() && a[i] == b[i]) {
+        ++i;
+    }
+    return i;
+}
+
+static size_t common_suffix_length(std::string_view a, std::string_view b)
+{
+    size_t i = 0;
+    while (i < a.size() && i < b.size() && a[a.size() - 1 - i] == b[b.size() - 1 - i]) {
+        ++i;
+    }
+    return i;
+}
+
+// Compare the reversals of a and b, looking at no more than limit characters
+// of each, with the same unsigned character order as std::string::compare
+static int compare_reversed(std::string_view a, std::string_view b,
+                            size_t limit = std::string::npos)
+{
+    size_t a_size = std::min(a.size(), limit);
+    size_t b_size = std::min(b.size(), limit);
+    for (size_t i = 0; i < a_size && i < b_size; ++i) {
+        unsigned char ac = a[a.size() - 1 - i];
+        unsigned char bc = b[b.size() - 1 - i];
+        if (ac != bc) {
+            return ac < bc ? -1 : 1;
+        }
+    }
+    return a_size < b_size ? -1 : (a_size > b_size ? 1 : 0);
+}
+
+RangeMinimum::RangeMinimum(const std::vector<uint32_t> & values):
+    n(values.size()), tree(2 * values.size())
+{
+    std::copy(values.begin(), values.end(), tree.begin() + n);
+    for (size_t i = n - 1; i > 0; --i) {
+        tree[i] = std::min(tree[2 * i], tree[2 * i + 1]);
+    }
+}
+
+uint32_t RangeMinimum::operator() (size_t begin, size_t end) const
+{
+    uint32_t retval = UINT32_MAX;
+    for (begin += n, end += n; begin < end; begin /= 2, end /= 2) {
+        if (begin & 1) {
+            retval = std::min(retval, tree[begin++]);
+        }
+        if (end & 1) {
+            retval = std::min(retval, tree[--end]);
+        }
+    }
+    return retval;
+}
+
+uint64_t word_hash(std::string_view word)
+{
+    uint64_t hash = 14695981039346656037ull;
+    for (unsigned char c : word) {
+        hash = (hash ^ c) * 1099511628211ull;
+    }
+    return hash;
+}
+
+std::vector<uint32_t> make_word_slots(const WordEmbeddings & embs)
+{
+    size_t slot_count = 2;
+    while (slot_count < 2 * embs.size()) {
+        slot_count *= 2;
+    }
+    std::vector<uint32_t> slots(slot_count, UINT32_MAX);
+    for (uint32_t row = 0; row < embs.size(); ++row) {
+        std::string_view word = embs.word_at(row);
+        size_t slot = word_hash(word) & (slot_count - 1);
+        // the first of any duplicates wins, as in a linear search
+        while (slots[slot] != UINT32_MAX && embs.word_at(slots[slot]) != word) {
+            slot = (slot + 1) & (slot_count - 1);
+        }
+        if (slots[slot] == UINT32_MAX) {
+            slots[slot] = row;
+        }
+    }
+    return slots;
+}
+
+void VocabularyIndex::clear(void)
+{
+    own_slots.clear();
+    mapped_slots = nullptr;
+    slot_mask = 0;
+    forward.clear();
+    reversed.clear();
+    reversed_position.clear();
+    forward_minimum = RangeMinimum();
+    reversed_minimum = RangeMinimum();
+    sorted_once = std::make_shared<std::once_flag>();
+}
+
+void VocabularyIndex::build(const WordEmbeddings & embs)
+{
+    clear();
+    own_slots = make_word_slots(embs);
+    slot_mask = own_slots.size() - 1;
+}
+
+void VocabularyIndex::attach(const uint32_t * slots, size_t slot_count)
+{
+    clear();
+    mapped_slots = slots;
+    slot_mask = slot_count - 1;
+}
+
+void VocabularyIndex::build_sorted(const WordEmbeddings & embs) const
+{
+    for (uint32_t row = 0; row < embs.size(); ++row) {
+        forward.push_back(row);
+    }
+    if (embs.size() == 0) {
+        return;
+    }
+    reversed = forward;
+    std::sort(forward.begin(), forward.end(),
+              [&embs](uint32_t a, uint32_t b) {
+                  return embs.word_at(a).compare(embs.word_at(b)) < 0; });
+    std::sort(reversed.begin(), reversed.end(),
+              [&embs](uint32_t a, uint32_t b) {
+                  return compare_reversed(embs.word_at(a), embs.word_at(b)) < 0; });
+    reversed_position.resize(embs.size());
+    for (size_t i = 0; i < reversed.size(); ++i) {
+        reversed_position[reversed[i]] = i;
+    }
+    forward_minimum = RangeMinimum(forward);
+    reversed_minimum = RangeMinimum(reversed);
+}
+
+long VocabularyIndex::find(const WordEmbeddings & embs, std::string_view word) const
+{
+    if (slots() == nullptr) {
+        return -1;
+    }
+    for (size_t slot = word_hash(word) & slot_mask;; slot = (slot + 1) & slot_mask) {
+        uint32_t row = slots()[slot];
+        if (row == UINT32_MAX) {
+            return -1;
+        }
+        // A snapshot loaded with a limit has slots for rows beyond it
+        if (row < embs.size() && embs.word_at(row) == word) {
+            return row;
+        }
+    }
+}
+
+// The range of positions in forward of words starting with the first
+// length characters of word
+std::pair<size_t, size_t> VocabularyIndex::prefix_range(
+    const WordEmbeddings & embs, const std::string & word, size_t length) const
+{
+    auto begin = std::lower_bound(
+        forward.begin(), forward.end(), word,
+        [&embs, length](uint32_t row, const std::string & w) {
+            return embs.word_at(row).compare(0, length, w, 0, length) < 0; });
+    auto end = std::upper_bound(
+        begin, forward.end(), word,
+        [&embs, length](const std::string & w, uint32_t row) {
+            return embs.word_at(row).compare(0, length, w, 0, length) > 0; });
+    return std::make_pair(begin - forward.begin(), end - forward.begin());
+}
+
+// The range of positions in reversed of words ending with the last length
+// characters of word
+std::pair<size_t, size_t> VocabularyIndex::suffix_range(
+    const WordEmbeddings & embs, const std::string & word, size_t length) const
+{
+    auto begin = std::lower_bound(
+        reversed.begin(), reversed.end(), word,
+        [&embs, length](uint32_t row, const std::string & w) {
+            return compare_reversed(embs.word_at(row), w, length) < 0; });
+    auto end = std::upper_bound(
+        begin, reversed.end(), word,
+        [&embs, length](const std::string & w, uint32_t row) {
+            return compare_reversed(embs.word_at(row), w, length) > 0; });
+    return std::make_pair(begin - reversed.begin(), end - reversed.begin());
+}
+
+long VocabularyIndex::find_best(const WordEmbeddings & embs,
+                                const std::string & word,
+                                bool * by_suffix) const
+{
+    long retval = find(embs, word);
+    if (retval >= 0 || word.empty()) {
+        return retval;
+    }
+    std::call_once(*sorted_once, [&] { build_sorted(embs); });
+    if (forward.empty()) {
+        return retval;
+    }
+    // The longest common prefix is with one of the neighbours in sorted
+    // order
+    size_t position = prefix_range(embs, word, std::string::npos).first;
+    size_t best_prefix = 0;
+    if (position > 0) {
+        best_prefix = common_prefix_length(word, embs.word_at(forward[position - 1]));
+    }
+    if (position < forward.size()) {
+        best_prefix = std::max(best_prefix, common_prefix_length(word, embs.word_at(forward[position])));
+    }
+    long best_by_prefix = -1;
+    if (best_prefix > 0) {
+        std::pair<size_t, size_t> range = prefix_range(embs, word, best_prefix);
+        best_by_prefix = forward_minimum(range.first, range.second);
+    }
+    if (best_prefix == word.size()) {
+        // word is a prefix of something, no suffix can be longer than that
+        return best_by_prefix;
+    }
+
+    // Suffixes are only considered for words that aren't prefixes of word,
+    // so find the positions of those to skip them
+    std::vector<size_t> skip;
+    for (size_t length = 0; length < word.size(); ++length) {
+        std::pair<size_t, size_t> range = prefix_range(
+            embs, word.substr(0, length), std::string::npos);
+        for (size_t i = range.first; i < range.second; ++i) {
+            skip.push_back(reversed_position[forward[i]]);
+        }
+    }
+    std::sort(skip.begin(), skip.end());
+    position = suffix_range(embs, word, std::string::npos).first;
+    size_t longest_suffix = 0;
+    if (position > 0) {
+        longest_suffix = common_suffix_length(word, embs.word_at(reversed[position - 1]));
+    }
+    if (position < reversed.size()) {
+        longest_suffix = std::max(longest_suffix, common_suffix_length(word, embs.word_at(reversed[position])));
+    }
+    for (size_t length = longest_suffix; length > best_prefix; --length) {
+        std::pair<size_t, size_t> range = suffix_range(embs, word, length);
+        // The earliest row in the range apart from the skipped ones
+        uint32_t best = UINT32_MAX;
+        size_t begin = range.first;
+        for (size_t skipped : skip) {
+            if (skipped < range.first || skipped >= range.second) {
+                continue;
+            }
+            if (begin < skipped) {
+                best = std::min(best, reversed_minimum(begin, skipped));
+            }
+            begin = skipped + 1;
+        }
+        if (begin < range.second) {
+            best = std::min(best, reversed_minimum(begin, range.second));
+        }
+        if (best != UINT32_MAX) {
+            if (by_suffix) {
+                *by_suffix = true;
+            }
+            return best;
+        }
+    }
+    return best_by_prefix;
+}
+
+StringVector WordEmbeddings::get_vocabulary(void) const
+{
+    StringVector retval;
+    retval.reserve(size());
+    for (size_t row = 0; row < size(); ++row) {
+        retval.push_back(std::string(word_at(row)));
+    }
+    return retval;
+}
+
+void WordEmbeddings::build_index(size_t M, size_t ef_construction,
+                                 unsigned int seed)
+{
+    index = std::make_shared<HnswIndex>(M, ef_construction);
+    index->build(*this, seed);
+    cache->clear();
+}
+
+void WordEmbeddings::save_index(const std::string & filename) const
+{
+    if (!index) {
+        throw std::runtime_error("no index to save");
+    }
+    index->save(filename);
+}
+
+void WordEmbeddings::load_index(const std::string & filename)
+{
+    std::shared_ptr<HnswIndex> loaded = std::make_shared<HnswIndex>();
+    loaded->load(filename, *this);
+    index = loaded;
+    cache->clear();
+}
+
+void WordEmbeddings::set_index_ef(size_t ef)
+{
+    if (!index) {
+        throw std::runtime_error("no index has been built or loaded");
+    }
+    index->set_ef(ef);
+    cache->clear();
+}
+
+uint64_t vocabulary_fingerprint(const WordEmbeddings & embs)
+{
+    // FNV-1a over the words, so that an index isn't used with a different
+    // vocabulary than it was built for
+    uint64_t hash = 14695981039346656037ull;
+    for (size_t row = 0; row < embs.size(); ++row) {
+        for (unsigned char c : embs.word_at(row)) {
+            hash = (hash ^ c) * 1099511628211ull;
+        }
+        hash = (hash ^ '\n') * 1099511628211ull;
+    }
+    return hash;
+}
+
+HnswIndex::HnswIndex(size_t _M, size_t _ef_construction):
+    M(std::max(static_cast<size_t>(2), _M)), M0(2 * M),
+    ef_construction(std::max(_ef_construction, M)), ef(50),
+    level_multiplier(1.0 / log(static_cast<double>(M))),
+    max_level(-1), entry_point(0), fingerprint(0) {}
+
+uint32_t * HnswIndex::neighbours(uint32_t node, int level)
 {
-    LikeUnlikeTransformerChain retval;
-    if (left->is_leaf() && right->is_leaf()) {
-        retval.push_back(LikeUnlikeTransformer(left->embedding.vector,
-                                               right->embedding.vector,
-                                               negative,
-                                               projection_factor));
+    return links[node].data() + (level == 0 ? 0 : (1 + M0) + (level - 1) * (1 + M));
+}
+
+const uint32_t * HnswIndex::neighbours(uint32_t node, int level) const
+{
+    return links[node].data() + (level == 0 ? 0 : (1 + M0) + (level - 1) * (1 + M));
+}
+
+// Best-first search on one level, returning up to ef nearest nodes found,
+// nearest first
+ScoredRows HnswIndex::search_layer(const WordEmbeddings & embs,
+                                   const Vector & query,
+                                   const ScoredRows & entry_points,
+                                   size_t ef, int level) const
+{
+    std::unordered_set<uint32_t> visited;
+    // candidates is a min-heap, found a max-heap of the best ef so far
+    std::priority_queue<ScoredRow, ScoredRows, std::greater<ScoredRow> > candidates;
+    std::priority_queue<ScoredRow> found;
+    for (const auto & ep : entry_points) {
+        visited.insert(ep.second);
+        candidates.push(ep);
+        found.push(ep);
+    }
+    while (found.size() > ef) {
+        found.pop();
+    }
+    while (!candidates.empty()) {
+        ScoredRow current = candidates.top();
+        if (current.first > found.top().first && found.size() >= ef) {
+            break;
+        }
+        candidates.pop();
+        const uint32_t * list = neighbours(current.second, level);
+        for (uint32_t i = 1; i <= list[0]; ++i) {
+            uint32_t neighbour = list[i];
+            if (!visited.insert(neighbour).second) {
+                continue;
+            }
+            WordVecFloat dist = embs.row_distance(neighbour, query);
+            if (found.size() < ef || dist < found.top().first) {
+                candidates.push(ScoredRow(dist, neighbour));
+                found.push(ScoredRow(dist, neighbour));
+                if (found.size() > ef) {
+                    found.pop();
+                }
+            }
+        }
+    }
+    ScoredRows retval(found.size());
+    for (size_t i = found.size(); i > 0; --i) {
+        retval[i - 1] = found.top();
+        found.pop();
+    }
+    return retval;
+}
+
+// The neighbour selection heuristic of the HNSW paper: take candidates
+// nearest first, skipping ones that are closer to an already selected
+// neighbour than to the base node, to keep the graph well connected
+ScoredRows HnswIndex::select_neighbours(const WordEmbeddings & embs,
+                                        ScoredRows candidates, size_t n) const
+{
+    std::sort(candidates.begin(), candidates.end());
+    ScoredRows retval;
+    for (const auto & candidate : candidates) {
+        if (retval.size() >= n) {
+            break;
+        }
+        bool keep = true;
+        for (const auto & selected : retval) {
+            if (embs.row_distance(candidate.second, selected.second) < candidate.first) {
+                keep = false;
+                break;
+            }
+        }
+        if (keep) {
+            retval.push_back(candidate);
+        }
+    }
+    return retval;
+}
+
+void HnswIndex::connect(const WordEmbeddings & embs, uint32_t node, int level,
+                        const ScoredRows & selected)
+{
+    uint32_t * list = neighbours(node, level);
+    list[0] = selected.size();
+    for (size_t i = 0; i < selected.size(); ++i) {
+        list[i + 1] = selected[i].second;
+    }
+    size_t limit = max_neighbours(level);
+    for (const auto & other : selected) {
+        uint32_t * other_list = neighbours(other.second, level);
+        if (other_list[0] < limit) {
+            other_list[++other_list[0]] = node;
+            continue;
+        }
+        // The neighbour is full, so reselect its neighbours from its
+        // current ones and the new node
+        ScoredRows candidates;
+        candidates.push_back(ScoredRow(other.first, node));
+        for (uint32_t i = 1; i <= other_list[0]; ++i) {
+            candidates.push_back(ScoredRow(
+                embs.row_distance(other_list[i], other.second),
+                other_list[i]));
+        }
+        ScoredRows kept = select_neighbours(embs, candidates, limit);
+        other_list[0] = kept.size();
+        for (size_t i = 0; i < kept.size(); ++i) {
+            other_list[i + 1] = kept[i].second;
+        }
+    }
+}
+
+void HnswIndex::build(const WordEmbeddings & embs, unsigned int seed)
+{
+    std::mt19937 rng(seed);
+    std::uniform_real_distribution<double> uniform(0.0, 1.0);
+    levels.clear();
+    links.clear();
+    levels.reserve(embs.size());
+    links.reserve(embs.size());
+    max_level = -1;
+    entry_point = 0;
+    fingerprint = vocabulary_fingerprint(embs);
+    for (uint32_t node = 0; node < embs.size(); ++node) {
+        int level = static_cast<int>(-log(1.0 - uniform(rng)) * level_multiplier);
+        levels.push_back(level);
+        links.push_back(std::vector<uint32_t>((1 + M0) + level * (1 + M), 0));
+        const Vector query = embs.row_vector(node);
+        if (max_level < 0) {
+            max_level = level;
+            entry_point = node;
+            continue;
+        }
+        ScoredRows eps(1, ScoredRow(embs.row_distance(entry_point, query), entry_point));
+        for (int l = max_level; l > level; --l) {
+            eps = search_layer(embs, query, eps, 1, l);
+        }
+        for (int l = std::min(level, max_level); l >= 0; --l) {
+            eps = search_layer(embs, query, eps, ef_construction, l);
+            connect(embs, node, l, select_neighbours(embs, eps, M));
+        }
+        if (level > max_level) {
+            max_level = level;
+            entry_point = node;
+        }
+    }
+}
+
+ScoredRows HnswIndex::search(const WordEmbeddings & embs, const Vector & query,
+                             size_t n) const
+{
+    if (max_level < 0 || n == 0) {
+        return ScoredRows();
+    }
+    ScoredRows eps(1, ScoredRow(embs.row_distance(entry_point, query), entry_point));
+    for (int l = max_level; l > 0; --l) {
+        eps = search_layer(embs, query, eps, 1, l);
+    }
+    ScoredRows retval = search_layer(embs, query, eps, std::max(ef, n), 0);
+    if (retval.size() > n) {
+        retval.resize(n);
+    }
+    return retval;
+}
+
+// All nodes within distance of query that the graph search finds. The
+// search is widened until it reaches beyond the radius.
+ScoredRows HnswIndex::search_radius(const WordEmbeddings & embs,
+                                    const Vector & query,
+                                    WordVecFloat distance) const
+{
+    ScoredRows found;
+    for (size_t n = std::max(ef, static_cast<size_t>(64));; n *= 2) {
+        found = search(embs, query, n);
+        if (found.size() < n || found.back().first > distance) {
+            break;
+        }
+    }
+    ScoredRows retval;
+    for (const auto & hit : found) {
+        if (hit.first > distance) {
+            break;
+        }
+        retval.push_back(hit);
+    }
+    return retval;
+}
+
+/*
+ * The index file has a fixed header followed by each node's level and
+ * neighbour lists:
+ *
+ *   "EMBHNSW1", then uint64 node count, M, ef_construction, ef and
+ *   vocabulary fingerprint, int32 max level, uint32 entry point
+ *   for each node: int32 level, uint32 neighbour lists as in links
+ */
+void HnswIndex::save(const std::string & filename) const
+{
+    std::ofstream outfile(filename.c_str(), std::ios::binary);
+    if (!outfile.good()) {
+        throw std::runtime_error("could not open index file " + filename + " for writing");
+    }
+    uint64_t header[5] = { levels.size(), M, ef_construction, ef, fingerprint };
+    outfile.write("EMBHNSW1", 8);
+    outfile.write((const char*)header, sizeof(header));
+    outfile.write((const char*)&max_level, sizeof(max_level));
+    outfile.write((const char*)&entry_point, sizeof(entry_point));
+    for (size_t node = 0; node < levels.size(); ++node) {
+        int32_t level = levels[node];
+        outfile.write((const char*)&level, sizeof(level));
+        outfile.write((const char*)links[node].data(), links[node].size() * sizeof(uint32_t));
+    }
+    if (!outfile.good()) {
+        throw std::runtime_error("error writing index file " + filename);
+    }
+}
+
+void HnswIndex::load(const std::string & filename, const WordEmbeddings & embs)
+{
+    // Nothing read from the file is trusted: sizes are checked before
+    // anything is allocated for them, and levels and neighbour ids before
+    // a search can follow them
+    const uint64_t max_M = 1 << 12;
+    const int32_t max_levels = 64;
+    std::ifstream infile(filename.c_str(), std::ios::binary | std::ios::ate);
+    uint64_t remaining = infile.good() ? static_cast<uint64_t>(infile.tellg()) : 0;
+    infile.seekg(0);
+    char magic[8];
+    uint64_t header[5];
+    infile.read(magic, 8);
+    if (!infile.good() || std::string(magic, 8) != "EMBHNSW1") {
+        throw std::runtime_error("could not read index file " + filename);
+    }
+    infile.read((char*)header, sizeof(header));
+    infile.read((char*)&max_level, sizeof(max_level));
+    infile.read((char*)&entry_point, sizeof(entry_point));
+    if (!infile.good()) {
+        throw std::runtime_error("index file " + filename + " is truncated");
+    }
+    remaining -= 8 + sizeof(header) + sizeof(max_level) + sizeof(entry_point);
+    if (header[0] != embs.size() || header[4] != vocabulary_fingerprint(embs)) {
+        throw std::runtime_error("index file " + filename + " was built for different embeddings");
+    }
+    size_t nodes = header[0];
+    if (header[1] < 2 || header[1] > max_M || max_level < -1 || max_level >= max_levels
+        || (nodes == 0) != (max_level < 0) || (nodes > 0 && entry_point >= nodes)) {
+        throw std::runtime_error("index file " + filename + " has an invalid header");
+    }
+    M = header[1];
+    M0 = 2 * M;
+    ef_construction = header[2];
+    ef = header[3];
+    level_multiplier = 1.0 / log(static_cast<double>(M));
+    fingerprint = header[4];
+    levels.assign(nodes, 0);
+    links.assign(nodes, std::vector<uint32_t>());
+    for (size_t node = 0; node < nodes; ++node) {
+        int32_t level;
+        infile.read((char*)&level, sizeof(level));
+        if (!infile.good()) {
+            throw std::runtime_error("index file " + filename + " is truncated");
+        }
+        if (level < 0 || level > max_level) {
+            throw std::runtime_error("index file " + filename + " has an invalid level for node " +
+                                     std::to_string(node));
+        }
+        size_t link_count = (1 + M0) + level * (1 + M);
+        if (sizeof(level) + link_count * sizeof(uint32_t) > remaining) {
+            throw std::runtime_error("index file " + filename + " is truncated");
+        }
+        remaining -= sizeof(level) + link_count * sizeof(uint32_t);
+        levels[node] = level;
+        links[node].resize(link_count);
+        infile.read((char*)links[node].data(), links[node].size() * sizeof(uint32_t));
+        for (int l = 0; l <= level; ++l) {
+            const uint32_t * list = neighbours(node, l);
+            bool valid = list[0] <= max_neighbours(l);
+            for (uint32_t i = 1; valid && i <= list[0]; ++i) {
+                valid = list[i] < nodes;
+            }
+            if (!valid) {
+                throw std::runtime_error("index file " + filename + " has invalid neighbours for node " +
+                                         std::to_string(node));
+            }
+        }
+    }
+    if (!infile.good()) {
+        throw std::runtime_error("index file " + filename + " is truncated");
+    }
+    if (nodes > 0 && levels[entry_point] != max_level) {
+        throw std::runtime_error("index file " + filename + " has an invalid entry point");
+    }
+}
+
+// The full precision vector of a row, either in the matrix or, if it has
+// been released, read into buffer
+const WordVecFloat * WordEmbeddings::full_precision_row(size_t row, RawVector & buffer) const
+{
+    if (!full_precision_released()) {
+        return row_data(row);
+    }
+    buffer.resize(dimension);
+    read_source_row(row, buffer.data());
+    return buffer.data();
+}
+
+void WordEmbeddings::read_source_row(size_t row, WordVecFloat * v) const
+{
+    const char * source = full_precision_source->begin() + source_offsets[row];
+    if (source_float16) {
+        uint16_t half;
+        for (size_t i = 0; i < dimension; ++i) {
+            memcpy(&half, source + i * sizeof(half), sizeof(half));
+            v[i] = half_to_float(half);
+        }
+    } else {
+        memcpy(v, source, sizeof(WordVecFloat) * dimension);
+    }
+}
+
+Vector WordEmbeddings::row_vector(size_t row) const
+{
+    RawVector buffer;
+    const WordVecFloat * v = full_precision_row(row, buffer);
+    return Vector(RawVector(v, v + dimension));
+}
+
+WordVecFloat WordEmbeddings::row_distance(size_t row, const WordVecFloat * other,
+                                          WordVecFloat other_inverse_norm) const
+{
+    RawVector buffer;
+    return cosine_distance_from_dot(
+        dot_product(full_precision_row(row, buffer), other, dimension),
+        inverse_norm_data[row], other_inverse_norm);
+}
+
+WordVecFloat WordEmbeddings::row_distance(size_t row, const Vector & other) const
+{
+    return row_distance(row, other.data(), inverse_norm(other.get_norm()));
+}
+
+WordVecFloat WordEmbeddings::row_distance(size_t row, size_t other_row) const
+{
+    RawVector buffer;
+    return row_distance(row, full_precision_row(other_row, buffer), inverse_norm_data[other_row]);
+}
+
+WordEmbedding WordEmbeddings::embedding_at(size_t row) const
+{
+    WordEmbedding retval{std::string(word_at(row))};
+    retval.vector = row_vector(row);
+    return retval;
+}
+
+void WordEmbeddings::quantize(const std::string & mode)
+{
+    cache->clear();
+    if (full_precision_released() && snapshot) {
+        // They never left the mapped snapshot
+        full_precision_source.reset();
+        source_offsets.clear();
+    } else if (full_precision_released()) {
+        // Bring the full precision vectors back first
+        matrix = std::make_shared<AlignedVector>(size() * row_stride, 0.0);
+        for (size_t row = 0; row < size(); ++row) {
+            read_source_row(row, matrix->data() + row * row_stride);
+        }
+        full_precision_source.reset();
+        use_own_arrays();
+    }
+    quantized.reset();
+    if (mode == "none") {
+        return;
+    }
+    std::shared_ptr<QuantizedVectors> q;
+    if (mode == "float16") {
+        q = std::make_shared<QuantizedVectors>(QuantizedVectors::Float16, dimension);
+    } else if (mode == "int8") {
+        q = std::make_shared<QuantizedVectors>(QuantizedVectors::Int8, dimension);
+    } else {
+        throw std::runtime_error("unknown quantization mode " + mode);
+    }
+    q->reserve(size());
+    for (size_t row = 0; row < size(); ++row) {
+        q->push_back(RawVector(row_data(row), row_data(row) + dimension));
+    }
+    quantized = q;
+    // Full precision is only needed for rescoring candidates, so leave it
+    // in the file
+    if (snapshot) {
+        const char * begin = reinterpret_cast<const char *>(matrix_data);
+        source_offsets.resize(size());
+        for (size_t row = 0; row < size(); ++row) {
+            source_offsets[row] = begin - snapshot->begin() + row * row_stride * sizeof(WordVecFloat);
+        }
+        source_float16 = false;
+        full_precision_source = snapshot;
+        snapshot->release(begin, size() * row_stride * sizeof(WordVecFloat));
+    } else if (!source_filename.empty() && source_offsets.size() == size()) {
+        full_precision_source = std::make_shared<MappedFile>(source_filename);
+        matrix = std::make_shared<AlignedVector>();
+        use_own_arrays();
+    } else if (size() > 0) {
+        std::cerr << "warning: vectors read from a text file are kept in full precision"
+            " as well as quantized\n";
+    }
+}
+
+size_t WordEmbeddings::vector_memory_usage(void) const
+{
+    size_t retval = (matrix->capacity() + inverse_norms.capacity()) * sizeof(WordVecFloat);
+    if (snapshot) {
+        // Mapped, and shared with any other process using the same file.
+        // The matrix is only read from for rescoring once quantized.
+        retval += ((full_precision_released() ? 0 : size() * row_stride) + size()) * sizeof(WordVecFloat);
+    }
+    if (quantized) {
+        retval += quantized->memory_usage();
+    }
+    return retval;
+}
+
+ScoredWords WordEmbeddings::scored_words(const ScoredRows & rows) const
+{
+    PhaseTimer timer(phase_total(&Instrumentation::conversion_time));
+    ScoredWords retval;
+    retval.reserve(rows.size());
+    for (const auto & hit : rows) {
+        retval.push_back(ScoredWord(std::string(word_at(hit.second)), hit.first));
+    }
+    return retval;
+}
+
+/*
+ * The n best in the original space by the quantized vectors. Every row whose
+ * lower bound is no worse than the n'th best upper bound is rescored in full
+ * precision, which gives the same result as scanning in full precision.
+ */
+ScoredRows WordEmbeddings::get_top_n_quantized(
+    const Vector & comparison_point,
+    size_t n) const
+{
+    ScoredRows retval;
+    if (n == 0) {
         return retval;
-    } else if (right->is_leaf()) {
-        LikeUnlikeTransformerChain l = left->get_transformer_chain();
-        retval.insert(retval.end(), l.begin(), l.end());
-        LikeUnlikeTransformer root(retval.get_final_comparison_point(),
-                                   right->embedding.vector,
-                                   negative,
-                                   projection_factor);
-        retval.push_back(root);
+    }
+    if (comparison_point.get_norm() == 0.0) {
+        // Everything is at distance 0.0 from a zero vector, and there are no
+        // meaningful bounds
+        for (size_t row = 0; row < size() && row < n; ++row) {
+            retval.push_back(ScoredRow(row_distance(row, comparison_point), row));
+        }
         return retval;
     }
-    LikeUnlikeTransformerChain l = left->get_transformer_chain();
-    retval.insert(retval.end(), l.begin(), l.end());
-    LikeUnlikeTransformerChain r = right->get_transformer_chain();
-    retval.insert(retval.end(), r.begin(), r.end());
+    count(&Instrumentation::vectors_scanned, size());
+    RawVector unit_query = scalar_multiplication(
+        1.0 / comparison_point.get_norm(), comparison_point);
+    std::vector<WordVecFloat> approximate(size());
+    size_t parts = row_parts();
+    std::vector<TopRows> upper_bounds(parts, TopRows(n));
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            for (size_t row = begin; row < end; ++row) {
+                approximate[row] = quantized->distance(row, unit_query);
+                upper_bounds[part].push(approximate[row] + quantized->error_bound(row), row);
+            }
+        });
+    ScoredRows best_upper_bounds = merge_top_rows(upper_bounds);
+    bool everything = best_upper_bounds.size() < n;
+    WordVecFloat threshold = best_upper_bounds.empty() ? 0.0 : best_upper_bounds.back().first;
+    std::vector<ScoredRows> candidates(parts);
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            for (size_t row = begin; row < end; ++row) {
+                if (everything || approximate[row] - quantized->error_bound(row) <= threshold) {
+                    candidates[part].push_back(ScoredRow(row_distance(row, comparison_point), row));
+                }
+            }
+        });
+    for (const auto & part_candidates : candidates) {
+        retval.insert(retval.end(), part_candidates.begin(), part_candidates.end());
+    }
+    // Ties are broken by row, the same way as in the full precision scan
+    std::sort(retval.begin(), retval.end());
+    if (retval.size() > n) {
+        retval.resize(n);
+    }
     return retval;
 }
 
-ScoredWords WordEmbeddings::like(LikeArgs args,
-                                 unsigned int nwords) const
+/*
+ * The n best in transformed space by the quantized vectors. The steps move
+ * vectors at most a fixed number of times further apart, so each quantized
+ * vector's error bound gives one for its transformed distance, and every
+ * row whose lower bound is no worse than the n'th best upper bound is
+ * rescored in full precision, as in get_top_n_quantized().
+ */
+ScoredRows WordEmbeddings::get_top_n_in_transformed_space_quantized(
+    size_t n,
+    const ChainScorer & scorer) const
 {
-//    auto embedder = std::bind(&WordEmbeddings::get, *this);
-//    std::function<WordEmbedding (const std::string & word)> embedder_fobj(embedder);
-    args.embed(*this);
-    // turn strings into Vectors
-    LikeUnlikeTransformerChain transformer = args.get_transformer_chain();
-    // needs to able to chain computations
-    return get_top_n_words_in_transformed_space(nwords, transformer);
-    // WordEmbedding this_word1 = get(word1);
-    // WordEmbedding this_word2 = get(word2);
-    // WordEmbedding this_word3 = get(word3);
-    // LikeUnlikeTransformer transformer(this_word1.vector, this_word2.vector, is_negative, vector_similarity_projection_factor);
-    // RawVector comparison = transformer.get_comparison_point();
-    // LikeUnlikeTransformer transformer2(comparison, transformer(this_word3.vector), is_negative, vector_similarity_projection_factor);
-    // return get_top_n_words_in_transformed_space(nwords,
-    //                                             transformer2);
+    ScoredRows retval;
+    if (n == 0) {
+        return retval;
+    }
+    count(&Instrumentation::vectors_scanned, size());
+    std::vector<WordVecFloat> approximate(size());
+    std::vector<WordVecFloat> bounds(size());
+    size_t parts = row_parts();
+    std::vector<TopRows> upper_bounds(parts, TopRows(n));
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            RawVector dequantized(dimension);
+            std::vector<double> multiples(scorer.steps());
+            for (size_t row = begin; row < end; ++row) {
+                quantized->dequantize(row, dequantized);
+                approximate[row] = scorer.distance(
+                    dequantized.data(), multiples.data(),
+                    static_cast<double>(quantized->error_bound(row)) * quantized->row_norm(row),
+                    bounds[row]);
+                upper_bounds[part].push(approximate[row] + bounds[row], row);
+            }
+        });
+    ScoredRows best_upper_bounds = merge_top_rows(upper_bounds);
+    bool everything = best_upper_bounds.size() < n;
+    WordVecFloat threshold = best_upper_bounds.empty() ? 0.0 : best_upper_bounds.back().first;
+    std::vector<ScoredRows> candidates(parts);
+    for_each_row_range(parts, [&](size_t part, size_t begin, size_t end) {
+            RawVector buffer;
+            std::vector<double> multiples(scorer.steps());
+            for (size_t row = begin; row < end; ++row) {
+                if (everything || approximate[row] - bounds[row] <= threshold) {
+                    WordVecFloat cosdist = scorer.distance(full_precision_row(row, buffer),
+                                                           multiples.data());
+                    candidates[part].push_back(ScoredRow(cosdist, row));
+                }
+            }
+        });
+    for (const auto & part_candidates : candidates) {
+        retval.insert(retval.end(), part_candidates.begin(), part_candidates.end());
+    }
+    // Ties are broken by row, the same way as in the full precision scan
+    std::sort(retval.begin(), retval.end());
+    if (retval.size() > n) {
+        retval.resize(n);
+    }
+    return retval;
 }
 
-ScoredWords WordEmbeddings::like(const std::string & word1, const std::string & word2,
-                                 unsigned int nwords,
-                                 WordVecFloat vector_similarity_projection_factor) const
+void QuantizedVectors::reserve(size_t rows)
 {
-    return like(word1, word2, nwords, false, vector_similarity_projection_factor);
+    if (mode == Float16) {
+        halves.reserve(rows * dimension);
+    } else {
+        bytes.reserve(rows * dimension);
+        scales.reserve(rows);
+    }
+    norms.reserve(rows);
+    errors.reserve(rows);
 }
 
-ScoredWords WordEmbeddings::unlike(const std::string & word1, const std::string & word2,
-                                 unsigned int nwords,
-                                 WordVecFloat vector_similarity_projection_factor) const
+static std::vector<float> make_half_table(void)
 {
-    return like(word1, word2, nwords, true, vector_similarity_projection_factor);
+    std::vector<float> table(1 << 16);
+    for (uint32_t h = 0; h < (1 << 16); ++h) {
+        table[h] = half_to_float(h);
+    }
+    return table;
+}
+
+// All float16 values as floats, for converting while scanning
+static const float * half_table(void)
+{
+    static const std::vector<float> table = make_half_table();
+    return table.data();
+}
+
+void QuantizedVectors::push_back(const RawVector & v)
+{
+    WordVecFloat original_norm = norm(v);
+    RawVector dequantized(dimension);
+    if (mode == Float16) {
+        for (size_t i = 0; i < dimension; ++i) {
+            halves.push_back(float_to_half(v[i]));
+        }
+    } else {
+        WordVecFloat largest = 0.0;
+        for (size_t i = 0; i < dimension; ++i) {
+            largest = std::max(largest, std::fabs(v[i]));
+        }
+        WordVecFloat scale = largest / 127;
+        for (size_t i = 0; i < dimension; ++i) {
+            bytes.push_back(scale == 0.0 ? 0 : static_cast<int8_t>(
+                                std::max(-127.0f, std::min(127.0f, std::round(v[i] / scale)))));
+        }
+        scales.push_back(scale);
+    }
+    norms.push_back(original_norm);
+    dequantize(norms.size() - 1, dequantized);
+    double error = 0.0;
+    for (size_t i = 0; i < dimension; ++i) {
+        error += (static_cast<double>(v[i]) - dequantized[i]) * (static_cast<double>(v[i]) - dequantized[i]);
+    }
+    // A little slack for rounding in the single precision arithmetic
+    errors.push_back(original_norm == 0.0 ? 0.0 : sqrt(error) / original_norm + 1e-5);
+}
+
+void QuantizedVectors::dequantize(size_t row, RawVector & out) const
+{
+    if (mode == Float16) {
+        const uint16_t * codes = &(halves[row * dimension]);
+        const float * table = half_table();
+        for (size_t i = 0; i < dimension; ++i) {
+            out[i] = table[codes[i]];
+        }
+    } else {
+        const int8_t * codes = &(bytes[row * dimension]);
+        for (size_t i = 0; i < dimension; ++i) {
+            out[i] = codes[i] * scales[row];
+        }
+    }
+}
+
+WordVecFloat QuantizedVectors::distance(size_t row, const RawVector & unit_query) const
+{
+    if (norms[row] == 0.0) {
+        // The full precision distance to a zero vector is 0.0
+        return 0.0;
+    }
+    WordVecFloat dot = 0.0;
+    if (mode == Float16) {
+        const uint16_t * codes = &(halves[row * dimension]);
+        const float * table = half_table();
+        for (size_t i = 0; i < dimension; ++i) {
+            dot += unit_query[i] * table[codes[i]];
+        }
+    } else {
+        const int8_t * codes = &(bytes[row * dimension]);
+        for (size_t i = 0; i < dimension; ++i) {
+            dot += unit_query[i] * codes[i];
+        }
+        dot *= scales[row];
+    }
+    return 1.0 - dot / norms[row];
+}
+
+size_t QuantizedVectors::memory_usage(void) const
+{
+    return halves.capacity() * sizeof(uint16_t) + bytes.capacity() +
+        (scales.capacity() + norms.capacity() + errors.capacity()) * sizeof(WordVecFloat);
+}
+
+uint16_t float_to_half(float f)
+{
+    uint32_t x;
+    memcpy(&x, &f, sizeof(x));
+    uint32_t sign = (x >> 16) & 0x8000;
+    uint32_t mantissa = x & 0x007fffff;
+    int32_t exponent = static_cast<int32_t>((x >> 23) & 0xff) - 127 + 15;
+    if (((x >> 23) & 0xff) == 0xff) {
+        // infinity or nan
+        return sign | 0x7c00 | (mantissa ? 0x200 : 0);
+    }
+    if (exponent >= 0x1f) {
+        return sign | 0x7c00;
+    }
+    if (exponent <= 0) {
+        // subnormal or zero
+        if (exponent < -10) {
+            return sign;
+        }
+        mantissa |= 0x00800000;
+        uint32_t shift = 14 - exponent;
+        uint32_t half_mantissa = mantissa >> shift;
+        uint32_t remainder = mantissa & ((1u << shift) - 1);
+        uint32_t halfway = 1u << (shift - 1);
+        if (remainder > halfway || (remainder == halfway && (half_mantissa & 1))) {
+            ++half_mantissa;
+        }
+        return sign | half_mantissa;
+    }
+    uint32_t half = sign | (exponent << 10) | (mantissa >> 13);
+    uint32_t remainder = mantissa & 0x1fff;
+    // round to nearest even, a carry into the exponent is still correct
+    if (remainder > 0x1000 || (remainder == 0x1000 && (half & 1))) {
+        ++half;
+    }
+    return half;
+}
+
+float half_to_float(uint16_t h)
+{
+    uint32_t sign = static_cast<uint32_t>(h & 0x8000) << 16;
+    uint32_t exponent = (h >> 10) & 0x1f;
+    uint32_t mantissa = h & 0x3ff;
+    uint32_t x;
+    if (exponent == 0) {
+        if (mantissa == 0) {
+            x = sign;
+        } else {
+            // subnormal, normalize it
+            exponent = 127 - 15 + 1;
+            while (!(mantissa & 0x400)) {
+                mantissa <<= 1;
+                --exponent;
+            }
+            x = sign | (exponent << 23) | ((mantissa & 0x3ff) << 13);
+        }
+    } else if (exponent == 0x1f) {
+        x = sign | 0x7f800000 | (mantissa << 13);
+    } else {
+        x = sign | ((exponent + 127 - 15) << 23) | (mantissa << 13);
+    }
+    float f;
+    memcpy(&f, &x, sizeof(f));
+    return f;
+}
+
+MappedFile::MappedFile(const std::string & filename)
+{
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0) {
+        throw std::runtime_error("could not open " + filename);
+    }
+    struct stat st;
+    fstat(fd, &st);
+    length = st.st_size;
+    void * mapped = mmap(nullptr, length, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (mapped == MAP_FAILED) {
+        throw std::runtime_error("could not map " + filename);
+    }
+    data = static_cast<char*>(mapped);
+}
+
+MappedFile::~MappedFile()
+{
+    munmap(data, length);
+}
+
+void MappedFile::release(const char * start, size_t bytes) const
+{
+    const uintptr_t page = sysconf(_SC_PAGESIZE);
+    uintptr_t first = (reinterpret_cast<uintptr_t>(start) + page - 1) / page * page;
+    uintptr_t last = (reinterpret_cast<uintptr_t>(start) + bytes) / page * page;
+    if (first < last) {
+        madvise(reinterpret_cast<void *>(first), last - first, MADV_DONTNEED);
+    }
 }
 
 RawVector operator-(RawVector l,
@@ -11,6 +11,23 @@
 #include <sstream>
 #include <functional>
 #include <memory>
+#include <queue>
+#include <random>
+#include <unordered_set>
+#include <unordered_map>
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <new>
+#include <string_view>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
+#include <deque>
+#include <list>
+#include <map>
+#include <chrono>
 
 struct WordEmbedding;
 
@@ -18,7 +35,6 @@ typedef std::pair<std::string, std::string> StringPair;
 typedef float WordVecFloat;
 typedef std::vector<WordVecFloat> RawVector;
 typedef std::vector<std::string> StringVector;
-typedef std::vector<WordEmbedding> WordEmbeddingVector;
 typedef std::pair<WordEmbedding, WordVecFloat> ScoredEmbedding;
 typedef std::vector<ScoredEmbedding> ScoredEmbeddings;
 typedef std::pair<std::string, WordVecFloat> ScoredWord;
@@ -79,6 +95,12 @@ public:
     Vector operator() (const Vector & original);
 
     const RawVector & get_comparison_point(void) { return comparison_point_cache; }
+    // The transformer adds to v
+    //   get_step_scale() * (get_translation_term() - v . get_plane_vec()) * get_plane_vec()
+    const RawVector & get_plane_vec(void) const { return plane_vec; }
+    WordVecFloat get_translation_term(void) const { return translation_term; }
+    WordVecFloat get_step_scale(void) const
+        { return (negative ? -projection_factor : projection_factor) / plane_vec_square_sum; }
 };
 
 class LikeUnlikeTransformerChain: public std::vector<LikeUnlikeTransformer> {
@@ -109,21 +131,490 @@ public:
         }
 };
 
+/*
+ * Cosine distances between a comparison point and vectors transformed by a
+ * sequence of LikeUnlikeTransformer steps, without transforming the
+ * vectors. Each step adds a multiple of its plane vector p_k, so the
+ * transformed x is x + sum_k b_k p_k, and the multiples, the dot product
+ * with the comparison point and the norm all follow from the dot products
+ * of x with the plane vectors and the comparison point, given the dot
+ * products between those, which are computed once.
+ */
+class ChainScorer {
+    size_t dimension;
+    RawVector comparison_point;
+    double comparison_point_norm;
+    // Plane vectors one after another, with for each step k its
+    // translation term, step scale, the dot product of its plane vector
+    // with the comparison point, and with the plane vectors of steps 0...k
+    RawVector planes;
+    std::vector<double> translation_terms;
+    std::vector<double> step_scales;
+    std::vector<double> plane_comparison_dots;
+    std::vector<std::vector<double> > plane_dots;
+    // How many times further apart two vectors can be after the steps than
+    // before them
+    double gain;
+    void transform(const WordVecFloat * x, double * multiples,
+                   double & square, double & comparison_dot) const;
+    WordVecFloat distance_of(double square, double comparison_dot) const;
+public:
+    ChainScorer(const RawVector & _comparison_point);
+    ChainScorer(LikeUnlikeTransformerChain & chain);
+    void add_step(const RawVector & plane_vec, WordVecFloat translation_term,
+                  WordVecFloat step_scale);
+    size_t steps(void) const { return translation_terms.size(); }
+    // The distance of x after the steps. multiples needs room for one
+    // number per step.
+    WordVecFloat distance(const WordVecFloat * x, double * multiples) const;
+    // The same, and in bound how much the distance of any vector within
+    // error of x can differ from it
+    WordVecFloat distance(const WordVecFloat * x, double * multiples,
+                          double error, WordVecFloat & bound) const;
+};
+
 class LikeArgs;
+class WordEmbeddings;
+
+typedef std::pair<WordVecFloat, uint32_t> ScoredRow;
+typedef std::vector<ScoredRow> ScoredRows;
+
+/*
+ * A fixed set of worker threads for splitting scans of the vocabulary.
+ * run() may be called from several threads at once; the calling thread
+ * works on its own call's parts too, so it isn't held up by workers busy
+ * with other calls.
+ */
+class ThreadPool {
+    std::vector<std::thread> workers;
+    std::deque<std::function<void (void)> > tasks;
+    std::mutex mutex;
+    std::condition_variable available;
+    bool stopping;
+
+    void work(void);
+public:
+    // threads - 1 workers, the caller of run() being the last thread
+    ThreadPool(size_t threads);
+    ~ThreadPool();
+    ThreadPool(const ThreadPool &) = delete;
+    ThreadPool & operator=(const ThreadPool &) = delete;
+    size_t size(void) const { return workers.size() + 1; }
+    // Call fun(part) for each part in 0...parts - 1, returning when all are
+    // done. An exception from fun is rethrown here.
+    void run(size_t parts, const std::function<void (size_t)> & fun);
+};
+
+// The n lowest scoring rows pushed, kept in a bounded max-heap. Scores are
+// compared together with rows, so ties go to the earlier row.
+class TopRows {
+    size_t n;
+    ScoredRows heap;
+    size_t inserted;
+public:
+    TopRows(size_t _n);
+    void push(WordVecFloat score, uint32_t row);
+    void merge(const TopRows & other);
+    // How many rows have got in, including ones pushed out since
+    size_t get_inserted(void) const { return inserted; }
+    bool full(void) const { return heap.size() == n; }
+    // The highest score kept, when full() a row has to be under it to get in
+    WordVecFloat worst(void) const { return heap.front().first; }
+    // The rows in order of score
+    ScoredRows sorted(void) const;
+};
+
+/*
+ * What a WordEmbeddings has done since instrumentation was turned on or
+ * reset: counts, and nanoseconds spent in each phase of loading and
+ * queries. Scans add to it from several threads.
+ */
+struct Instrumentation {
+    // Rows scored in scans of the vocabulary, once for each query they are
+    // scored for. Approximate index searches aren't counted.
+    std::atomic<uint64_t> vectors_scanned;
+    // Words looked up, and of those, ones not present that were matched by
+    // their longest common prefix or suffix instead
+    std::atomic<uint64_t> lookups;
+    std::atomic<uint64_t> prefix_fallbacks;
+    std::atomic<uint64_t> suffix_fallbacks;
+    // Rows that got into a heap of the best n
+    std::atomic<uint64_t> candidates_inserted;
+    std::atomic<uint64_t> load_time;
+    std::atomic<uint64_t> lookup_time;
+    std::atomic<uint64_t> chain_time;
+    std::atomic<uint64_t> scan_time;
+    std::atomic<uint64_t> conversion_time;
+
+    Instrumentation(void) { reset(); }
+    void reset(void);
+};
+
+// Adds the nanoseconds from its construction to its destruction to total,
+// without looking at the clock if total is nullptr
+class PhaseTimer {
+    std::atomic<uint64_t> * total;
+    std::chrono::steady_clock::time_point start;
+public:
+    PhaseTimer(std::atomic<uint64_t> * _total): total(_total)
+        { if (total) { start = std::chrono::steady_clock::now(); } }
+    ~PhaseTimer()
+        {
+            if (total) {
+                *total += std::chrono::duration_cast<std::chrono::nanoseconds>(
+                    std::chrono::steady_clock::now() - start).count();
+            }
+        }
+    PhaseTimer(const PhaseTimer &) = delete;
+    PhaseTimer & operator=(const PhaseTimer &) = delete;
+};
+
+/*
+ * Results of recent queries by key, the least recently used ones dropped
+ * beyond capacity entries. A capacity of 0 turns it off. Lookups and
+ * insertions may come from several threads at once.
+ */
+class ResultCache {
+    size_t capacity;
+    std::list<std::pair<std::string, ScoredWords> > entries;
+    std::unordered_map<std::string, std::list<std::pair<std::string, ScoredWords> >::iterator> positions;
+    size_t hits;
+    size_t misses;
+    std::mutex mutex;
+public:
+    ResultCache(void): capacity(0), hits(0), misses(0) {}
+    bool enabled(void) const { return capacity > 0; }
+    size_t get_capacity(void) const { return capacity; }
+    void set_capacity(size_t _capacity);
+    // Whether key is present, copying its results to result if it is
+    bool find(const std::string & key, ScoredWords & result);
+    void insert(const std::string & key, const ScoredWords & result);
+    // Drop the entries, keeping the counters
+    void clear(void);
+    void reset_counters(void);
+    size_t get_hits(void);
+    size_t get_misses(void);
+};
+
+/*
+ * A Hierarchical Navigable Small World graph (Malkov & Yashunin 2016) over
+ * the rows of a WordEmbeddings, for approximate nearest neighbour search by
+ * cosine distance. The index only stores the graph, vectors are always
+ * looked up from the WordEmbeddings it was built for.
+ */
+class HnswIndex {
+    size_t M;
+    size_t M0;
+    size_t ef_construction;
+    size_t ef;
+    double level_multiplier;
+    int max_level;
+    uint32_t entry_point;
+    uint64_t fingerprint;
+    std::vector<int> levels;
+    // For each node, the neighbour lists of levels 0...levels[node], each
+    // list being a count followed by room for M0 (level 0) or M neighbours
+    std::vector<std::vector<uint32_t> > links;
+
+    uint32_t * neighbours(uint32_t node, int level);
+    const uint32_t * neighbours(uint32_t node, int level) const;
+    size_t max_neighbours(int level) const { return level == 0 ? M0 : M; }
+    ScoredRows search_layer(const WordEmbeddings & embs,
+                            const Vector & query,
+                            const ScoredRows & entry_points,
+                            size_t ef, int level) const;
+    ScoredRows select_neighbours(const WordEmbeddings & embs,
+                                 ScoredRows candidates, size_t n) const;
+    void connect(const WordEmbeddings & embs, uint32_t node, int level,
+                 const ScoredRows & neighbours);
+
+public:
+    HnswIndex(size_t M = 16, size_t ef_construction = 200);
+    void build(const WordEmbeddings & embs, unsigned int seed = 0);
+    ScoredRows search(const WordEmbeddings & embs, const Vector & query,
+                      size_t n) const;
+    ScoredRows search_radius(const WordEmbeddings & embs, const Vector & query,
+                             WordVecFloat distance) const;
+    void save(const std::string & filename) const;
+    void load(const std::string & filename, const WordEmbeddings & embs);
+    void set_ef(size_t _ef) { ef = _ef; }
+    size_t get_ef(void) const { return ef; }
+    size_t size(void) const { return levels.size(); }
+};
+
+uint64_t vocabulary_fingerprint(const WordEmbeddings & embs);
+
+// Minimum over ranges of a fixed array, in O(log n) per query
+class RangeMinimum {
+    size_t n;
+    std::vector<uint32_t> tree;
+public:
+    RangeMinimum(void): n(0) {}
+    RangeMinimum(const std::vector<uint32_t> & values);
+    // The minimum of values[begin:end], which must not be empty
+    uint32_t operator() (size_t begin, size_t end) const;
+};
+
+// FNV-1a hash of a word, as used for the word slots of snapshot files
+uint64_t word_hash(std::string_view word);
+// An open addressing table of the rows of embs by word_hash() of their
+// words, the first of any duplicates only. The size is a power of two at
+// least twice the number of rows, collisions go to the next slot and empty
+// slots are UINT32_MAX.
+std::vector<uint32_t> make_word_slots(const WordEmbeddings & embs);
+
+/*
+ * Word lookups for WordEmbeddings: a hash table for exact matches, and the
+ * rows sorted by word and by reversed word for finding the longest common
+ * prefix or suffix. The nearest neighbours of a word in sorted order have
+ * the longest common prefix with it, and the words sharing a prefix of a
+ * given length are a contiguous range, so the earliest such row is a range
+ * minimum query. The sorted rows are only built when a word without an
+ * exact match is first looked up.
+ */
+class VocabularyIndex {
+    // From make_word_slots(), either own_slots or mapped from a snapshot
+    std::vector<uint32_t> own_slots;
+    const uint32_t * mapped_slots;
+    size_t slot_mask;
+    mutable std::vector<uint32_t> forward;
+    mutable std::vector<uint32_t> reversed;
+    mutable std::vector<uint32_t> reversed_position;
+    mutable RangeMinimum forward_minimum;
+    mutable RangeMinimum reversed_minimum;
+    std::shared_ptr<std::once_flag> sorted_once;
+
+    const uint32_t * slots(void) const
+        { return mapped_slots ? mapped_slots : own_slots.data(); }
+    void build_sorted(const WordEmbeddings & embs) const;
+    std::pair<size_t, size_t> prefix_range(const WordEmbeddings & embs,
+                                           const std::string & word,
+                                           size_t length) const;
+    std::pair<size_t, size_t> suffix_range(const WordEmbeddings & embs,
+                                           const std::string & word,
+                                           size_t length) const;
+public:
+    VocabularyIndex(void): mapped_slots(nullptr), slot_mask(0),
+                           sorted_once(std::make_shared<std::once_flag>()) {}
+    void build(const WordEmbeddings & embs);
+    // Use slot_count word slots made by make_word_slots(), which must stay
+    // in place, instead of building them
+    void attach(const uint32_t * slots, size_t slot_count);
+    void clear(void);
+    // Row of an exact match, or -1
+    long find(const WordEmbeddings & embs, std::string_view word) const;
+    // Row of an exact match, or failing that, of the earliest word with the
+    // longest common prefix, or of the earliest word with a longer common
+    // suffix that isn't a prefix of word. -1 if nothing shares a prefix or a
+    // suffix with word. by_suffix, if given, is set to whether the row was
+    // found by its suffix.
+    long find_best(const WordEmbeddings & embs, const std::string & word,
+                   bool * by_suffix = nullptr) const;
+};
+
+uint16_t float_to_half(float f);
+float half_to_float(uint16_t h);
+
+/*
+ * Snapshot files start with this header, followed by the arrays it gives
+ * the byte offsets of, each starting at a multiple of 64 bytes:
+ *
+ *   matrix         rows * row_stride float32, each row padded with zeros
+ *   inverse norms  rows float32, 0.0 for zero vectors
+ *   word offsets   rows + 1 uint64, the word of row i being
+ *                  word_arena[word_offsets[i]:word_offsets[i + 1]]
+ *   word arena     word_arena_size bytes of UTF-8
+ *   word slots     slot_count uint32, as from make_word_slots()
+ *
+ * All numbers are little-endian.
+ */
+struct SnapshotHeader {
+    char magic[8];
+    uint64_t rows;
+    uint64_t dimension;
+    uint64_t row_stride;
+    uint64_t word_arena_size;
+    uint64_t slot_count;
+    uint64_t matrix_offset;
+    uint64_t inverse_norms_offset;
+    uint64_t word_offsets_offset;
+    uint64_t word_arena_offset;
+    uint64_t slots_offset;
+};
+
+// A read-only memory mapping of a whole file
+class MappedFile {
+    char * data;
+    size_t length;
+public:
+    MappedFile(const std::string & filename);
+    ~MappedFile();
+    MappedFile(const MappedFile &) = delete;
+    MappedFile & operator=(const MappedFile &) = delete;
+    const char * begin(void) const { return data; }
+    size_t size(void) const { return length; }
+    // Let the pages wholly within bytes from start go until they are read
+    // again
+    void release(const char * start, size_t bytes) const;
+};
+
+/*
+ * Compact copies of the vectors for scanning, either as float16 or as int8
+ * with a scale per vector. For each row the norm of the original vector and
+ * a bound on the relative error of the compact one are kept, so that scans
+ * can tell which rows might still make it after rescoring in full
+ * precision: for a unit length query, the cosine distance computed from the
+ * compact vector differs from the exact one by at most the error bound.
+ */
+class QuantizedVectors {
+public:
+    enum Mode { Float16, Int8 };
+private:
+    Mode mode;
+    size_t dimension;
+    std::vector<uint16_t> halves;
+    std::vector<int8_t> bytes;
+    std::vector<WordVecFloat> scales;
+    std::vector<WordVecFloat> norms;
+    std::vector<WordVecFloat> errors;
+public:
+    QuantizedVectors(Mode _mode, size_t _dimension):
+        mode(_mode), dimension(_dimension) {}
+    void reserve(size_t rows);
+    void push_back(const RawVector & v);
+    void dequantize(size_t row, RawVector & out) const;
+    WordVecFloat distance(size_t row, const RawVector & unit_query) const;
+    WordVecFloat error_bound(size_t row) const { return errors[row]; }
+    WordVecFloat row_norm(size_t row) const { return norms[row]; }
+    size_t memory_usage(void) const;
+};
+
+// An allocator aligning vector data to cache lines, so that rows padded to a
+// multiple of the alignment all start on a boundary
+template <typename T> struct AlignedAllocator {
+    typedef T value_type;
+    static constexpr size_t alignment = 64;
+    AlignedAllocator(void) {}
+    template <typename U> AlignedAllocator(const AlignedAllocator<U> &) {}
+    T * allocate(size_t n)
+        { return static_cast<T*>(::operator new(n * sizeof(T), std::align_val_t(alignment))); }
+    void deallocate(T * p, size_t)
+        { ::operator delete(p, std::align_val_t(alignment)); }
+    template <typename U> bool operator==(const AlignedAllocator<U> &) const { return true; }
+    template <typename U> bool operator!=(const AlignedAllocator<U> &) const { return false; }
+};
 
-class WordEmbeddings: public WordEmbeddingVector {
+typedef std::vector<WordVecFloat, AlignedAllocator<WordVecFloat> > AlignedVector;
+
+class WordEmbeddings {
     size_t dimension;
+    // The vectors as one matrix, each row padded with zeros to row_stride
+    // floats so that every row is aligned, the inverse of each row's norm
+    // (0.0 for a zero vector), and the words concatenated in word_arena,
+    // the word of row i being word_arena[word_offsets[i]:word_offsets[i + 1]]
+    size_t row_stride;
+    // Shared with arrays made by vectors() in Python, so it is replaced
+    // rather than changed in place
+    std::shared_ptr<AlignedVector> matrix;
+    std::vector<WordVecFloat> inverse_norms;
+    std::string word_arena;
+    std::vector<uint64_t> word_offsets;
+    // Where the arrays above are read from: the containers themselves, or
+    // the same arrays in a mapped snapshot file
+    std::shared_ptr<MappedFile> snapshot;
+    size_t row_count;
+    const WordVecFloat * matrix_data;
+    const WordVecFloat * inverse_norm_data;
+    const char * word_arena_data;
+    const uint64_t * word_offset_data;
+    std::shared_ptr<HnswIndex> index;
+    bool use_index;
+    std::shared_ptr<QuantizedVectors> quantized;
+    // When the vectors came from a binary file, the file, the offset of
+    // each vector in it and whether it holds float16 components, so that
+    // full precision vectors can be released from memory after quantizing
+    // and read back when needed
+    std::string source_filename;
+    std::vector<size_t> source_offsets;
+    bool source_float16;
+    std::shared_ptr<MappedFile> full_precision_source;
+    VocabularyIndex lookup;
+    std::shared_ptr<ThreadPool> pool;
+    std::shared_ptr<ResultCache> cache;
+    // nullptr unless instrumentation is on
+    std::shared_ptr<Instrumentation> stats;
+
+    // Where a PhaseTimer adds the time of a phase, nullptr when
+    // instrumentation is off
+    std::atomic<uint64_t> * phase_total(std::atomic<uint64_t> Instrumentation::* total) const
+        { return stats ? &((*stats).*total) : nullptr; }
+    void count(std::atomic<uint64_t> Instrumentation::* counter, uint64_t n) const
+        { if (stats) { (*stats).*counter += n; } }
+    // The best rows of several TopRows, in order of score
+    ScoredRows merge_top_rows(std::vector<TopRows> & tops) const;
+
+    // Scans are split into parts of consecutive rows, run on the pool
+    size_t row_parts(void) const;
+    void for_each_row_range(
+        size_t parts,
+        const std::function<void (size_t part, size_t begin, size_t end)> & fun) const;
+    void clear(void);
+    void load_binary(std::shared_ptr<MappedFile> file,
+                     const char * pos,
+                     size_t lexicon_size,
+                     bool float16);
+    void load_text(const std::string & filename,
+                   const char * pos,
+                   const char * end,
+                   size_t lexicon_size);
+    void load_snapshot(std::shared_ptr<MappedFile> file,
+                       std::function<unsigned int (size_t lexicon_size)> limiter);
+    void read_source_row(size_t row, WordVecFloat * v) const;
+    void use_own_arrays(void);
+    void push_row(const std::string & word, const WordVecFloat * v);
+    const WordVecFloat * row_data(size_t row) const { return matrix_data + row * row_stride; }
+    const WordVecFloat * full_precision_row(size_t row, RawVector & buffer) const;
+    WordVecFloat row_distance(size_t row, const WordVecFloat * other,
+                              WordVecFloat other_inverse_norm) const;
+    ScoredRows get_rows_at_distance_under(
+        const std::string & comparison_word,
+        const Vector & comparison_point,
+        WordVecFloat distance,
+        size_t max_hits) const;
+    std::vector<ScoredRows> get_rows_at_distance_under_many(
+        const StringVector & comparison_words,
+        const std::vector<Vector> & comparison_points,
+        WordVecFloat distance,
+        size_t max_hits) const;
+    bool full_precision_released(void) const { return full_precision_source.get() != nullptr; }
+    WordEmbedding embedding_at(size_t row) const;
+    ScoredWords scored_words(const ScoredRows & rows) const;
+    // The results of query(), from and into the cache under key and nwords
+    // when it is on
+    ScoredWords cached_query(const std::string & key,
+                             unsigned int nwords,
+                             const std::function<ScoredWords (void)> & query) const;
+    ScoredRows get_top_n_quantized(
+        const Vector & comparison_point,
+        size_t n) const;
+    ScoredRows get_top_n_in_transformed_space_quantized(
+        size_t n,
+        const ChainScorer & scorer) const;
     
    
-    ScoredEmbeddings get_top_n(
+    ScoredRows get_top_n(
         const Vector & _comparison_point,
         size_t n = 10) const;
 
-    ScoredEmbeddings get_top_n(
+    ScoredRows get_top_n(
         const WordEmbedding & _comparison_point,
         size_t n = 10) const;
 
-    ScoredEmbeddings get_top_n_in_transformed_space(
+    std::vector<ScoredRows> get_top_n(
+        const std::vector<Vector> & comparison_points,
+        size_t n) const;
+
+    ScoredRows get_top_n_in_transformed_space(
         size_t n,
         const RawVector & comparison_point,
         const RawVector & plane_vec,
@@ -142,9 +633,15 @@ class WordEmbeddings: public WordEmbeddingVector {
     ScoredWords get_top_n_words_in_transformed_space(
         size_t n,
         LikeUnlikeTransformerChain transformer) const;
-    ScoredEmbeddings get_top_n_in_transformed_space(
+    ScoredRows get_top_n_in_transformed_space(
         size_t n,
         LikeUnlikeTransformerChain transformer) const;
+    ScoredRows get_top_n_in_transformed_space(
+        size_t n,
+        const ChainScorer & scorer) const;
+    std::vector<ScoredRows> get_top_n_in_transformed_space(
+        size_t n,
+        const std::vector<ChainScorer> & scorers) const;
     
     ScoredWords get_top_n_words(
         const Vector & comparison_point,
@@ -155,14 +652,26 @@ class WordEmbeddings: public WordEmbeddingVector {
         size_t n = 10) const;
 
 public:
-    
+    WordEmbeddings(void): dimension(0), row_stride(0),
+                          matrix(std::make_shared<AlignedVector>()), word_offsets(1, 0),
+                          use_index(true), source_float16(false),
+                          pool(std::make_shared<ThreadPool>(
+                                   std::max(1u, std::thread::hardware_concurrency()))),
+                          cache(std::make_shared<ResultCache>())
+        { use_own_arrays(); }
+
+    // Binary files hold "float32" components, as written by word2vec, or
+    // "float16" ones. Text files are always parsed as decimal numbers.
     void load_from_file(const std::string & filename,
-                        float fraction);
+                        float fraction,
+                        const std::string & datatype = "float32");
     void load_from_file(const std::string & filename,
-                        unsigned int limit = 0);
+                        unsigned int limit = 0,
+                        const std::string & datatype = "float32");
     void load_from_file(
         const std::string & filename,
-        std::function<unsigned int (size_t lexicon_size)> limiter);
+        std::function<unsigned int (size_t lexicon_size)> limiter,
+        const std::string & datatype = "float32");
 
     WordEmbedding get(const std::string & word) const;
     WordEmbedding get_exact(const std::string & word) const;
@@ -171,9 +680,17 @@ public:
     
     WordVecFloat get_distance(const std::string& word1, const std::string& word2) const;
 
+    // Words within distance of comparison_word, closest first, at most
+    // max_hits of them unless it is 0
     ScoredWords get_words_at_distance_under(
         const std::string & comparison_word,
-        WordVecFloat distance) const;
+        WordVecFloat distance,
+        size_t max_hits = 0) const;
+    // The same for each word, in one pass over the vectors
+    std::vector<ScoredWordVector> get_words_at_distance_under_many(
+        const StringVector & comparison_words,
+        WordVecFloat distance,
+        size_t max_hits = 0) const;
 
     ScoredWords like(const std::string & word,
                      unsigned int nwords = 10) const;
@@ -183,6 +700,12 @@ public:
                      WordVecFloat vector_similarity_projection_factor = 1.0) const;
 
     ScoredWords like(LikeArgs args, unsigned int nwords = 10) const;
+    // Distances of words from the comparison point of a Like() query, as
+    // scanning computes them, or with transform_each by moving each vector
+    // with the query's LikeUnlikeTransformerChain, for checking the one
+    // against the other
+    RawVector like_distances(LikeArgs args, const StringVector & words,
+                             bool transform_each) const;
 
     ScoredWords like(const std::string & word1, const std::string & word2,
                      unsigned int nwords = 10, WordVecFloat vector_similarity_projection_factor = 1.0) const;
@@ -190,6 +713,118 @@ public:
     ScoredWords unlike(const std::string & word1, const std::string & word2,
                        unsigned int nwords = 10, WordVecFloat vector_similarity_projection_factor = 1.0) const;
 
+    // Like() for each query, in one pass over the vectors
+    std::vector<ScoredWordVector> like_many(std::vector<LikeArgs> queries,
+                                            unsigned int nwords = 10) const;
+
+    StringVector get_vocabulary(void) const;
+
+    // For array access from Python. The matrix of vectors, dimension
+    // floats per row with rows row_stride floats apart, or nullptr if it
+    // has been released by quantize().
+    const WordVecFloat * vector_data(void) const { return matrix_data; }
+    // What keeps vector_data() valid, whatever is loaded later
+    std::shared_ptr<const void> vector_data_owner(void) const
+        { return snapshot ? std::shared_ptr<const void>(snapshot) : std::shared_ptr<const void>(matrix); }
+    size_t get_dimension(void) const { return dimension; }
+    size_t get_row_stride(void) const { return row_stride; }
+    // Row of word, or -1 if it isn't present
+    long get_row(const std::string & word) const;
+    // The nearest rows to count query vectors laid out one after another,
+    // those of query i going to rows and scores from i * n to (i + 1) * n
+    // where n = rows_size / count
+    void nearest_rows(const WordVecFloat * queries,
+                      size_t count,
+                      size_t query_dimension,
+                      int64_t * rows,
+                      size_t rows_size,
+                      WordVecFloat * scores,
+                      size_t scores_size) const;
+    // The graph of the k nearest neighbours within max_distance of each of
+    // the first top_n rows (all rows if 0) among those rows, in compressed
+    // sparse row form: the neighbours of row i are indices[indptr[i]] to
+    // indices[indptr[i + 1] - 1], closest first, at the same places in
+    // distances. indptr needs room for top_n + 1 entries and the others
+    // for top_n * k. Returns the number of edges.
+    size_t knn_graph(size_t top_n,
+                     size_t k,
+                     WordVecFloat max_distance,
+                     int64_t * indptr,
+                     size_t indptr_size,
+                     int64_t * indices,
+                     size_t indices_size,
+                     WordVecFloat * distances,
+                     size_t distances_size) const;
+
+    // Number of threads used for scanning the vocabulary, by default one
+    // per core. Not to be changed while queries are running.
+    void set_threads(size_t threads);
+    size_t get_threads(void) const { return pool->size(); }
+
+    // Results of up to entries recent like(), unlike() and like_many()
+    // queries are kept and returned again for the same words, arguments
+    // and nwords, by default none. Loading, quantizing and changes to the
+    // index empty the cache. Not to be changed while queries are running.
+    void set_cache_size(size_t entries) { cache->set_capacity(entries); }
+    size_t get_cache_size(void) const { return cache->get_capacity(); }
+    // Queries answered from the cache and queries looked for in it but
+    // not found, since the last clear_cache()
+    size_t get_cache_hits(void) const { return cache->get_hits(); }
+    size_t get_cache_misses(void) const { return cache->get_misses(); }
+    // Drop the cached results and zero the counters
+    void clear_cache(void) { cache->clear(); cache->reset_counters(); }
+
+    // Counters and timers of loading and queries, off by default and
+    // costing nothing then. Turning them on starts from zero.
+    void set_instrumentation(bool enabled);
+    bool instrumentation_enabled(void) const { return stats.get() != nullptr; }
+    // The counters of Instrumentation by name, and its times in seconds
+    // under the phase name with _seconds, eg. scan_seconds. Empty when
+    // instrumentation is off.
+    std::map<std::string, unsigned long long> get_instrumentation_counts(void) const;
+    std::map<std::string, double> get_instrumentation_seconds(void) const;
+    void reset_instrumentation(void) { if (stats) { stats->reset(); } }
+
+    size_t size(void) const { return row_count; }
+    std::string_view word_at(size_t row) const
+        { return std::string_view(word_arena_data + word_offset_data[row],
+                                  word_offset_data[row + 1] - word_offset_data[row]); }
+
+    // Approximate nearest neighbour index, used by like(word) and
+    // get_words_at_distance_under() when present. Like() and Unlike()
+    // between different words always scan the whole vocabulary.
+    void build_index(size_t M = 16, size_t ef_construction = 200,
+                     unsigned int seed = 0);
+    void save_index(const std::string & filename) const;
+    void load_index(const std::string & filename);
+    void drop_index(void) { index.reset(); cache->clear(); }
+    bool has_index(void) const { return index.get() != nullptr; }
+    void set_index_ef(size_t ef);
+    void set_use_index(bool _use_index) { use_index = _use_index; cache->clear(); }
+
+    // Full precision vector of a row and cosine distances to it, reading
+    // the vector back from the embedding file if it has been released
+    Vector row_vector(size_t row) const;
+    WordVecFloat row_distance(size_t row, const Vector & other) const;
+    WordVecFloat row_distance(size_t row, size_t other_row) const;
+
+    // Scan compact "float16" or "int8" copies of the vectors and rescore
+    // in full precision every candidate that the error bounds of the
+    // compact vectors can't rule out, so that results are the same as
+    // without, or go back to scanning full precision vectors with "none".
+    // Full precision vectors loaded from a binary file or a snapshot are
+    // left in the file and read back for rescoring, but those parsed from
+    // a text file have nowhere to be read back from and are kept, so
+    // quantizing them adds to memory use instead.
+    void quantize(const std::string & mode);
+    // Bytes used for vector data
+    size_t vector_memory_usage(void) const;
+
+    // Write the vectors, words and word lookup table as a snapshot file,
+    // which load_from_file() maps and uses as it is, without parsing or
+    // copying. Processes that load the same snapshot share one copy of it
+    // in memory.
+    void save_snapshot(const std::string & filename) const;
 };
 
 struct LikeArgs {
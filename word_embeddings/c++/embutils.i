@@ -1,22 +1,162 @@
 %module embutils
 %{
 #include "embutils.h"
+
+// Releases the GIL for as long as it exists, so that other Python threads
+// can run during long computations
+class GILRelease {
+    PyThreadState * state;
+public:
+    GILRelease(void): state(PyEval_SaveThread()) {}
+    ~GILRelease() { PyEval_RestoreThread(state); }
+};
+
+// Whether a buffer holds native items of the struct module type code with
+// the given size
+static bool buffer_has_type(const Py_buffer & view, const char * codes, size_t itemsize)
+{
+    const char * format = view.format == NULL ? "B" : view.format;
+    if (*format == '@' || *format == '=' || *format == '<') {
+        ++format;
+    }
+    return static_cast<size_t>(view.itemsize) == itemsize &&
+        strlen(format) == 1 && strchr(codes, *format) != NULL;
+}
+
+// A read-only buffer over the vectors of a WordEmbeddings, holding on to
+// the storage they are in, so that arrays made from it stay valid when the
+// embeddings are loaded again or quantized
+struct VectorExport {
+    PyObject_HEAD
+    std::shared_ptr<const void> * owner;
+    const WordVecFloat * data;
+    Py_ssize_t shape[2];
+    Py_ssize_t strides[2];
+};
+
+static int vector_export_getbuffer(PyObject * self, Py_buffer * view, int flags)
+{
+    VectorExport * exported = reinterpret_cast<VectorExport *>(self);
+    bool contiguous = exported->strides[0] ==
+        exported->shape[1] * static_cast<Py_ssize_t>(sizeof(WordVecFloat));
+    view->obj = NULL;
+    if ((flags & PyBUF_WRITABLE) == PyBUF_WRITABLE) {
+        PyErr_SetString(PyExc_BufferError, "the vectors are read-only");
+        return -1;
+    }
+    if ((flags & PyBUF_STRIDES) != PyBUF_STRIDES && !contiguous) {
+        PyErr_SetString(PyExc_BufferError, "the rows of the vectors are padded, strides are needed");
+        return -1;
+    }
+    view->obj = self;
+    Py_INCREF(self);
+    view->buf = const_cast<WordVecFloat *>(exported->data);
+    view->len = exported->shape[0] * exported->shape[1] * sizeof(WordVecFloat);
+    view->readonly = 1;
+    view->itemsize = sizeof(WordVecFloat);
+    view->format = (flags & PyBUF_FORMAT) == PyBUF_FORMAT ? const_cast<char *>("f") : NULL;
+    view->ndim = (flags & PyBUF_ND) == PyBUF_ND ? 2 : 1;
+    view->shape = (flags & PyBUF_ND) == PyBUF_ND ? exported->shape : NULL;
+    view->strides = (flags & PyBUF_STRIDES) == PyBUF_STRIDES ? exported->strides : NULL;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+    return 0;
+}
+
+static void vector_export_dealloc(PyObject * self)
+{
+    delete reinterpret_cast<VectorExport *>(self)->owner;
+    PyTypeObject * type = Py_TYPE(self);
+    type->tp_free(self);
+    Py_DECREF(type);
+}
+
+static PyType_Slot vector_export_slots[] = {
+    {Py_bf_getbuffer, reinterpret_cast<void *>(vector_export_getbuffer)},
+    {Py_tp_dealloc, reinterpret_cast<void *>(vector_export_dealloc)},
+    {0, NULL}
+};
+
+static PyType_Spec vector_export_spec = {
+    "embutils._VectorExport", sizeof(VectorExport), 0, Py_TPFLAGS_DEFAULT, vector_export_slots
+};
+
+static PyTypeObject * vector_export_type = NULL;
+%}
+
+%init %{
+    vector_export_type = reinterpret_cast<PyTypeObject *>(PyType_FromSpec(&vector_export_spec));
 %}
 
 typedef float WordVecFloat;
 typedef std::pair<std::string, WordVecFloat> ScoredWord;
 typedef std::vector<ScoredWord> ScoredWords;
+typedef std::vector<ScoredWord> ScoredWordVector;
 typedef std::vector<WordVecFloat> RawVector;
 typedef std::pair<std::string, RawVector> WordWithVector;
+typedef std::vector<std::string> StringVector;
 
 %include <std_string.i>
 %include <std_vector.i>
 %include <std_pair.i>
+%include <std_map.i>
 %include <exception.i>
 %template(ScoredWord) std::pair<std::string, float>;
 %template(ScoredWords) std::vector<ScoredWord>;
 %template(RawVector) std::vector<WordVecFloat>;
 %template(WordWithVector) std::pair<std::string, RawVector>;
+%template(StringVector) std::vector<std::string>;
+%template(InstrumentationCounts) std::map<std::string, unsigned long long>;
+%template(InstrumentationSeconds) std::map<std::string, double>;
+
+// Arrays are passed in through the buffer protocol without copying: query
+// vectors as a C-contiguous float32 vector or matrix, and results into
+// writable int64 and float32 arrays
+%typemap(in) (const WordVecFloat * queries, size_t count, size_t query_dimension) (Py_buffer view = Py_buffer()) {
+    if (PyObject_GetBuffer($input, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+        SWIG_fail;
+    }
+    if (!buffer_has_type(view, "f", sizeof(WordVecFloat)) || view.ndim < 1 || view.ndim > 2) {
+        SWIG_exception_fail(SWIG_TypeError, "expected a float32 vector or matrix");
+    }
+    $1 = static_cast<WordVecFloat *>(view.buf);
+    $2 = view.ndim == 2 ? view.shape[0] : 1;
+    $3 = view.shape[view.ndim - 1];
+}
+%typemap(freearg) (const WordVecFloat * queries, size_t count, size_t query_dimension) {
+    if (view$argnum.obj != NULL) { PyBuffer_Release(&view$argnum); }
+}
+%typemap(in) (int64_t * rows, size_t rows_size) (Py_buffer view = Py_buffer()) {
+    if (PyObject_GetBuffer($input, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | PyBUF_WRITABLE) != 0) {
+        SWIG_fail;
+    }
+    if (!buffer_has_type(view, "lq", sizeof(int64_t))) {
+        SWIG_exception_fail(SWIG_TypeError, "expected a writable int64 array");
+    }
+    $1 = static_cast<int64_t *>(view.buf);
+    $2 = view.len / view.itemsize;
+}
+%typemap(freearg) (int64_t * rows, size_t rows_size) {
+    if (view$argnum.obj != NULL) { PyBuffer_Release(&view$argnum); }
+}
+%typemap(in) (WordVecFloat * scores, size_t scores_size) (Py_buffer view = Py_buffer()) {
+    if (PyObject_GetBuffer($input, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | PyBUF_WRITABLE) != 0) {
+        SWIG_fail;
+    }
+    if (!buffer_has_type(view, "f", sizeof(WordVecFloat))) {
+        SWIG_exception_fail(SWIG_TypeError, "expected a writable float32 array");
+    }
+    $1 = static_cast<WordVecFloat *>(view.buf);
+    $2 = view.len / view.itemsize;
+}
+%typemap(freearg) (WordVecFloat * scores, size_t scores_size) {
+    if (view$argnum.obj != NULL) { PyBuffer_Release(&view$argnum); }
+}
+%apply (int64_t * rows, size_t rows_size) {
+    (int64_t * indptr, size_t indptr_size),
+    (int64_t * indices, size_t indices_size)
+};
+%apply (WordVecFloat * scores, size_t scores_size) { (WordVecFloat * distances, size_t distances_size) };
 
 %exception {
     try { $action } catch (std::runtime_error & e) {
@@ -25,6 +165,28 @@ typedef std::pair<std::string, RawVector> WordWithVector;
     }
  }
 
+// Methods that only touch C++ data run without the GIL. Arguments are
+// converted before and results after, with the GIL held.
+%define WITHOUT_GIL(method)
+%exception method {
+    try { GILRelease release; $action } catch (std::runtime_error & e) {
+        std::string s(e.what());
+        SWIG_exception(SWIG_RuntimeError, s.c_str());
+    }
+ }
+%enddef
+
+WITHOUT_GIL(WordEmbeddings::load_from_file)
+WITHOUT_GIL(WordEmbeddings::like)
+WITHOUT_GIL(WordEmbeddings::unlike)
+WITHOUT_GIL(WordEmbeddings::like_many)
+WITHOUT_GIL(WordEmbeddings::get_words_at_distance_under)
+WITHOUT_GIL(WordEmbeddings::get_words_at_distance_under_many)
+WITHOUT_GIL(WordEmbeddings::build_index)
+WITHOUT_GIL(WordEmbeddings::nearest_rows)
+WITHOUT_GIL(WordEmbeddings::knn_graph)
+WITHOUT_GIL(WordEmbeddings::save_snapshot)
+
 class LikeArgs {
     /* bool negative; */
     /* WordVecFloat projection_factor; */
@@ -46,11 +208,26 @@ public:
     /* LikeUnlikeTransformerChain get_transformer_chain(void); */
 };
 
+%template(LikeArgsVector) std::vector<LikeArgs>;
+%template(ScoredWordsVector) std::vector<ScoredWordVector>;
+
+// get_words_at_distance_under_many() takes any sequence of words, and
+// like_many() takes LikeArgs or (word1, word2[, negative[, projection
+// factor]]) tuples from Python
+%rename(_like_many) WordEmbeddings::like_many;
+%rename(_get_words_at_distance_under_many) WordEmbeddings::get_words_at_distance_under_many;
+%rename(_nearest_rows) WordEmbeddings::nearest_rows;
+%rename(_knn_graph) WordEmbeddings::knn_graph;
+%rename(_get_instrumentation_counts) WordEmbeddings::get_instrumentation_counts;
+%rename(_get_instrumentation_seconds) WordEmbeddings::get_instrumentation_seconds;
+
 struct WordEmbeddings {
     void load_from_file(const std::string & filename,
-                        unsigned int limit = 0);
+                        unsigned int limit = 0,
+                        const std::string & datatype = "float32");
     void load_from_file(const std::string & filename,
-                        float fraction);
+                        float fraction,
+                        const std::string & datatype = "float32");
     ScoredWords like(const std::string & word,
                      unsigned int nwords = 10) const;
     
@@ -60,17 +237,179 @@ struct WordEmbeddings {
         const;
 
     ScoredWords like(LikeArgs args, unsigned int nwords = 10) const;
+    RawVector like_distances(LikeArgs args, const StringVector & words,
+                             bool transform_each) const;
     
     ScoredWords unlike(const std::string & word1, const std::string & word2,
                        unsigned int nwords = 10,
                        WordVecFloat vector_similarity_projection_factor = 1.0)
         const;
 
+    std::vector<ScoredWordVector> like_many(std::vector<LikeArgs> queries,
+                                            unsigned int nwords = 10) const;
+
     ScoredWords get_words_at_distance_under(
         const std::string & comparison_word,
-        WordVecFloat distance) const;
+        WordVecFloat distance,
+        size_t max_hits = 0) const;
+
+    std::vector<ScoredWordVector> get_words_at_distance_under_many(
+        const StringVector & comparison_words,
+        WordVecFloat distance,
+        size_t max_hits = 0) const;
     
     WordVecFloat get_distance(const std::string& word1, const std::string& word2) const;
     
     WordWithVector get_embedding(const std::string & word) const;
+
+    StringVector get_vocabulary(void) const;
+    size_t size(void) const;
+    size_t get_dimension(void) const;
+    size_t get_row_stride(void) const;
+    long get_row(const std::string & word) const;
+
+    void nearest_rows(const WordVecFloat * queries,
+                      size_t count,
+                      size_t query_dimension,
+                      int64_t * rows,
+                      size_t rows_size,
+                      WordVecFloat * scores,
+                      size_t scores_size) const;
+
+    size_t knn_graph(size_t top_n,
+                     size_t k,
+                     WordVecFloat max_distance,
+                     int64_t * indptr,
+                     size_t indptr_size,
+                     int64_t * indices,
+                     size_t indices_size,
+                     WordVecFloat * distances,
+                     size_t distances_size) const;
+
+    void build_index(size_t M = 16, size_t ef_construction = 200,
+                     unsigned int seed = 0);
+    void save_index(const std::string & filename) const;
+    void load_index(const std::string & filename);
+    void drop_index(void);
+    bool has_index(void) const;
+    void set_index_ef(size_t ef);
+    void set_use_index(bool _use_index);
+
+    void quantize(const std::string & mode);
+    size_t vector_memory_usage(void) const;
+    void save_snapshot(const std::string & filename) const;
+
+    void set_threads(size_t threads);
+    size_t get_threads(void) const;
+
+    void set_cache_size(size_t entries);
+    size_t get_cache_size(void) const;
+    size_t get_cache_hits(void) const;
+    size_t get_cache_misses(void) const;
+    void clear_cache(void);
+
+    void set_instrumentation(bool enabled);
+    bool instrumentation_enabled(void) const;
+    std::map<std::string, unsigned long long> get_instrumentation_counts(void) const;
+    std::map<std::string, double> get_instrumentation_seconds(void) const;
+    void reset_instrumentation(void);
 };
+
+%extend WordEmbeddings {
+PyObject * _vector_buffer(void) const {
+    if ($self->vector_data() == nullptr && $self->size() > 0) {
+        throw std::runtime_error("full precision vectors have been released by quantize()");
+    }
+    static const WordVecFloat empty = 0.0;
+    VectorExport * exported = PyObject_New(VectorExport, vector_export_type);
+    if (exported == NULL) {
+        return NULL;
+    }
+    exported->owner = new std::shared_ptr<const void>($self->vector_data_owner());
+    exported->data = $self->size() > 0 ? $self->vector_data() : &empty;
+    exported->shape[0] = $self->size();
+    exported->shape[1] = $self->get_dimension();
+    exported->strides[0] = $self->get_row_stride() * sizeof(WordVecFloat);
+    exported->strides[1] = sizeof(WordVecFloat);
+    return reinterpret_cast<PyObject *>(exported);
+}
+std::string _word_at(size_t row) const {
+    if (row >= $self->size()) {
+        throw std::runtime_error("row " + std::to_string(row) + " out of range");
+    }
+    return std::string($self->word_at(row));
+}
+%pythoncode %{
+def like_many(self, queries, nwords=10):
+    args = LikeArgsVector()
+    for query in queries:
+        if not isinstance(query, LikeArgs):
+            query = tuple(query)
+            query = LikeArgs(*(query + (False, 1.0)[len(query) - 2:]))
+        args.append(query)
+    return list(self._like_many(args, nwords))
+
+def get_words_at_distance_under_many(self, comparison_words, distance, max_hits=0):
+    return list(self._get_words_at_distance_under_many(
+        StringVector(list(comparison_words)), distance, max_hits))
+
+def vectors(self):
+    """
+    The vectors as a read-only (size, dimension) float32 NumPy array
+    sharing memory with the embeddings. It holds on to that memory, so it
+    keeps the vectors it was made with when the embeddings are loaded
+    again or quantized.
+    """
+    import numpy
+    return numpy.asarray(self._vector_buffer())
+
+def nearest(self, queries, n=10):
+    """
+    The n nearest rows to a query vector or to each row of a matrix of
+    them, as arrays of rows and of cosine distances. Rows missing when
+    there are fewer than n are -1.
+    """
+    import numpy
+    queries = numpy.ascontiguousarray(queries, dtype=numpy.float32)
+    batch = queries.reshape(-1, queries.shape[-1])
+    rows = numpy.empty((len(batch), n), dtype=numpy.int64)
+    scores = numpy.empty((len(batch), n), dtype=numpy.float32)
+    self._nearest_rows(batch, rows, scores)
+    if queries.ndim == 1:
+        return rows[0], scores[0]
+    return rows, scores
+
+def knn_graph(self, top_n_words=0, k=10, max_distance=2.0):
+    """
+    The k nearest neighbours within max_distance of each of the first
+    top_n_words words (all words if 0) among those words, as the indptr,
+    indices and distances arrays of a sparse matrix in compressed sparse
+    row form, for example scipy.sparse.csr_matrix((distances, indices,
+    indptr)). Each row has its neighbours closest first.
+    """
+    import numpy
+    nodes = self.size() if top_n_words == 0 else min(top_n_words, self.size())
+    indptr = numpy.empty(nodes + 1, dtype=numpy.int64)
+    indices = numpy.empty(nodes * k, dtype=numpy.int64)
+    distances = numpy.empty(nodes * k, dtype=numpy.float32)
+    edges = self._knn_graph(nodes, k, max_distance, indptr, indices, distances)
+    return indptr, indices[:edges].copy(), distances[:edges].copy()
+
+def get_instrumentation(self):
+    """
+    The counters (as ints) and phase times (in seconds) collected since
+    set_instrumentation(True) or reset_instrumentation(), as a dict, which
+    is empty when instrumentation is off.
+    """
+    retval = dict(self._get_instrumentation_counts())
+    retval.update(self._get_instrumentation_seconds())
+    return retval
+
+def words_at(self, rows):
+    return [None if row < 0 else self._word_at(int(row)) for row in rows]
+
+def rows_of(self, words):
+    import numpy
+    return numpy.array([self.get_row(word) for word in words], dtype=numpy.int64)
+%}
+}
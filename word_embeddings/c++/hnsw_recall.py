@@ -0,0 +1,59 @@
+import argparse
+import random
+import time
+import embutils
+
+parser = argparse.ArgumentParser(description = "Measure the recall and speed of the approximate nearest neighbour index against exhaustive search.")
+parser.add_argument('embedding_file', action='store')
+parser.add_argument('--cutoff', action='store', help='Only consider most common N or N%% of words')
+parser.add_argument('--index', metavar = 'FILENAME', action='store', default=None, help='Load the index from this file if it exists, otherwise build it and save it here')
+parser.add_argument('--M', type=int, default=16, help='Neighbours per node in the index graph (default: 16)')
+parser.add_argument('--ef-construction', type=int, default=200, help='Search width when building the index (default: 200)')
+parser.add_argument('--ef', type=str, default='10,20,50,100,200,400', help='Comma-separated search widths to evaluate (default: 10,20,50,100,200,400)')
+parser.add_argument('--n-closest', type=int, default=10, help='Number of neighbours per query (default: 10)')
+parser.add_argument('--queries', type=int, default=1000, help='Number of query words (default: 1000)')
+parser.add_argument('--seed', type=int, default=0, help='Random seed for choosing query words (default: 0)')
+
+args = parser.parse_args()
+if args.cutoff is None:
+    cutoff = 0
+elif args.cutoff.endswith('%'):
+    cutoff = float(args.cutoff[:-1]) * 0.01
+else:
+    cutoff = int(args.cutoff)
+
+first = lambda x: x[0]
+
+vecs = embutils.WordEmbeddings()
+vecs.load_from_file(args.embedding_file, cutoff)
+vocabulary = vecs.get_vocabulary()
+random.seed(args.seed)
+queries = random.sample(list(vocabulary), min(args.queries, len(vocabulary)))
+
+t = time.time()
+try:
+    if args.index is None:
+        raise RuntimeError
+    vecs.load_index(args.index)
+    print("loaded index in {:.2f} s".format(time.time() - t))
+except RuntimeError:
+    vecs.build_index(args.M, args.ef_construction)
+    print("built index in {:.2f} s".format(time.time() - t))
+    if args.index is not None:
+        vecs.save_index(args.index)
+
+vecs.set_use_index(False)
+t = time.time()
+exact = [set(map(first, vecs.like(word, args.n_closest))) for word in queries]
+exact_time = time.time() - t
+print("exact\t\trecall 1.0000\t{:.2f} queries/s".format(len(queries) / exact_time))
+
+vecs.set_use_index(True)
+for ef in map(int, args.ef.split(',')):
+    vecs.set_index_ef(ef)
+    t = time.time()
+    approximate = [set(map(first, vecs.like(word, args.n_closest))) for word in queries]
+    elapsed = time.time() - t
+    hits = sum(len(a & e) for a, e in zip(approximate, exact))
+    recall = hits / sum(map(len, exact))
+    print("ef {}\t\trecall {:.4f}\t{:.2f} queries/s".format(ef, recall, len(queries) / elapsed))
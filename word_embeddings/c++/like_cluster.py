@@ -36,11 +36,11 @@ associations = {}
 
 groups[clusterword] = words
 groups_with_weights[clusterword] = words_with_weights
-for word2 in words:
-    if word2 != clusterword:
-        clusterwords_with_weights = vecs.like(clusterword, word2, nwords, similarityfactor)
-        groups[word2] = get_words(clusterwords_with_weights)
-        groups_with_weights[word2] = clusterwords_with_weights
+neighbours = [word2 for word2 in words if word2 != clusterword]
+like_lists = vecs.like_many([(clusterword, word2, False, similarityfactor) for word2 in neighbours], nwords)
+for word2, clusterwords_with_weights in zip(neighbours, like_lists):
+    groups[word2] = get_words(clusterwords_with_weights)
+    groups_with_weights[word2] = clusterwords_with_weights
 
 for key in groups:
     associations[key] = {}
@@ -1,8 +1,13 @@
+import os
+import sys
 import argparse
 import embutils
 
-parser = argparse.ArgumentParser(description = "Print the members of a Like() or Unlike() group.")
-parser.add_argument('word1', action='store')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import word2vec
+
+parser = argparse.ArgumentParser(description = "Print the members of a Like() or Unlike() group, or of one group per line of --queries.")
+parser.add_argument('word1', action='store', nargs='?', default = None)
 parser.add_argument('word2', action='store', nargs='?', default = None)
 parser.add_argument('--embedding-file', '-f', metavar = 'FILENAME', action='store', help='File to read the word embeddings from')
 parser.add_argument('-u', action='store_true', default=False, help='Unlike() instead of Like()')
@@ -12,8 +17,14 @@ parser.add_argument('--compare-implementations', action='store_true', default=Fa
 parser.add_argument('--n-closest', type=int, default=20 , help='number of group members (default: 20)')
 parser.add_argument('--projection-factor', type=float, default=1.0 , help='projection factor, 1.0 is full projection (default: 1.0)')
 parser.add_argument('--cutoff', action='store', help='Only consider most common N or N%% of words')
+parser.add_argument('--queries', metavar = 'FILENAME', action='store', default=None, help='Answer queries from this file, - for STDIN, one per line as: word1 [word2] [-u] [n] [projection factor]')
+parser.add_argument('--format', action='store', default='tsv', choices=['tsv', 'jsonl'], help='Output of --queries: a query, word, distance line per group member, or a JSON object per query (default: tsv)')
+parser.add_argument('--workers', type=int, default=1, help='Threads answering --queries, the output stays in query order (default: 1)')
+parser.add_argument('--datatype', action='store', default='float32', choices=['float32', 'float16'], help='Type of the vector components in a binary embedding file (default: float32)')
 
 args = parser.parse_args()
+if (args.word1 is None) == (args.queries is None):
+    parser.error("give either word1 or --queries")
 wordvecfilename = args.embedding_file
 similarityfactor = args.projection_factor
 nwords = args.n_closest
@@ -25,7 +36,7 @@ else:
     cutoff = int(args.cutoff)
 
 vecs = embutils.WordEmbeddings()
-vecs.load_from_file(wordvecfilename, cutoff)
+vecs.load_from_file(wordvecfilename, cutoff, args.datatype)
 
 first = lambda x: x[0]
 second = lambda x: x[1]
@@ -45,6 +56,19 @@ def alternate_unlike():
         if vecs.get_distance(args.word2, word[0]) > word[1]:
             result.append(word)
     return result
+def like(word1, word2, negative, n, factor):
+    if word1 == word2 and not negative:
+        return vecs.like(word1, n)
+    elif negative:
+        return vecs.unlike(word1, word2, n, factor)
+    return vecs.like(word1, word2, n, factor)
+
+if args.queries is not None:
+    answers = word2vec.answer_like_queries(word2vec.read_query_lines(args.queries), like,
+                                           nwords, similarityfactor, args.workers)
+    word2vec.write_like_answers(answers, args.format)
+    sys.exit(0)
+
 if args.word2 is None:
     args.word2 = args.word1
 if args.word1 == args.word2:
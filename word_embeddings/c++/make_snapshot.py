@@ -0,0 +1,20 @@
+import argparse
+import embutils
+
+parser = argparse.ArgumentParser(description = "Convert a word embedding file into a snapshot file, which embutils and word2vec.VecReader map into memory and use without parsing. The word embedding file can be in binary or text format.")
+parser.add_argument('embedding_file', action='store')
+parser.add_argument('snapshot_file', action='store')
+parser.add_argument('--cutoff', action='store', help='Only keep most common N or N%% of words')
+parser.add_argument('--datatype', action='store', default='float32', choices=['float32', 'float16'], help='Type of the vector components in a binary embedding file (default: float32)')
+
+args = parser.parse_args()
+if args.cutoff is None:
+    cutoff = 0
+elif args.cutoff.endswith('%'):
+    cutoff = float(args.cutoff[:-1]) * 0.01
+else:
+    cutoff = int(args.cutoff)
+
+vecs = embutils.WordEmbeddings()
+vecs.load_from_file(args.embedding_file, cutoff, args.datatype)
+vecs.save_snapshot(args.snapshot_file)
@@ -1,5 +1,15 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
 import unittest
+import numpy
 import embutils
+import benchmark
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import word2vec
 
 embeddings_filename = "/srv/data/word2vec/GoogleNews-vectors-negative300.bin"
 cutoff = 100000
@@ -56,6 +66,458 @@ class BasicLikeUnlike(ResultAssert, unittest.TestCase):
         like_args = embutils.LikeArgs(embutils.LikeArgs("mouse", "keyboard", False), embutils.LikeArgs("screen"), True)
         self.assert_results_almost_equal(self.embs.like(like_args), correct)
 
-        
+class SyntheticFile:
+    # A file generated like the benchmark's in a temporary directory, with
+    # its vectors in double precision for brute force checks
+    n_words = 2000
+    dimension = 50
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        cls.filename = os.path.join(cls.data_dir, "synthetic.bin")
+        cls.words = benchmark.write_synthetic(cls.filename, cls.n_words, cls.dimension, 0, True)
+        embs = embutils.WordEmbeddings()
+        embs.load_from_file(cls.filename)
+        cls.vectors = numpy.array(embs.vectors(), dtype=numpy.float64)
+        cls.rows = {word: row for row, word in enumerate(cls.words)}
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+def brute_force_distances(vectors, point):
+    # Cosine distances of all vectors from point in double precision
+    point = numpy.asarray(point, dtype=numpy.float64)
+    cosines = vectors @ point / (numpy.linalg.norm(vectors, axis=1) * numpy.linalg.norm(point))
+    return numpy.maximum(0.0, 1.0 - cosines)
+
+def brute_force_like(vectors, first_point, second_point, negative, projection_factor):
+    # Cosine distances of all vectors from the comparison point of Like() or
+    # Unlike(), moving every vector explicitly in double precision
+    vectors = numpy.asarray(vectors, dtype=numpy.float64)
+    first_point = numpy.asarray(first_point, dtype=numpy.float64)
+    second_point = numpy.asarray(second_point, dtype=numpy.float64)
+    plane_vec = first_point - second_point
+    square_sum = plane_vec @ plane_vec
+    translation_term = plane_vec @ first_point - 0.5 * square_sum
+    if negative:
+        comparison_point = first_point + 0.5 * projection_factor * plane_vec
+        step_scale = -projection_factor / square_sum
+    else:
+        comparison_point = second_point + 0.5 * plane_vec
+        step_scale = projection_factor / square_sum
+    moved = vectors + (step_scale * (translation_term - vectors @ plane_vec))[:, None] * plane_vec
+    cosines = moved @ comparison_point / (numpy.linalg.norm(moved, axis=1) * numpy.linalg.norm(comparison_point))
+    return 1.0 - cosines
+
+class BruteForceAssert(ResultAssert):
+    def assert_brute_force(self, results, distances, n=10):
+        # results are the n closest (word, distance) closest first by the
+        # distances of all words, near ties in any order
+        self.assertEqual(len(results), min(n, len(distances)))
+        for (word, distance), best in zip(results, numpy.sort(distances)[:n]):
+            self.assertAlmostEqual(distance, best, places=5)
+            self.assertAlmostEqual(distance, distances[self.rows[word]], places=5)
+    def assert_like_brute_force(self, results, word1, word2, negative=False, factor=1.0, n=10):
+        self.assert_brute_force(results, brute_force_like(self.vectors, self.vectors[self.rows[word1]],
+                                                          self.vectors[self.rows[word2]], negative, factor), n)
+
+class SyntheticLikeUnlike(SyntheticFile, BruteForceAssert, unittest.TestCase):
+    def setUp(self):
+        self.embs = embutils.WordEmbeddings()
+        self.embs.load_from_file(self.filename)
+    def test_one_arg(self):
+        word = self.words[3]
+        self.assert_brute_force(self.embs.like(word), brute_force_distances(self.vectors, self.vectors[3]))
+    def test_two_args(self):
+        w = self.words
+        self.assert_like_brute_force(self.embs.like(w[0], w[1]), w[0], w[1])
+        self.assert_like_brute_force(self.embs.unlike(w[0], w[1], 10), w[0], w[1], True)
+        self.assert_like_brute_force(self.embs.unlike(w[2], w[3], 15, 0.5), w[2], w[3], True, 0.5, 15)
+        self.assert_like_brute_force(self.embs.like(embutils.LikeArgs(w[4], w[5], False, 0.7)),
+                                     w[4], w[5], False, 0.7)
+    def test_like_many(self):
+        w = self.words
+        queries = [(w[0], w[1], False, 1.0), (w[0], w[1], True, 0.5), (w[2], w[3])]
+        many = self.embs.like_many(queries, 5)
+        self.assertEqual(len(many), len(queries))
+        self.assert_results_almost_equal(many[0], self.embs.like(w[0], w[1], 5))
+        self.assert_results_almost_equal(many[1], self.embs.unlike(w[0], w[1], 5, 0.5))
+        self.assert_results_almost_equal(many[2], self.embs.like(w[2], w[3], 5))
+        self.assert_like_brute_force(many[1], w[0], w[1], True, 0.5, 5)
+    def test_cache(self):
+        w = self.words
+        self.embs.set_cache_size(10)
+        first = self.embs.unlike(w[0], w[1], 5, 0.5)
+        again = self.embs.like(embutils.LikeArgs(w[0], w[1], True, 0.5), 5)
+        self.assertEqual(tuple(first), tuple(again))
+        self.assertEqual((self.embs.get_cache_hits(), self.embs.get_cache_misses()), (1, 1))
+        self.embs.like(w[0], w[1], 5)
+        self.assertEqual(self.embs.get_cache_misses(), 2)
+    def test_instrumentation(self):
+        self.assertEqual(self.embs.get_instrumentation(), {})
+        self.embs.set_instrumentation(True)
+        self.embs.like(self.words[0], self.words[1], 5)
+        stats = self.embs.get_instrumentation()
+        self.assertEqual(stats["lookups"], 2)
+        self.assertIsInstance(stats["lookups"], int)
+        self.assertEqual(stats["vectors_scanned"], self.n_words)
+        self.assertGreater(stats["scan_seconds"], 0)
+        self.embs.reset_instrumentation()
+        self.assertEqual(self.embs.get_instrumentation()["lookups"], 0)
+    def test_distance_under_many(self):
+        words = self.words[:3]
+        many = self.embs.get_words_at_distance_under_many(words, 0.5)
+        for word, hits in zip(words, many):
+            self.assert_results_almost_equal(hits, self.embs.get_words_at_distance_under(word, 0.5))
+            distances = brute_force_distances(self.vectors, self.vectors[self.rows[word]])
+            # Leaving out anything too close to the limit to call
+            expected = {self.words[row] for row in numpy.flatnonzero(distances < 0.5 - 1e-5)} - {word}
+            uncertain = {self.words[row] for row in numpy.flatnonzero(abs(distances - 0.5) <= 1e-5)}
+            self.assertEqual({w for w, _ in hits} - uncertain, expected)
+            for hit, distance in hits:
+                self.assertAlmostEqual(distance, distances[self.rows[hit]], places=5)
+        capped = self.embs.get_words_at_distance_under_many(words, 0.5, 3)
+        for hits, capped_hits in zip(many, capped):
+            self.assert_results_almost_equal(capped_hits, hits[:3])
+    def test_nearest_vectors(self):
+        queries = self.vectors[[3, 7]].astype(numpy.float32) * 2
+        nearest, scores = self.embs.nearest(queries, 10)
+        for i, query in enumerate(queries):
+            self.assert_brute_force(list(zip(self.embs.words_at(nearest[i]), scores[i])),
+                                    brute_force_distances(self.vectors, query))
+
+class QuantizedLikeUnlike(SyntheticLikeUnlike):
+    def setUp(self):
+        super().setUp()
+        self.embs.quantize("int8")
+
+class Float16LikeUnlike(SyntheticLikeUnlike):
+    def setUp(self):
+        super().setUp()
+        self.embs.quantize("float16")
+
+class ThreadedLikeUnlike(SyntheticLikeUnlike):
+    def setUp(self):
+        super().setUp()
+        self.embs.set_threads(4)
+
+class ArrayAccess(SyntheticFile, BruteForceAssert, unittest.TestCase):
+    def setUp(self):
+        self.embs = embutils.WordEmbeddings()
+        self.embs.load_from_file(self.filename)
+    def test_vectors(self):
+        vectors = self.embs.vectors()
+        self.assertEqual(vectors.shape, (self.n_words, self.dimension))
+        word = self.words[3]
+        row = self.embs.rows_of([word])[0]
+        self.assertEqual(row, 3)
+        self.assertEqual(self.embs.words_at([row]), [word])
+        self.assertEqual(list(vectors[row]), list(self.embs.get_embedding(word)[1]))
+    def test_vectors_after_reload(self):
+        vectors = self.embs.vectors()
+        before = vectors[:10].copy()
+        self.embs.load_from_file(self.filename, 500)
+        self.assertEqual(vectors.tolist()[:10], before.tolist())
+        self.assertEqual(self.embs.vectors().shape[0], 500)
+    def test_knn_graph(self):
+        nodes, k, max_distance = 500, 9, 0.3
+        indptr, indices, distances = self.embs.knn_graph(nodes, k, max_distance)
+        self.assertEqual(len(indptr), nodes + 1)
+        for node in range(nodes):
+            brute_force = brute_force_distances(self.vectors[:nodes], self.vectors[node])
+            brute_force[node] = numpy.inf
+            expected = numpy.sort(brute_force[brute_force <= max_distance - 1e-5])[:k]
+            neighbours = indices[indptr[node]:indptr[node + 1]]
+            self.assertIn(len(neighbours), range(len(expected), k + 1))
+            for neighbour, distance, best in zip(neighbours, distances[indptr[node]:indptr[node + 1]], expected):
+                self.assertAlmostEqual(distance, best, places=5)
+                self.assertAlmostEqual(distance, brute_force[neighbour], places=5)
+
+class EmptyEmbeddings(unittest.TestCase):
+    def setUp(self):
+        self.embs = embutils.WordEmbeddings()
+    def test_knn_graph(self):
+        indptr, indices, distances = self.embs.knn_graph(3)
+        self.assertEqual((list(indptr), list(indices), list(distances)), ([0], [], []))
+    def test_like_many(self):
+        self.assertEqual(list(self.embs.like_many([], 3)), [])
+    def test_distance_under_many(self):
+        self.assertEqual(list(self.embs.get_words_at_distance_under_many([], 0.5)), [])
+
+class Snapshot(SyntheticFile, BruteForceAssert, unittest.TestCase):
+    def setUp(self):
+        self.embs = embutils.WordEmbeddings()
+        self.embs.load_from_file(self.filename)
+    def test_save_and_load(self):
+        filename = os.path.join(self.data_dir, "synthetic.snap")
+        self.embs.save_snapshot(filename)
+        snapshot = embutils.WordEmbeddings()
+        snapshot.load_from_file(filename)
+        w = self.words
+        self.assertEqual(tuple(snapshot.get_vocabulary()), tuple(w))
+        self.assertEqual(snapshot.vectors().tolist(), self.embs.vectors().tolist())
+        self.assert_results_almost_equal(snapshot.like(w[3]), self.embs.like(w[3]))
+        self.assert_like_brute_force(snapshot.like(w[0], w[1]), w[0], w[1])
+        self.assert_like_brute_force(snapshot.unlike(w[0], w[1], 10, 0.5), w[0], w[1], True, 0.5)
+
+class ChainScoring(SyntheticFile, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.embs = embutils.WordEmbeddings()
+        cls.embs.load_from_file(cls.filename)
+        cls.quantized = {}
+        for mode in ["float16", "int8"]:
+            cls.quantized[mode] = embutils.WordEmbeddings()
+            cls.quantized[mode].load_from_file(cls.filename)
+            cls.quantized[mode].quantize(mode)
+    def assert_scored_like_transformed(self, like_args):
+        words = self.words[::10]
+        scored = self.embs.like_distances(like_args, words, False)
+        transformed = self.embs.like_distances(like_args, words, True)
+        self.assertEqual(len(scored), len(words))
+        for s1, s2 in zip(scored, transformed):
+            self.assertAlmostEqual(s1, s2, delta=1e-5)
+    def test_one_level(self):
+        w = self.words
+        self.assert_scored_like_transformed(embutils.LikeArgs(w[0], w[1], False, 1.0))
+        self.assert_scored_like_transformed(embutils.LikeArgs(w[0], w[1], True, 0.5))
+        self.assert_scored_like_transformed(embutils.LikeArgs(w[2], w[3], False, 0.3))
+    def test_two_levels(self):
+        w = self.words
+        self.assert_scored_like_transformed(
+            embutils.LikeArgs(embutils.LikeArgs(w[0], w[1], False, 1.0), embutils.LikeArgs(w[2]), True, 0.7))
+        self.assert_scored_like_transformed(
+            embutils.LikeArgs(embutils.LikeArgs(w[4], w[5], True, 0.4), embutils.LikeArgs(w[6]), False, 1.0))
+    def test_three_levels(self):
+        w = self.words
+        inner = embutils.LikeArgs(embutils.LikeArgs(w[0], w[1], True, 0.8), embutils.LikeArgs(w[2]), False, 0.5)
+        self.assert_scored_like_transformed(embutils.LikeArgs(inner, embutils.LikeArgs(w[3]), True, 0.6))
+        inner = embutils.LikeArgs(embutils.LikeArgs(w[7], w[8], False, 1.0), embutils.LikeArgs(w[9]), True, 0.9)
+        self.assert_scored_like_transformed(embutils.LikeArgs(inner, embutils.LikeArgs(w[10]), False, 0.2))
+    def test_quantized(self):
+        w = self.words
+        queries = [embutils.LikeArgs(w[0], w[1], False, 1.0), embutils.LikeArgs(w[0], w[1], True, 0.5),
+                   embutils.LikeArgs(embutils.LikeArgs(w[2], w[3], True, 0.8), embutils.LikeArgs(w[4]), False, 1.0),
+                   embutils.LikeArgs(embutils.LikeArgs(embutils.LikeArgs(w[5], w[6], True, 0.8), embutils.LikeArgs(w[7]),
+                                                       False, 0.5), embutils.LikeArgs(w[8]), True, 0.6)]
+        for mode, quantized in self.quantized.items():
+            for like_args in queries:
+                self.assertEqual(tuple(quantized.like(like_args, 20)), tuple(self.embs.like(like_args, 20)))
+
+class VecReaderChecks(SyntheticFile, ResultAssert, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.vecs = word2vec.VecReader(cls.filename)
+        # VecReader keeps float16 vectors, embutils gets the same ones
+        cls.rounded_filename = os.path.join(cls.data_dir, "rounded.bin")
+        with open(cls.rounded_filename, "wb") as f:
+            f.write(f"{len(cls.vecs.words)} {cls.vecs.dimension}\n".encode("utf-8"))
+            for word, row in zip(cls.vecs.words, cls.vecs.matrix):
+                f.write(word.encode("utf-8") + b" " + row.astype(numpy.float32).tobytes() + b"\n")
+        cls.embs = embutils.WordEmbeddings()
+        cls.embs.load_from_file(cls.rounded_filename)
+        words = cls.vecs.words
+        cls.queries = [(words[0], words[1], False, 1.0), (words[2], words[3], True, 1.0),
+                       (words[4], words[5], False, 0.5), (words[6], words[7], True, 0.8)]
+    def assert_like_brute_force(self, vecs, results, queries, n):
+        words = list(vecs.get_vocabulary())
+        matrix = numpy.array([vecs.find(w) for w in words])
+        for result, (word1, word2, negative, factor) in zip(results, queries):
+            distances = brute_force_like(matrix, vecs.find(word1), vecs.find(word2), negative, factor)
+            best = numpy.argsort(distances, kind="stable")[:n]
+            self.assertEqual(len(result), n)
+            for (word, distance), i in zip(result, best):
+                self.assertAlmostEqual(distance, distances[i], places=5)
+                self.assertAlmostEqual(distance, distances[words.index(word)], places=5)
+    def test_like_brute_force(self):
+        results = [self.vecs.like(w1, w2, 10, negative, factor) for w1, w2, negative, factor in self.queries]
+        self.assert_like_brute_force(self.vecs, results, self.queries, 10)
+        self.assertEqual(self.vecs.unlike(*self.queries[1][:2], 10), results[1])
+        self.assertEqual(self.vecs.like_batch(self.queries, 10, block_size=3), results)
+        self.assertEqual(self.vecs.like(self.vecs.words[0], "no such word", 10), [])
+    def test_like_embutils(self):
+        for word1, word2, negative, factor in self.queries:
+            self.assert_results_almost_equal(self.vecs.like(word1, word2, 10, negative, factor),
+                                             self.embs.like(embutils.LikeArgs(word1, word2, negative, factor), 10))
+        word = self.vecs.words[0]
+        self.assert_results_almost_equal(self.vecs.like(word, word, 10), self.embs.like(word, 10))
+    def test_closest_n_batch(self):
+        words = self.vecs.words[:100:7]
+        queries = words + [self.vecs.find(w) * 2 for w in words[:3]]
+        batch = self.vecs.closest_n_batch(queries, 10, block_size=4)
+        self.assertEqual(batch[:len(words)], [self.vecs.closest_n(w, 10) for w in words])
+        self.assertEqual(batch[len(words):], [self.vecs.closest_n_vecs(v, 10) for v in queries[len(words):]])
+        self.assertEqual(self.vecs.closest_n_batch(["no such word"], 10), [[]])
+    def test_restricted(self):
+        kept = self.vecs.words[::3] + self.vecs.words[1:100]
+        restricted = self.vecs.keep_words(kept, inplace=False)
+        reread = word2vec.VecReader(self.filename, vocabulary=set(kept))
+        self.assertEqual(sorted(restricted.get_vocabulary()), sorted(reread.get_vocabulary()))
+        self.assertIsNone(restricted.find(self.vecs.words[2000 - 1]))
+        self.assertEqual(len(self.vecs.get_vocabulary()), 2000)
+        words = self.vecs.words[:60:6]
+        self.assertEqual(restricted.closest_n_batch(words, 10), reread.closest_n_batch(words, 10))
+        queries = [q for q in self.queries if q[0] in kept and q[1] in kept]
+        self.assertTrue(queries)
+        results = restricted.like_batch(queries, 10)
+        self.assertEqual(results, reread.like_batch(queries, 10))
+        self.assert_like_brute_force(restricted, results, queries, 10)
+        removed = self.vecs.remove_words(self.vecs.words[:1000], inplace=False)
+        self.assertEqual(list(removed.get_vocabulary()), self.vecs.words[1000:])
+        self.assertEqual(removed.closest_n_vecs(self.vecs.find(self.vecs.words[0]), 5),
+                         word2vec.VecReader(self.filename).keep_words(self.vecs.words[1000:], inplace=False)
+                         .closest_n_vecs(self.vecs.find(self.vecs.words[0]), 5))
+    def test_snapshot(self):
+        filename = os.path.join(self.data_dir, "synthetic.snap")
+        self.vecs.save_snapshot(filename)
+        snapshot = word2vec.VecReader(filename)
+        self.assertEqual(list(snapshot.get_vocabulary()), self.vecs.words)
+        self.assertEqual(snapshot.find(self.vecs.words[5]).tolist(), self.vecs.find(self.vecs.words[5]).tolist())
+        words = self.vecs.words[:50:5]
+        self.assertEqual(snapshot.closest_n_batch(words, 10), self.vecs.closest_n_batch(words, 10))
+        for got, expected in zip(snapshot.like_batch(self.queries, 10), self.vecs.like_batch(self.queries, 10)):
+            self.assert_results_almost_equal(got, expected)
+        embs = embutils.WordEmbeddings()
+        embs.load_from_file(filename)
+        self.assertEqual(tuple(embs.get_vocabulary()), tuple(self.vecs.words))
+        self.assert_results_almost_equal(embs.like(self.vecs.words[0], 10), self.embs.like(self.vecs.words[0], 10))
+        restricted = self.vecs.keep_words(self.vecs.words[::2], inplace=False)
+        restricted.save_snapshot(filename)
+        self.assertEqual(list(word2vec.VecReader(filename).get_vocabulary()), self.vecs.words[::2])
+    def test_loading(self):
+        mapped = word2vec.VecReader(self.filename, mmap=True)
+        self.assertEqual(mapped.words, self.vecs.words)
+        self.assertTrue(numpy.array_equal(mapped.matrix, self.vecs.matrix))
+        top = word2vec.VecReader(self.filename, top_n=100)
+        self.assertEqual(top.words, self.vecs.words[:100])
+        text_filename = os.path.join(self.data_dir, "synthetic.txt")
+        benchmark.write_synthetic(text_filename, 2000, 50, 0, False)
+        text = word2vec.VecReader(text_filename, processes=2)
+        self.assertEqual(text.words, self.vecs.words)
+        self.assertTrue(numpy.allclose(text.matrix, self.vecs.matrix, atol=1e-2))
+    def test_parse_text_lines(self):
+        lines = b"a 1 2 3\nb 1 2\nc 1 2 3 4\nd 4 5 6\n"
+        words, floats, positions, nlines, unicode_errors, malformed = word2vec.parse_text_lines(lines, 3)
+        self.assertEqual(words, ["a", "d"])
+        self.assertEqual(floats.tolist(), [[1, 2, 3], [4, 5, 6]])
+        self.assertEqual(positions.tolist(), [0, 3])
+        self.assertEqual((nlines, unicode_errors, malformed), (4, 0, [1, 2]))
+    def test_index_reader(self):
+        index_filename = os.path.join(self.data_dir, "synthetic.index")
+        vector_filename = os.path.join(self.data_dir, "synthetic.float16")
+        with open(index_filename, "w") as f:
+            for i, word in enumerate(self.vecs.words):
+                f.write(f"{word} {i}\n")
+        self.vecs.matrix.astype(numpy.float16).tofile(vector_filename)
+        reader = word2vec.VecIndexReader(index_filename, vector_filename, self.vecs.dimension)
+        words = self.vecs.words[:20] + ["no such word"]
+        many = reader.find_many(words)
+        self.assertEqual(many[:20].tolist(), self.vecs.matrix[:20].tolist())
+        self.assertEqual(many[20].tolist(), [0.0] * self.vecs.dimension)
+        self.assertIsNone(reader.find("no such word"))
+        self.assertEqual(reader.find(words[3]).tolist(), many[3].tolist())
+
+class ApproximateIndex(SyntheticFile, unittest.TestCase):
+    n_words = 5000
+    def setUp(self):
+        self.embs = embutils.WordEmbeddings()
+        self.embs.load_from_file(self.filename)
+        self.embs.build_index()
+    def test_recall(self):
+        rows = range(0, self.n_words, 500)
+        hits = 0
+        for row in rows:
+            distances = brute_force_distances(self.vectors, self.vectors[row])
+            exact = {self.words[i] for i in numpy.argsort(distances)[:10]}
+            approximate = set(map(lambda x: x[0], self.embs.like(self.words[row], 10)))
+            hits += len(approximate & exact)
+        self.assertGreaterEqual(hits / (10 * len(rows)), 0.9)
+    def test_save_and_load(self):
+        word = self.words[3]
+        before = self.embs.like(word)
+        filename = os.path.join(self.data_dir, "synthetic.hnsw")
+        self.embs.save_index(filename)
+        self.embs.drop_index()
+        self.embs.load_index(filename)
+        self.assertEqual(tuple(before), tuple(self.embs.like(word)))
+
+class QuantizedMemory(SyntheticFile, unittest.TestCase):
+    n_words = 3000
+    dimension = 40
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        embs = embutils.WordEmbeddings()
+        embs.load_from_file(cls.filename)
+        cls.snapshot_filename = os.path.join(cls.data_dir, "synthetic.snap")
+        embs.save_snapshot(cls.snapshot_filename)
+    def assert_releases_full_precision(self, filename):
+        embs = embutils.WordEmbeddings()
+        embs.load_from_file(filename)
+        word = embs.get_vocabulary()[5]
+        full_precision = embs.vector_memory_usage()
+        expected = tuple(embs.like(word)), tuple(embs.unlike(word, embs.get_vocabulary()[9], 10, 0.5))
+        for mode in ["float16", "int8"]:
+            embs.quantize(mode)
+            self.assertLess(2 * embs.vector_memory_usage(), full_precision)
+            self.assertEqual((tuple(embs.like(word)), tuple(embs.unlike(word, embs.get_vocabulary()[9], 10, 0.5))),
+                             expected)
+        embs.quantize("none")
+        self.assertEqual(embs.vector_memory_usage(), full_precision)
+        self.assertEqual(tuple(embs.like(word)), expected[0])
+    def test_binary(self):
+        self.assert_releases_full_precision(self.filename)
+    def test_snapshot(self):
+        self.assert_releases_full_precision(self.snapshot_filename)
+
+class CorruptIndex(SyntheticFile, unittest.TestCase):
+    n_words = 500
+    dimension = 20
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.embs = embutils.WordEmbeddings()
+        cls.embs.load_from_file(cls.filename)
+        cls.embs.build_index(4)
+        cls.index_filename = os.path.join(cls.data_dir, "synthetic.hnsw")
+        cls.embs.save_index(cls.index_filename)
+        with open(cls.index_filename, "rb") as f:
+            cls.index_bytes = f.read()
+    def assert_rejected(self, offset, value, fmt="<I"):
+        corrupt = bytearray(self.index_bytes)
+        struct.pack_into(fmt, corrupt, offset, value)
+        filename = os.path.join(self.data_dir, "corrupt.hnsw")
+        with open(filename, "wb") as f:
+            f.write(corrupt)
+        self.assertRaises(RuntimeError, self.embs.load_index, filename)
+    def test_intact(self):
+        self.embs.load_index(self.index_filename)
+        word = self.embs.get_vocabulary()[0]
+        self.assertEqual(self.embs.like(word, 5)[0][0], word)
+    def test_header(self):
+        # magic, then node count, M, ef_construction, ef, fingerprint,
+        # max level and entry point
+        self.assert_rejected(16, 0, "<Q")
+        self.assert_rejected(16, 1 << 40, "<Q")
+        self.assert_rejected(48, 1000, "<i")
+        self.assert_rejected(48, -2, "<i")
+        self.assert_rejected(52, 500)
+        self.assert_rejected(52, 0xffffffff)
+    def test_nodes(self):
+        # node 0 starts with its level, then its level 0 neighbour count
+        # and neighbours
+        first_node = 56
+        self.assert_rejected(first_node, 1000, "<i")
+        self.assert_rejected(first_node, -1, "<i")
+        self.assert_rejected(first_node + 4, 9)
+        self.assert_rejected(first_node + 8, 500)
+    def test_truncated(self):
+        filename = os.path.join(self.data_dir, "truncated.hnsw")
+        with open(filename, "wb") as f:
+            f.write(self.index_bytes[:len(self.index_bytes) // 2])
+        self.assertRaises(RuntimeError, self.embs.load_index, filename)
+
 if __name__ == '__main__':
     unittest.main()
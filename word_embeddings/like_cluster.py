@@ -1,10 +1,16 @@
+import os
+import sys
+import json
 import argparse
+import concurrent.futures
 from subprocess import Popen, PIPE
 
+import numpy as np
+
 import word2vec
 
-parser = argparse.ArgumentParser(description = "Perform Like() clustering for one target word and a word embedding file. The word embedding file can be in binary or text format.")
-parser.add_argument('target_word', action='store')
+parser = argparse.ArgumentParser(description = "Perform Like() clustering for one target word and a word embedding file, or for many target words with --targets or --top-n, writing one JSON object per target. The word embedding file can be in binary or text format.")
+parser.add_argument('target_word', action='store', nargs='?', default=None)
 parser.add_argument('word_embedding_file', action='store')
 parser.add_argument('--n-closest', type=int, default=20 , help='number of neighbour words to consider (default: 20)')
 parser.add_argument('--shared-proportion-cutoff', type=float, default=0.5 , help='what proportion of cluster members must be shared (default: 0.5)')
@@ -14,87 +20,171 @@ parser.add_argument('--print-shared-member-counts', action='store_true', default
 parser.add_argument('--fill-graph', action='store_true', default=False, help='print list of words that participate in any cluster')
 parser.add_argument('--show-false-results', action='store_true', default=False, help="report that a pair doesn't cluster with each other")
 parser.add_argument('--suppress-true-results', action='store_true', default=False, help="don't report that a pair does cluster with each other")
+parser.add_argument('--backend', action='store', default='numpy', choices=['numpy', 'hfst'], help='compute the Like() groups in this process with NumPy, or compile a pmatch script with hfst-pmatch2fst (default: numpy)')
+parser.add_argument('--targets', action='store', default=None, help='cluster each word in this file, one per line, - for STDIN')
+parser.add_argument('--top-n', type=int, default=None, help='cluster each of the N first (most common) words of the word embedding file')
+parser.add_argument('--processes', type=int, default=None, help='worker processes for --targets and --top-n (default: one per core)')
+parser.add_argument('--output', '-o', action='store', default=None, help='write the JSON lines of --targets and --top-n here, default is STDOUT')
 parser.add_argument('--verbose', action='store_true', default=False, help='print everything')
 
+def like_groups_numpy(vecs, clusterword, words, nwords, similarityfactor):
+    groups = {}
+    results = vecs.like_batch([(clusterword, word2, False, similarityfactor) for word2 in words], nwords)
+    for word2, result in zip(words, results):
+        if len(result) > 0:
+            groups[word2] = [word for word, distance in result]
+    return groups
+
+def like_groups_hfst(wordvecfilename, clusterword, words, nwords, similarityfactor):
+    likes = []
+    script = ''
+    script += "set need-separators off\n"
+    script += "set vector-similarity-projection-factor " + str(similarityfactor) + '\n'
+    script += '@vec"' + wordvecfilename + '"\n'
+    for word2 in words:
+        word2 = word2.replace('-', '#').replace('_', '#')
+        script += "define " + word2 + ' Like("' + clusterword + '", "' + word2 + '")^' + str(nwords) + ';\n'
+        likes.append(word2)
+    script += "define TOP " + ' | '.join(map(lambda x: '[ {' + x + ' } ' + x + ' ]\n', likes)) + ";\n"
+    pmatch2fst_process = Popen(["hfst-pmatch2fst"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    pmatch_out, err = pmatch2fst_process.communicate(input=script.encode('utf-8'))
+
+    fst2strings_process = Popen(["hfst-fst2strings"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    fst2strings_out, err = fst2strings_process.communicate(input=pmatch_out)
+    strings = str(fst2strings_out, "utf-8")
+    groups = {}
+    for line in strings.split('\n'):
+        if ' ' not in line:
+            continue
+        groupword, word = line.split(' ')
+        groups[groupword] = groups.setdefault(groupword, []) + [word]
+    return groups
+
+def shared_member_counts(groups):
+    """
+    How many members of each group are in each other group, from a matrix
+    with a row per group and a column per word that is in any group. The
+    product of it with its transpose counts the shared words of every pair
+    of groups at once.
+    """
+    columns = {}
+    for members in groups.values():
+        for word in members:
+            columns.setdefault(word, len(columns))
+    membership = np.zeros((len(groups), len(columns)), dtype = np.int32)
+    for row, members in enumerate(groups.values()):
+        for word in members:
+            membership[row, columns[word]] += 1
+    shared = membership @ (membership > 0).T
+    associations = {}
+    for i, key in enumerate(groups):
+        associations[key] = {}
+        for j, key2 in enumerate(groups):
+            if key == key2:
+                continue
+            associations[key][key2] = int(shared[i, j])
+    return associations
+
+def cluster(clusterword):
+    # The groups of Like(clusterword, neighbour) for each neighbour of
+    # clusterword, how many members they share, and which of them cluster
+    # with each other
+    words = vecs.closest_n(clusterword, nwords)
+    if args.backend == 'hfst':
+        groups = like_groups_hfst(wordvecfilename, clusterword, words, nwords, similarityfactor)
+    else:
+        groups = like_groups_numpy(vecs, clusterword, words, nwords, similarityfactor)
+    groups[clusterword] = list(groups.keys())
+    associations = shared_member_counts(groups)
+    clusters_with = {}
+    for a in groups.keys():
+        clusters_with[a] = [b for b in groups.keys()
+                            if a != b and float(associations[a][b])/nwords > threshold]
+    return groups, associations, clusters_with
+
+def print_cluster(clusterword, groups, associations, clusters_with):
+    if args.print_like_lists or args.verbose:
+        for key in groups:
+            print("Like(" + clusterword + ", " + key + ") contains the words:")
+            for item in groups[key]:
+                print("  " + item)
+
+    if args.print_shared_member_counts or args.verbose:
+        for key in associations:
+            print("Like(" + clusterword + ", " + key + ")")
+            for item in associations[key]:
+                print("  shares " + str(associations[key][item]) + " members with Like(" + clusterword + ", " + item + ")")
+
+    all_cluster_members = set()
+
+    for a in groups.keys():
+        clusteringgroup = clusters_with[a]
+        nonclusteringgroup = [b for b in groups.keys() if b != a and b not in clusteringgroup]
+        if len(clusteringgroup) > 0:
+            all_cluster_members.add(a)
+        if len(clusteringgroup) > 0 and (not args.suppress_true_results) or args.verbose:
+            print(a + " clusters with " + ', '.join(clusteringgroup))
+        if len(nonclusteringgroup) > 0 and (args.show_false_results) or args.verbose:
+            print(a + " doesn't cluster with " + ', '.join(nonclusteringgroup))
+
+    if args.fill_graph:
+        for word in all_cluster_members:
+            print(word)
+
+def cluster_record(clusterword):
+    # One line of batch output
+    groups, associations, clusters_with = cluster(clusterword)
+    record = {'target': clusterword,
+              'neighbours': groups.pop(clusterword),
+              'clusters': {a: b for a, b in clusters_with.items() if len(b) > 0}}
+    if args.print_like_lists or args.verbose:
+        record['groups'] = groups
+    if args.print_shared_member_counts or args.verbose:
+        record['shared'] = associations
+    return json.dumps(record, ensure_ascii = False)
+
+def batch_targets():
+    if args.top_n is not None:
+        for word in vecs.words[:args.top_n]:
+            yield word
+    if args.targets is not None:
+        infile = sys.stdin if args.targets == '-' else open(args.targets, encoding = 'utf-8')
+        for line in infile:
+            if line.strip() != '':
+                yield line.strip()
+
+def run_batch():
+    # The workers are forked after the vectors are loaded and normalized, so
+    # they all share one copy of them
+    vecs.norms
+    processes = args.processes or os.cpu_count() or 1
+    outfile = sys.stdout if args.output is None else open(args.output, 'w', encoding = 'utf-8')
+    executor = None
+    if processes > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(processes, mp_context = word2vec._fork_context())
+        results = word2vec._windowed_map(executor, cluster_record, batch_targets(), 4 * processes)
+    else:
+        results = map(cluster_record, batch_targets())
+    try:
+        for line in results:
+            outfile.write(line + '\n')
+            outfile.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures = True)
+
 args = parser.parse_args()
+batch = args.targets is not None or args.top_n is not None
+if batch == (args.target_word is not None):
+    parser.error("give either a target word or --targets or --top-n")
 clusterword = args.target_word
 wordvecfilename = args.word_embedding_file
 similarityfactor = args.projection_factor
 nwords = args.n_closest
-
-vecs = word2vec.VecReader(wordvecfilename)
-words = vecs.closest_n(clusterword, nwords)
-likes = []
-
-script = ''
-script += "set need-separators off\n"
-script += "set vector-similarity-projection-factor " + str(similarityfactor) + '\n'
-script += '@vec"' + wordvecfilename + '"\n'
-for word2 in words:
-    word2 = word2.replace('-', '#').replace('_', '#')
-    script += "define " + word2 + ' Like("' + clusterword + '", "' + word2 + '")^' + str(nwords) + ';\n'
-    likes.append(word2)
-script += "define TOP " + ' | '.join(map(lambda x: '[ {' + x + ' } ' + x + ' ]\n', likes)) + ";\n"
-pmatch2fst_process = Popen(["hfst-pmatch2fst"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-pmatch_out, err = pmatch2fst_process.communicate(input=script.encode('utf-8'))
-
-fst2strings_process = Popen(["hfst-fst2strings"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-fst2strings_out, err = fst2strings_process.communicate(input=pmatch_out)
-strings = str(fst2strings_out, "utf-8")
-
 threshold = args.shared_proportion_cutoff
 
-groups = {}
-associations = {}
-
-for line in strings.split('\n'):
-    if ' ' not in line:
-        continue
-    groupword, word = line.split(' ')
-    groups[groupword] = groups.setdefault(groupword, []) + [word]
-
-groups[clusterword] = list(groups.keys())
-
-for key in groups:
-    associations[key] = {}
-    for key2 in groups:
-        if key == key2:
-            continue
-        associations[key][key2] = len(list(filter(lambda x: x in groups[key2], groups[key])))
-
-if args.print_like_lists or args.verbose:
-    for key in groups:
-        print("Like(" + clusterword + ", " + key + ") contains the words:")
-        for item in groups[key]:
-            print("  " + item)
-
-if args.print_shared_member_counts or args.verbose:
-    for key in associations:
-        print("Like(" + clusterword + ", " + key + ")")
-        for item in associations[key]:
-            print("  shares " + str(associations[key][item]) + " members with Like(" + clusterword + ", " + item + ")")
-
-def clusters_with(a, b):
-    return float(associations[a][b])/nwords > threshold
-
-all_cluster_members = set()
-
-for a in groups.keys():
-    clusteringgroup = []
-    nonclusteringgroup = []
-    for b in groups.keys():
-        if a == b:
-            continue
-        if clusters_with(a, b):
-            all_cluster_members.add(a)
-            clusteringgroup.append(b)
-        else:
-            nonclusteringgroup.append(b)
-    if len(clusteringgroup) > 0 and (not args.suppress_true_results) or args.verbose:
-        print(a + " clusters with " + ', '.join(clusteringgroup))
-    if len(nonclusteringgroup) > 0 and (args.show_false_results) or args.verbose:
-        print(a + " doesn't cluster with " + ', '.join(nonclusteringgroup))
-
-if args.fill_graph:
-    for word in all_cluster_members:
-        print(word)
+vecs = word2vec.VecReader(wordvecfilename)
+if batch:
+    run_batch()
+else:
+    print_cluster(clusterword, *cluster(clusterword))
@@ -1,46 +1,76 @@
+import sys
 import argparse
 from subprocess import Popen, PIPE
 
 import word2vec
 
-parser = argparse.ArgumentParser(description = "Print the members of a Like() or Unlike() group.")
-parser.add_argument('word1', action='store')
-parser.add_argument('word2', action='store')
+parser = argparse.ArgumentParser(description = "Print the members of a Like() or Unlike() group, or of one group per line of --queries.")
+parser.add_argument('word1', action='store', nargs='?', default=None)
+parser.add_argument('word2', action='store', nargs='?', default=None)
 parser.add_argument('word_embedding_file', action='store')
 parser.add_argument('-u', action='store_true', default=False, help='Unlike() instead of Like()')
 parser.add_argument('--n-closest', type=int, default=20 , help='number of group members (default: 20)')
 parser.add_argument('--projection-factor', type=float, default=1.0 , help='projection factor, 1.0 is full projection (default: 1.0)')
+parser.add_argument('--backend', action='store', default='numpy', choices=['numpy', 'hfst'], help='compute in this process with NumPy, or compile a pmatch script with hfst-pmatch2fst (default: numpy)')
+parser.add_argument('--queries', metavar='FILENAME', action='store', default=None, help='answer queries from this file, - for STDIN, one per line as: word1 [word2] [-u] [n] [projection factor]')
+parser.add_argument('--format', action='store', default='tsv', choices=['tsv', 'jsonl'], help='output of --queries: a query, word, distance line per group member, or a JSON object per query (default: tsv)')
+parser.add_argument('--workers', type=int, default=1, help='threads answering --queries, the output stays in query order (default: 1)')
 
 args = parser.parse_args()
+if args.queries is None and args.word2 is None:
+    parser.error("give word1 and word2, or --queries")
+if args.queries is not None and args.word1 is not None:
+    parser.error("word1 and word2 can't be given with --queries")
 wordvecfilename = args.word_embedding_file
 similarityfactor = args.projection_factor
 nwords = args.n_closest
-vecs = word2vec.VecReader(wordvecfilename)
 
-fun = 'Like('
-if args.u:
-    fun = 'Unlike('
+def like_numpy(vecs, word1, word2, negative, n, factor):
+    for word in (word1, word2):
+        if vecs.find(word) is None:
+            raise KeyError(f"{word} is not in {wordvecfilename}")
+    return vecs.like(word1, word2, n, negative, factor)
 
-likes = []
+def like_hfst(word1, word2, negative, n, factor):
+    fun = 'Like('
+    if negative:
+        fun = 'Unlike('
+    script = ''
+    script += "set need-separators off\n"
+    script += "set vector-similarity-projection-factor " + str(factor) + '\n'
+    script += '@vec"' + wordvecfilename + '"\n'
+    if word1 == word2 and not negative:
+        script += 'define TOP ' + fun + word1 + ')^' + str(n) + ';\n'
+    else:
+        script += 'define TOP ' + fun + word1 + ', ' + word2 + ')^' + str(n) + ';\n'
+    pmatch2fst_process = Popen(["hfst-pmatch2fst", "--cosine-distances"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    pmatch_out, err = pmatch2fst_process.communicate(input=script.encode('utf-8'))
 
-script = ''
-script += "set need-separators off\n"
-script += "set vector-similarity-projection-factor " + str(similarityfactor) + '\n'
-script += '@vec"' + wordvecfilename + '"\n'
-if args.word1 == args.word2 and not args.u:
-    script += 'define TOP ' + fun + args.word1 + ')^' + str(args.n_closest) + ';\n'
+    fst2strings_process = Popen(["hfst-fst2strings", "--print-weights"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    fst2strings_out, err = fst2strings_process.communicate(input=pmatch_out)
+    out_lines =  str(fst2strings_out, "utf-8").split("\n")
+    scored_strings = []
+    for line in out_lines:
+        if line != "":
+            parts = line.split("\t")
+            scored_strings.append((parts[0], float(parts[1])))
+    return sorted(scored_strings, key = lambda x: x[1])
+
+if args.backend == 'hfst':
+    like = like_hfst
 else:
-    script += 'define TOP ' + fun + args.word1 + ', ' + args.word2 + ')^' + str(args.n_closest) + ';\n'
-pmatch2fst_process = Popen(["hfst-pmatch2fst", "--cosine-distances"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-pmatch_out, err = pmatch2fst_process.communicate(input=script.encode('utf-8'))
-
-fst2strings_process = Popen(["hfst-fst2strings", "--print-weights"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-fst2strings_out, err = fst2strings_process.communicate(input=pmatch_out)
-out_lines =  str(fst2strings_out, "utf-8").split("\n")
-scored_strings = []
-for line in out_lines:
-    if line != "":
-        parts = line.split("\t")
-        scored_strings.append((parts[0], float(parts[1])))
-for word, score in sorted(scored_strings, key = lambda x: x[1]):
+    vecs = word2vec.VecReader(wordvecfilename)
+    like = lambda *query: like_numpy(vecs, *query)
+
+if args.queries is not None:
+    answers = word2vec.answer_like_queries(word2vec.read_query_lines(args.queries), like,
+                                           nwords, similarityfactor, args.workers)
+    word2vec.write_like_answers(answers, args.format)
+    sys.exit(0)
+
+try:
+    scored_strings = like(args.word1, args.word2, args.u, nwords, similarityfactor)
+except KeyError as e:
+    sys.exit(e.args[0])
+for word, score in scored_strings:
     print(word)
@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
 import numpy as np
+import os
 import sys
+import math
+import json
+import warnings
+import collections
+import multiprocessing
+import concurrent.futures
 import scipy.spatial
 import marshal
+import copy
+import functools
+import operator
+import collections.abc
+import mmap as mmap_module
 #import heapq
 
 cosine_distance = scipy.spatial.distance.cosine
@@ -11,8 +23,8 @@ first = lambda x: x[0]
 second = lambda x: x[1]
 
 class VecIndexReader:
-    def __init__(self, indexfile, vecfile):
-        self.dimension = 128
+    def __init__(self, indexfile, vecfile, dimension = 128, cache_size = 100000):
+        self.dimension = dimension
         if indexfile.endswith(".marshal"):
             indexfile_f = open(indexfile, "rb")
             self.indices = marshal.load(indexfile_f)
@@ -22,39 +34,345 @@ class VecIndexReader:
             for line in indexfile_f:
                 parts = line.strip().split()
                 self.indices[first(parts)] = int(second(parts))
-        self.vecfile = open(vecfile, "rb")
+        # vecfile is a flat array of float16 vectors, row i belonging to the
+        # word with index i
+        rows = os.path.getsize(vecfile) // (2 * self.dimension)
+        self.vectors = np.memmap(vecfile, dtype = np.float16, mode = "r",
+                                 shape = (rows, self.dimension))
+        self._lookup = functools.lru_cache(maxsize = cache_size)(self._lookup_uncached)
 
-    def find(self, word):
-        if word not in self.indices:
+    def _best_index(self, word):
+        # The index of word, or failing that of its longest prefix or suffix
+        # that is in the index, preferring prefixes of equal length. Only the
+        # in-memory index is consulted.
+        if word in self.indices:
+            return self.indices[word]
+        for length in range(len(word) - 1, 0, -1):
+            prefix = word[:length]
+            if prefix in self.indices:
+                return self.indices[prefix]
+            suffix = word[len(word) - length:]
+            if suffix in self.indices:
+                return self.indices[suffix]
+        return None
+
+    def _lookup_uncached(self, word, best):
+        index = self._best_index(word) if best else self.indices.get(word)
+        if index is None:
             return None
-        self.vecfile.seek(2 * self.dimension * self.indices[word])
-        return np.fromfile(self.vecfile, dtype = np.float16,
-                           count = self.dimension)
+        retval = np.array(self.vectors[index])
+        retval.flags.writeable = False
+        return retval
+
+    def find(self, word):
+        return self._lookup(word, False)
 
     def findbest(self, word):
-        v = self.find(word)
-        if v is not None:
-            return v
-        i = 1
-        while i < len(word):
-            v = self.find(word[:len(word) - i])
-            if v is not None:
-                return v
-            v = vindex.find(word[i:])
-            if v is not None:
-                return v
-            i += 1
-        return(np.zeros(self.dimension))
-            
+        v = self._lookup(word, True)
+        if v is None:
+            return np.zeros(self.dimension)
+        return v
+
+    def find_many(self, words, best = False):
+        # Vectors of many words gathered from the vector file in one go,
+        # words that aren't found (with findbest semantics if best is set)
+        # get zero rows
+        lookup = self._best_index if best else self.indices.get
+        indices = [lookup(w) for w in words]
+        indices = np.array([-1 if i is None else i for i in indices], dtype = np.int64)
+        found = indices >= 0
+        retval = np.zeros((len(indices), self.dimension), dtype = np.float16)
+        retval[found] = self.vectors[indices[found]]
+        return retval
+
+def text_chunk_bounds(filename, start, chunk_size):
+    # (start, end) byte ranges of about chunk_size bytes covering filename
+    # from start to the end, each ending just after a newline
+    size = os.path.getsize(filename)
+    bounds = []
+    with open(filename, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+def parse_text_lines(data, dimension, datatype = "float32", vocabulary = None):
+    """
+    Parse lines of a text format embedding file. Returns the accepted words,
+    their vectors as a float16 matrix, the line number of each accepted word
+    within data, the number of lines read, the number of lines skipped
+    due to unicode errors and the line numbers of lines skipped for not
+    having dimension numbers.
+    """
+    words = []
+    positions = []
+    bodies = []
+    nlines = 0
+    unicode_errors = 0
+    # Whether every line has dimension numbers separated by single spaces,
+    # so that the numbers of all lines can be parsed in one go
+    regular = True
+    for line in data.split(b'\n'):
+        if not line.strip():
+            continue
+        nlines += 1
+        spacepos = line.find(b' ')
+        if spacepos < 0:
+            continue
+        try:
+            word = str(line[:spacepos], "utf-8")
+        except UnicodeDecodeError:
+            unicode_errors += 1
+            continue
+        if vocabulary and word not in vocabulary:
+            continue
+        words.append(word)
+        positions.append(nlines - 1)
+        body = line[spacepos+1:].strip()
+        if body.count(b' ') != dimension - 1:
+            regular = False
+        bodies.append(body)
+    floats = None
+    if regular:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                floats = np.fromstring(b' '.join(bodies), dtype = datatype, sep = ' ')
+        except ValueError:
+            pass
+    malformed = []
+    if floats is not None and floats.size == len(words) * dimension:
+        floats = floats.reshape(len(words), dimension)
+    else:
+        # Something was malformed or irregularly spaced, fall back to
+        # parsing line by line and leaving out lines of the wrong dimension
+        rows = []
+        kept = []
+        for i, body in enumerate(bodies):
+            try:
+                row = np.array(list(map(float, body.split())), dtype = datatype)
+            except ValueError:
+                row = None
+            if row is not None and len(row) == dimension:
+                rows.append(row)
+                kept.append(i)
+            else:
+                malformed.append(positions[i])
+        words = [words[i] for i in kept]
+        positions = [positions[i] for i in kept]
+        floats = np.array(rows, dtype = datatype).reshape(len(kept), dimension)
+    return words, floats.astype("float16"), np.array(positions, dtype = np.int64), nlines, unicode_errors, malformed
+
+_worker_vocabulary = None
+
+def _init_text_worker(vocabulary):
+    global _worker_vocabulary
+    _worker_vocabulary = vocabulary
+
+def _parse_text_chunk(job):
+    filename, start, end, dimension, datatype = job
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return parse_text_lines(data, dimension, datatype, _worker_vocabulary)
+
+def _fork_context():
+    # The scripts using this module aren't import-safe, so avoid start
+    # methods that re-import __main__ where possible
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+def _windowed_map(executor, fun, iterable, window):
+    # Like executor.map, but keeping at most window tasks submitted ahead of
+    # the consumer
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fun, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# Streams of Like() and Unlike() queries, as read by both like_unlike.py
+# scripts with --queries
+
+def parse_like_query(line, n, projection_factor):
+    """
+    A query line, word1 [word2] [-u] [n] [projection factor], as a dict
+    with the given n and projection factor where the line leaves them out.
+    A number is n if it's an integer and the projection factor if it's
+    any other finite number, anything else after word1 is word2. Raises
+    ValueError if the line doesn't parse.
+    """
+    fields = line.split()
+    if len(fields) == 0:
+        raise ValueError("empty query")
+    query = {'word1': fields[0], 'word2': fields[0], 'unlike': False,
+             'n': n, 'projection_factor': projection_factor}
+    for i, field in enumerate(fields[1:]):
+        if field == '-u':
+            query['unlike'] = True
+            continue
+        try:
+            query['n'] = int(field)
+            continue
+        except ValueError:
+            pass
+        try:
+            value = float(field)
+        except ValueError:
+            value = None
+        # nan, inf and the like are words
+        if value is not None and math.isfinite(value):
+            query['projection_factor'] = value
+            continue
+        if i > 0:
+            raise ValueError("word2 must come right after word1")
+        query['word2'] = field
+    return query
+
+def answer_like_queries(lines, like, n, projection_factor, workers = 1):
+    """
+    (line, query, result) for each query line in order, result being
+    like(word1, word2, unlike, n, projection_factor). When the line doesn't
+    parse or like() raises ValueError, KeyError or RuntimeError, query is
+    None and result the error message. With workers > 1 the queries are
+    answered on that many threads, a few per thread at a time, so answers
+    come out while lines are still being read.
+    """
+    def answer(line):
+        try:
+            query = parse_like_query(line, n, projection_factor)
+            result = like(query['word1'], query['word2'], query['unlike'],
+                          query['n'], query['projection_factor'])
+        except (ValueError, KeyError, RuntimeError) as e:
+            return line, None, e.args[0] if len(e.args) > 0 else str(e)
+        return line, query, [(word, distance) for word, distance in result]
+    if workers <= 1:
+        yield from map(answer, lines)
+        return
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        yield from _windowed_map(executor, answer, lines, 4 * workers)
+
+def write_like_answers(answers, output_format, outfile = sys.stdout):
+    """
+    Write answers from answer_like_queries() as they come, either as tsv,
+    a query, word, distance line per word and errors to STDERR, or as
+    jsonl, an object per query with the error in an error key.
+    """
+    for line, query, result in answers:
+        if query is None:
+            if output_format == 'jsonl':
+                print(json.dumps({'query': line, 'error': result}, ensure_ascii = False), file = outfile, flush = True)
+            else:
+                print(f"{line}: {result}", file = sys.stderr)
+            continue
+        if output_format == 'jsonl':
+            record = {'query': line}
+            record.update(query)
+            record['results'] = result
+            print(json.dumps(record, ensure_ascii = False), file = outfile, flush = True)
+        else:
+            for word, distance in result:
+                print(f"{line}\t{word}\t{distance}", file = outfile)
+            outfile.flush()
+
+def read_query_lines(filename):
+    # Nonempty lines of filename, or of STDIN for -
+    infile = sys.stdin if filename == '-' else open(filename, encoding = 'utf-8')
+    return (line.strip() for line in infile if line.strip() != '')
+
+# Snapshot files hold the words and vectors of a VecReader or an
+# embutils.WordEmbeddings ready to be mapped into memory and used in place.
+# The layout is described with SnapshotHeader in c++/embutils.h.
+SNAPSHOT_MAGIC = b"EMBSNAP1"
+SNAPSHOT_HEADER = np.dtype([("magic", "S8"), ("rows", "<u8"), ("dimension", "<u8"),
+                            ("row_stride", "<u8"), ("word_arena_size", "<u8"),
+                            ("slot_count", "<u8"), ("matrix_offset", "<u8"),
+                            ("inverse_norms_offset", "<u8"), ("word_offsets_offset", "<u8"),
+                            ("word_arena_offset", "<u8"), ("slots_offset", "<u8")])
+SNAPSHOT_EMPTY_SLOT = 0xFFFFFFFF
+
+def snapshot_word_hash(word):
+    # FNV-1a over the UTF-8 bytes of a word
+    h = 14695981039346656037
+    for c in word:
+        h = ((h ^ c) * 1099511628211) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+class _SnapshotWords(collections.abc.Sequence):
+    # The words of a snapshot, decoded from the mapped file when asked for
+    def __init__(self, arena, offsets):
+        self._arena = arena
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def word_bytes(self, index):
+        return bytes(self._arena[int(self._offsets[index]):int(self._offsets[index + 1])])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = operator.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("word index out of range")
+        return str(self.word_bytes(index), "utf-8", errors = "replace")
+
+class _SnapshotWordIndex(collections.abc.Mapping):
+    # Rows of words by the word slots of a snapshot
+    def __init__(self, words, slots):
+        self._words = words
+        self._slots = slots
+        self._mask = len(slots) - 1
+
+    def __getitem__(self, word):
+        encoded = word.encode("utf-8")
+        slot = snapshot_word_hash(encoded) & self._mask
+        while True:
+            row = int(self._slots[slot])
+            if row == SNAPSHOT_EMPTY_SLOT:
+                raise KeyError(word)
+            # A snapshot opened with top_n has slots for rows beyond it
+            if row < len(self._words) and self._words.word_bytes(row) == encoded:
+                return row
+            slot = (slot + 1) & self._mask
+
+    def __len__(self):
+        return len(self._words)
+
+    def __iter__(self):
+        return iter(self._words)
+
 class VecReader:
-    def __init__(self, vecfile, datatype = "float32", vocabulary = None, top_n = None, verbose = False):
-        self.vectors = []
-        self.word2vec = {}
+    def __init__(self, vecfile, datatype = "float32", vocabulary = None, top_n = None, verbose = False, mmap = False, processes = None):
+        # Vectors are stored as rows of one matrix, self.words holds the
+        # words in file order and self.word2index maps them to rows.
+        self.words = []
+        self.word2index = {}
+        self._cache = {}
+        self._mask = None
+        self._rows = None
+        # Only for snapshots, which keep the inverse of each vector's norm
+        self._inverse_norms = None
         f = open(vecfile, "rb")
-        firstline = f.readline().strip()
-        self.vocabulary_size, self.dimension = map(int, firstline.split())
+        if f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+            self._open_snapshot(f, top_n)
+            if vocabulary:
+                self.keep_words(vocabulary)
+            return
+        f.seek(0)
+        firstline = f.readline()
+        self.vocabulary_size, self.dimension = map(int, firstline.strip().split())
         self.orig_vocabulary_size = self.vocabulary_size
-        fraction_of_vocab = self.vocabulary_size // 20
+        fraction_of_vocab = max(1, self.vocabulary_size // 20)
         if verbose:
             print("reading from " + vecfile, end = '', flush=True)
         wordsread = 0
@@ -63,102 +381,480 @@ class VecReader:
                 datasize = 4
             elif datatype == "float16":
                 datasize = 2
-            data = f.read()
-            i = 0
+            if mmap:
+                data = mmap_module.mmap(f.fileno(), 0, access = mmap_module.ACCESS_READ)
+                i = len(firstline)
+            else:
+                data = f.read()
+                i = 0
+            offsets = []
             while i < len(data):
                 if top_n and top_n <= wordsread:
-                    self.vocabulary_size = len(self.vectors)
                     break
                 wordsread += 1
                 if verbose and wordsread % fraction_of_vocab == 0:
                     print(".", end = '', flush=True)
-                spacepos = data.index(ord(' '), i)
+                spacepos = data.find(b' ', i)
+                if spacepos < 0:
+                    break
                 try:
                     word = str(data[i:spacepos], "utf-8")
                 except UnicodeDecodeError:
-                    self.vocabulary_size -= 1
                     i = spacepos + 1 + 1 + self.dimension * datasize
                     continue
-                floats = np.frombuffer(data, offset = spacepos + 1,
-                                       count = self.dimension, dtype=datatype).astype("float16")
                 i = spacepos + 1 + 1 + self.dimension * datasize
                 if not vocabulary or word in vocabulary:
-                    self.vectors.append((word, floats))
-                    self.word2vec[word] = floats
-                else:
-                    self.vocabulary_size -= 1
+                    self._add_word(word)
+                    offsets.append(spacepos + 1)
+            self._vector_source = (data, np.array(offsets, dtype = np.int64), datatype)
+            if not mmap:
+                # Copy the vectors out now so that the file contents can be
+                # released, in mmap mode this is put off until needed
+                self.matrix
         else:
-            for line in f:
-                if top_n and top_n <= wordsread:
-                    self.vocabulary_size = len(self.vectors)
-                    break
-                wordsread += 1
-                if verbose and wordsread % fraction_of_vocab == 0:
-                    print(".", end='', flush=True)
-                spacepos = line.index(ord(' '))
-                try:
-                    word = str(line[:spacepos], "utf-8")
-                except UnicodeDecodeError:
-                    print("unicode error!")
-                    self.vocabulary_size -= 1
-                    continue
-                line = line.strip()
-                floats = np.array(list(map(float, line[spacepos+1:].split())), dtype=datatype).astype("float16")
-                if not vocabulary or word in vocabulary:
-                    self.vectors.append((word, floats))
-                    self.word2vec[word] = floats
-                else:
-                    self.vocabulary_size -= 1
+            self._read_text(vecfile, len(firstline), datatype, vocabulary,
+                            top_n, verbose, processes)
+        self.vocabulary_size = len(self.words)
         if verbose:
             print()
 
+    def _read_text(self, vecfile, start, datatype, vocabulary, top_n, verbose,
+                   processes, chunk_size = 1 << 23):
+        # The file is cut into chunks of about chunk_size bytes on line
+        # boundaries, which are parsed in a process pool and copied into one
+        # preallocated matrix in file order. Only a window of chunks is in
+        # flight at a time so that top_n can stop reading early.
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if vocabulary:
+            vocabulary = set(vocabulary)
+        chunks = text_chunk_bounds(vecfile, start, chunk_size)
+        jobs = ((vecfile, s, e, self.dimension, datatype) for s, e in chunks)
+        rows = self.vocabulary_size
+        if top_n:
+            rows = min(rows, top_n)
+        matrix = np.empty((rows, self.dimension), dtype = "float16")
+        fraction_of_vocab = max(1, self.vocabulary_size // 20)
+        wordsread = 0
+        executor = None
+        if processes > 1 and len(chunks) > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context = _fork_context(),
+                initializer = _init_text_worker, initargs = (vocabulary,))
+            results = _windowed_map(executor, _parse_text_chunk, jobs, 2 * processes)
+        else:
+            _init_text_worker(vocabulary)
+            results = map(_parse_text_chunk, jobs)
+        try:
+            for words, floats, positions, nlines, unicode_errors, malformed in results:
+                for _ in range(unicode_errors):
+                    print("unicode error!")
+                for line in malformed:
+                    if top_n and wordsread + line >= top_n:
+                        break
+                    # Counting the header and from 1
+                    print(f"warning: vector file {vecfile} appears malformed\n  (reading line {wordsread + line + 2})",
+                          file = sys.stderr)
+                if top_n and wordsread + nlines > top_n:
+                    keep = np.searchsorted(positions, top_n - wordsread)
+                    words, floats = words[:keep], floats[:keep]
+                    nlines = top_n - wordsread
+                if verbose:
+                    for _ in range((wordsread + nlines) // fraction_of_vocab - wordsread // fraction_of_vocab):
+                        print(".", end='', flush=True)
+                wordsread += nlines
+                row = len(self.words)
+                if row + len(words) > len(matrix):
+                    matrix = np.resize(matrix, (2 * (row + len(words)), self.dimension))
+                matrix[row:row + len(words)] = floats
+                for word in words:
+                    self._add_word(word)
+                if top_n and wordsread >= top_n:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures = True)
+        self._cache["matrix"] = matrix[:len(self.words)]
+
+    def _open_snapshot(self, f, top_n):
+        # Everything stays in the mapped file: the matrix is a float32 view
+        # of it and words are decoded and looked up when needed
+        data = mmap_module.mmap(f.fileno(), 0, access = mmap_module.ACCESS_READ)
+        if len(data) < SNAPSHOT_HEADER.itemsize:
+            raise ValueError("snapshot file is truncated")
+        header = np.frombuffer(data, dtype = SNAPSHOT_HEADER, count = 1)[0]
+        self.orig_vocabulary_size = int(header["rows"])
+        self.dimension = int(header["dimension"])
+        rows = self.orig_vocabulary_size
+        if top_n:
+            rows = min(rows, top_n)
+        self._cache["matrix"] = np.ndarray(
+            (rows, self.dimension), dtype = "<f4", buffer = data,
+            offset = int(header["matrix_offset"]),
+            strides = (4 * int(header["row_stride"]), 4))
+        self._inverse_norms = np.frombuffer(
+            data, dtype = "<f4", count = rows, offset = int(header["inverse_norms_offset"]))
+        offsets = np.frombuffer(data, dtype = "<u8", count = rows + 1,
+                                offset = int(header["word_offsets_offset"]))
+        arena_offset = int(header["word_arena_offset"])
+        arena = memoryview(data)[arena_offset:arena_offset + int(header["word_arena_size"])]
+        slots = np.frombuffer(data, dtype = "<u4", count = int(header["slot_count"]),
+                              offset = int(header["slots_offset"]))
+        self.words = _SnapshotWords(arena, offsets)
+        self.word2index = _SnapshotWordIndex(self.words, slots)
+        self.vocabulary_size = rows
+
+    def save_snapshot(self, filename):
+        """
+        Write the selected words and their vectors as a snapshot file, which
+        VecReader and embutils.WordEmbeddings.load_from_file() both open by
+        mapping it into memory. The vectors are stored as float32.
+        """
+        rows = self._selected_rows()
+        words = [self.words[i].encode("utf-8") for i in rows]
+        row_stride = -(-self.dimension // 16) * 16
+        matrix = np.zeros((len(rows), row_stride), dtype = "<f4")
+        matrix[:, :self.dimension] = self.matrix[rows]
+        norms = np.linalg.norm(matrix, axis = 1)
+        inverse_norms = np.zeros(len(rows), dtype = "<f4")
+        inverse_norms[norms > 0] = 1.0 / norms[norms > 0]
+        offsets = np.zeros(len(rows) + 1, dtype = "<u8")
+        offsets[1:] = np.cumsum([len(w) for w in words])
+        slot_count = 2
+        while slot_count < 2 * len(rows):
+            slot_count *= 2
+        slots = [SNAPSHOT_EMPTY_SLOT] * slot_count
+        for row, word in enumerate(words):
+            slot = snapshot_word_hash(word) & (slot_count - 1)
+            # the first of any duplicates wins
+            while slots[slot] != SNAPSHOT_EMPTY_SLOT and words[slots[slot]] != word:
+                slot = (slot + 1) & (slot_count - 1)
+            if slots[slot] == SNAPSHOT_EMPTY_SLOT:
+                slots[slot] = row
+        sections = [matrix.tobytes(), inverse_norms.tobytes(), offsets.tobytes(),
+                    b"".join(words), np.array(slots, dtype = "<u4").tobytes()]
+        aligned = lambda offset: -(-offset // 64) * 64
+        positions = [aligned(SNAPSHOT_HEADER.itemsize)]
+        for section in sections[:-1]:
+            positions.append(aligned(positions[-1] + len(section)))
+        header = np.zeros(1, dtype = SNAPSHOT_HEADER)
+        header[0] = (SNAPSHOT_MAGIC, len(rows), self.dimension, row_stride,
+                     len(sections[3]), slot_count, *positions)
+        with open(filename, "wb") as f:
+            f.write(header.tobytes())
+            for position, section in zip(positions, sections):
+                f.write(b"\0" * (position - f.tell()))
+                f.write(section)
+
+    def _add_word(self, word):
+        self.word2index[word] = len(self.words)
+        self.words.append(word)
+
+    @property
+    def matrix(self):
+        # The (vocabulary size, dimension) float16 matrix of all vectors
+        if "matrix" not in self._cache:
+            self._cache["matrix"] = self._gather_rows(slice(None))
+            if not isinstance(self._vector_source[0], mmap_module.mmap):
+                del self._vector_source
+        return self._cache["matrix"]
+
+    def _gather_rows(self, rows, block_size = 4096):
+        # Copy vectors starting at the given byte offsets of a .bin file into
+        # a float16 matrix, a block of rows at a time to bound the size of
+        # the index array
+        data, offsets, datatype = self._vector_source
+        offsets = offsets[rows]
+        raw = np.frombuffer(data, dtype = np.uint8)
+        rowbytes = self.dimension * np.dtype(datatype).itemsize
+        columns = np.arange(rowbytes)
+        retval = np.empty((len(offsets), self.dimension), dtype = "float16")
+        for start in range(0, len(offsets), block_size):
+            block = offsets[start:start + block_size]
+            retval[start:start + len(block)] = \
+                raw[block[:, None] + columns].view(datatype)
+        return retval
+
+    def _row(self, index):
+        if "matrix" in self._cache:
+            return self._cache["matrix"][index]
+        # Not yet copied out of the mapped file
+        data, offsets, datatype = self._vector_source
+        return np.frombuffer(data, dtype = datatype, count = self.dimension,
+                             offset = int(offsets[index])).astype("float16")
+
+    # A VecReader can be restricted to a subset of its words with
+    # keep_words() and remove_words(). The matrix, words and word2index are
+    # always those of the whole file and are shared between restricted
+    # copies; the selected rows are given by self._mask (a boolean array
+    # over all rows, or None for everything) and self._rows (a slice or a
+    # sorted array of row numbers).
+
+    def _selected_rows(self):
+        if self._rows is None:
+            return np.arange(len(self.words))
+        if isinstance(self._rows, slice):
+            return np.arange(len(self.words))[self._rows]
+        return self._rows
+
+    def _is_selected(self, index):
+        return self._mask is None or self._mask[index]
+
+    @property
+    def vectors(self):
+        return [(self.words[i], self.matrix[i]) for i in self._selected_rows()]
+
+    @property
+    def word2vec(self):
+        return { self.words[i]: self.matrix[i] for i in self._selected_rows() }
+
+    def find(self, word):
+        if word not in self.word2index or not self._is_selected(self.word2index[word]):
+            return None
+        return self._row(self.word2index[word])
+
     def get_vocabulary(self):
-        return self.word2vec.keys()
-                    
-    def remove_words(self, wds):
-        words_to_keep = set(self.word2vec.keys()).difference(set(wds))
-        self.word2vec = { w: self.word2vec[w] for w in words_to_keep }
-        self.vectors = [(w, self.word2vec[w]) for w in words_to_keep]
-
-    def keep_words(self, wds):
-        words_to_keep = set(self.word2vec.keys()).intersection(set(wds))
-        self.word2vec = { w: self.word2vec[w] for w in words_to_keep }
-        self.vectors = [(w, self.word2vec[w]) for w in words_to_keep]
+        if self._mask is None:
+            return self.word2index.keys()
+        return [self.words[i] for i in self._selected_rows()]
+
+    def remove_words(self, wds, inplace = True):
+        mask = self._full_mask()
+        mask[[self.word2index[w] for w in wds if w in self.word2index]] = False
+        return self._restrict(mask, inplace)
+
+    def keep_words(self, wds, inplace = True):
+        mask = np.zeros(len(self.words), dtype = bool)
+        mask[[self.word2index[w] for w in wds if w in self.word2index]] = True
+        if self._mask is not None:
+            mask &= self._mask
+        return self._restrict(mask, inplace)
+
+    def _full_mask(self):
+        if self._mask is None:
+            return np.ones(len(self.words), dtype = bool)
+        return self._mask.copy()
+
+    def _restrict(self, mask, inplace):
+        # Select the rows in mask, either in this object or in a shallow copy
+        # sharing the matrix and everything cached from it
+        retval = self if inplace else copy.copy(self)
+        rows = np.flatnonzero(mask)
+        retval._mask = mask
+        if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+            # Contiguous, eg. the most frequent words, so scans can use a
+            # view of the matrix
+            retval._rows = slice(int(rows[0]), int(rows[-1]) + 1)
+        else:
+            retval._rows = rows
+        retval.vocabulary_size = len(rows)
+        return None if inplace else retval
+
+    @property
+    def normalized(self):
+        # float32 copy of the matrix with every row scaled to unit length,
+        # so that a matrix-vector product gives cosine similarities
+        if "normalized" not in self._cache:
+            normalized = self.matrix.astype(np.float32)
+            norms = np.linalg.norm(normalized, axis = 1, keepdims = True)
+            self._cache["norms"] = norms[:, 0].copy()
+            norms[norms == 0.0] = 1.0
+            normalized /= norms
+            self._cache["normalized"] = normalized
+        return self._cache["normalized"]
+
+    @property
+    def norms(self):
+        # The length of every row of the matrix
+        if "norms" not in self._cache:
+            if self._inverse_norms is not None:
+                norms = np.zeros(len(self._inverse_norms), dtype = np.float32)
+                nonzero = self._inverse_norms > 0.0
+                norms[nonzero] = 1.0 / self._inverse_norms[nonzero]
+                self._cache["norms"] = norms
+            else:
+                self.normalized
+        return self._cache["norms"]
+
+    def _similarities(self, vs):
+        # Cosine similarities of the rows of vs against the selected rows,
+        # one row of the result per query
+        vs = np.array(vs, dtype = np.float32, ndmin = 2)
+        norms = np.linalg.norm(vs, axis = 1, keepdims = True)
+        norms[norms == 0.0] = 1.0
+        vs /= norms
+        if self._inverse_norms is not None:
+            # Snapshot vectors are scored where they are and scaled by their
+            # stored inverse norms instead of being normalized into a copy
+            rows = slice(None) if self._rows is None else self._rows
+            if isinstance(rows, slice) or 2 * len(rows) < len(self.words):
+                return (vs @ self.matrix[rows].T) * self._inverse_norms[rows]
+            return ((vs @ self.matrix.T) * self._inverse_norms)[:, rows]
+        if self._rows is None or isinstance(self._rows, slice):
+            return vs @ self.normalized[self._rows or slice(None)].T
+        if 2 * len(self._rows) < len(self.words):
+            return vs @ self.normalized[self._rows].T
+        # For a large selection it's cheaper to score everything and pick
+        # out the selected columns than to gather the selected vectors
+        return (vs @ self.normalized.T)[:, self._rows]
 
     def closest_n_vecs(self, v, n):
-        sortkey = lambda x: cosine_distance(x[1], v)
-        retval = []
-        return list(map(lambda x: x[0], sorted(self.vectors, key = sortkey)[:n]))
-        
-    def closest_n_vecs_(self, v, n):
-        sortkey = lambda x: cosine_distance(x[1], v)
-        retval = []
-        if n == 0:
-            return retval
-        for vec in self.vectors:
-            if len(retval) == 0:
-                retval.append(vec)
-                continue
-            if len(retval) >= n:
-                if sortkey(vec) >= sortkey(retval[-1]):
-                    continue
-                else:
-                    for i in range(len(retval) - 1, -1, -1):
-                        if sortkey(vec) >= sortkey(retval[i-1]):
-                            retval[i] = vec
-                            break
-        return list(map(lambda x: x[0], sorted(self.vectors, key = sortkey)[:n]))
-        
+        return self.closest_n_batch([v], n)[0]
+
     def closest_n(self, w, n):
-        if w not in self.word2vec:
-            return []
-        sortkey = lambda x: cosine_distance(x[1], self.word2vec[w])
-        v_is_not_w = lambda x: x[0] != w
-#        best_n = heapq.nsmallest(n, self.vectors, sortkey)
-#        self.vectors.sort(key = sortkey)
-#        return map(lambda x: x[0], best_n) #self.vectors[n])
-        return map(lambda x: x[0], sorted(
-            filter(v_is_not_w, self.vectors),
-            key = sortkey)[:n])
-#        return map(lambda x: x[0], self.vectors[:n])
+        return self.closest_n_batch([w], n)[0]
+
+    def closest_n_batch(self, words_or_vectors, n, block_size = 64):
+        # Neighbours for many queries at once, each item being either a word,
+        # which is treated like in closest_n(), or a vector, treated like in
+        # closest_n_vecs(). Queries are scored block_size at a time with one
+        # matrix product, so peak memory is about
+        # block_size * vocabulary size * 4 bytes.
+        queries = []
+        for item in words_or_vectors:
+            if isinstance(item, str):
+                queries.append((item, self.find(item)))
+            else:
+                queries.append((None, item))
+        rows = self._selected_rows()
+        retval = [[] for _ in queries]
+        valid = [i for i, (w, v) in enumerate(queries) if v is not None]
+        for start in range(0, len(valid), block_size):
+            block = valid[start:start + block_size]
+            sims = self._similarities([queries[i][1] for i in block])
+            for row, i in enumerate(block):
+                w = queries[i][0]
+                if w is None:
+                    retval[i] = [self.words[rows[j]] for j in top_k(sims[row], n)]
+                else:
+                    sims[row, np.searchsorted(rows, self.word2index[w])] = -np.inf
+                    retval[i] = [self.words[rows[j]] for j in top_k(sims[row], n + 1)
+                                 if self.words[rows[j]] != w][:n]
+        return retval
+
+    def like(self, word1, word2, n, negative = False, projection_factor = 1.0):
+        return self.like_batch([(word1, word2, negative, projection_factor)], n)[0]
+
+    def unlike(self, word1, word2, n, projection_factor = 1.0):
+        return self.like_batch([(word1, word2, True, projection_factor)], n)[0]
+
+    def like_batch(self, queries, n, block_size = 32):
+        """
+        The n words closest to Like(word1, word2), or Unlike() when negative
+        is true, for each (word1, word2[, negative[, projection_factor]])
+        query, as lists of (word, cosine distance) closest first. Like(word,
+        word) is the n closest words to word, including itself. A query with
+        a word that isn't in the vocabulary gets an empty list.
+
+        The words are moved towards the hyperplane halfway between word1 and
+        word2, as by LikeUnlikeTransformer in embutils and hfst, and compared
+        with the comparison point of the query. The moved vectors are never
+        made: their dot products and lengths follow from each vector's dot
+        products with the plane vector and the comparison point, so a block
+        of queries is one matrix product with the vectors. The best
+        candidates are then scored again in double precision.
+        """
+        steps = []
+        for query in queries:
+            query = tuple(query) + (False, 1.0)[len(query) - 2:]
+            steps.append(like_step(self.find(query[0]), self.find(query[1]), *query[2:]))
+        rows = self._selected_rows()
+        norms = self.norms[rows]
+        retval = [[] for _ in queries]
+        valid = [i for i, step in enumerate(steps) if step is not None]
+        for start in range(0, len(valid), block_size):
+            block = valid[start:start + block_size]
+            points = []
+            for i in block:
+                points.extend(steps[i][:2])
+            # Dot products from the cosine similarities, good to about 1e-6
+            # of the product of the norms
+            dots = self._similarities(points) * norms
+            point_norms = np.linalg.norm(points, axis = 1)
+            dots *= point_norms[:, None]
+            for j, i in enumerate(block):
+                distances = like_distances(dots[2 * j], dots[2 * j + 1], norms ** 2, steps[i])
+                if n < len(rows):
+                    # Anything that could be among the n best at full
+                    # precision, with a wide margin for the error
+                    kth = distances[top_k(-distances, n)[-1]] if n > 0 else -1.0
+                    candidates = np.flatnonzero(distances <= kth + 1e-4)
+                else:
+                    candidates = np.arange(len(rows))
+                vectors = np.array([self._row(rows[k]) for k in candidates], dtype = np.float64)
+                vectors = vectors.reshape(len(candidates), self.dimension)
+                exact = like_distances(vectors @ steps[i][0], vectors @ steps[i][1],
+                                       np.einsum("ij,ij->i", vectors, vectors), steps[i])
+                retval[i] = [(self.words[rows[candidates[k]]], float(exact[k]))
+                             for k in top_k(-exact, n)]
+        return retval
+
+def like_step(first_point, second_point, negative = False, projection_factor = 1.0):
+    """
+    The plane vector, comparison point, translation term and step scale of
+    Like(first_point, second_point), or Unlike() if negative is true. A
+    vector x is moved by step_scale * (translation_term - x . plane_vec)
+    times plane_vec. None if either point is None.
+    """
+    if first_point is None or second_point is None:
+        return None
+    # In single precision, like embutils, so that the results agree to the
+    # last bit or so
+    single = np.float32
+    first_point = np.asarray(first_point, dtype = single)
+    second_point = np.asarray(second_point, dtype = single)
+    plane_vec = first_point - second_point
+    plane_vec_square_sum = single(np.dot(plane_vec, plane_vec))
+    translation_term = single(np.dot(plane_vec, first_point)) - plane_vec_square_sum * single(0.5)
+    if plane_vec_square_sum == 0.0:
+        # The same point twice, which leaves everything where it is
+        return plane_vec, first_point, 0.0, 0.0
+    if negative:
+        comparison_scaler = (translation_term - single(np.dot(first_point, plane_vec))) / plane_vec_square_sum
+        comparison_point = first_point - single(comparison_scaler * single(projection_factor)) * plane_vec
+    else:
+        comparison_point = second_point + single(0.5) * plane_vec
+    step_scale = single(projection_factor) / plane_vec_square_sum
+    return (plane_vec.astype(np.float64), comparison_point.astype(np.float64),
+            float(translation_term), float(-step_scale if negative else step_scale))
+
+def like_distances(plane_dots, comparison_dots, square_norms, step):
+    """
+    Cosine distances of vectors moved by a like_step() from its comparison
+    point, given each vector's dot products with the plane vector and the
+    comparison point and its squared length.
+    """
+    plane_vec, comparison_point, translation_term, step_scale = step
+    plane_dots = np.asarray(plane_dots, dtype = np.float64)
+    multiples = step_scale * (translation_term - plane_dots)
+    # |x + m p|^2 = |x|^2 + 2 m x . p + m^2 |p|^2
+    squares = square_norms + multiples * (2 * plane_dots + multiples * np.dot(plane_vec, plane_vec))
+    comparison_dots = comparison_dots + multiples * np.dot(plane_vec, comparison_point)
+    comparison_norm = np.linalg.norm(comparison_point)
+    if comparison_norm == 0.0:
+        return np.zeros(len(plane_dots), dtype = np.float32)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        # Rounded to single precision before taking it from 1, as in
+        # embutils, so that vectors moved onto the comparison point come out
+        # at distance 0.0
+        cosines = (comparison_dots / (np.sqrt(squares) * comparison_norm)).astype(np.float32)
+    # and a vector moved to the origin is at distance 0.0
+    cosines[squares <= 0.0] = 1.0
+    return np.maximum(np.float32(0.0), np.float32(1.0) - cosines)
 
+def top_k(sims, k):
+    """
+    Indices of the k largest values of sims in descending order. Ties are
+    broken in favour of the lower index, as a stable sort would do.
+    """
+    k = max(0, min(k, len(sims)))
+    if k == 0:
+        return np.zeros(0, dtype = np.int64)
+    if k < len(sims):
+        kth = sims[np.argpartition(sims, -k)[-k]]
+        above = np.flatnonzero(sims > kth)
+        ties = np.flatnonzero(sims == kth)[:k - len(above)]
+        candidates = np.union1d(above, ties)
+    else:
+        candidates = np.arange(len(sims))
+    return candidates[np.argsort(-sims[candidates], kind = "stable")]